@@ -0,0 +1,352 @@
+import math
+import time
+from collections import namedtuple
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from db import get_db_connection
+
+# Decides which warehouses fulfil Pending sales orders and reserves the stock there.
+#
+# A wave takes the oldest Pending orders that still have unreserved quantity (up to
+# ALLOCATION_WAVE_SIZE), loads per-warehouse stock for every item they order in one query,
+# allocates them in memory one after another against the running availability, and writes
+# all reservations in the same BEGIN IMMEDIATE transaction as the read, so no posting can
+# slip in between. Available stock is ItemWarehouseStockTotals less what is already reserved.
+#
+# Strategies, per order:
+#   nearest       each line from the closest warehouse that has it, splitting only when short
+#   least_splits  as few warehouses as possible: repeatedly the one that can fill the most
+#                 remaining lines outright (nearest on ties); lines no single one can fill are split
+#   fifo          each line from the warehouse whose stock of the item was touched longest ago
+#
+# Distances come from latitude/longitude on Customers and Warehouses; without them every
+# warehouse is equally near and ties go to the lowest warehouse_id. An order is allocated in
+# full or not at all unless ALLOCATION_PARTIAL is set. Shipping an allocated order (ledger
+# ship_sales_order without a warehouse) takes its reserved quantities out of each warehouse;
+# shipping, cancelling, deleting or editing its lines releases them. Every other stock removal
+# leaves reserved stock alone: the ledger's guard counts it as unavailable.
+
+DEFAULTS = {
+    'ALLOCATION_STRATEGY': 'nearest',
+    'ALLOCATION_WAVE_SIZE': 500,
+    'ALLOCATION_PARTIAL': False,
+    'ALLOCATE_ON_CREATE': True,
+}
+STRATEGIES = ('nearest', 'least_splits', 'fifo')
+EARTH_RADIUS_KM = 6371.0
+
+MIGRATION = '''
+    ALTER TABLE Warehouses ADD COLUMN latitude REAL;
+    ALTER TABLE Warehouses ADD COLUMN longitude REAL;
+    ALTER TABLE Customers ADD COLUMN latitude REAL;
+    ALTER TABLE Customers ADD COLUMN longitude REAL;
+
+    CREATE TABLE IF NOT EXISTS StockReservations (
+        reservation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        so_id INTEGER NOT NULL,
+        so_detail_id INTEGER NOT NULL,
+        item_id INTEGER NOT NULL,
+        warehouse_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL CHECK (quantity > 0),
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_stock_reservations_item_warehouse ON StockReservations (item_id, warehouse_id);
+    CREATE INDEX IF NOT EXISTS idx_stock_reservations_detail ON StockReservations (so_detail_id);
+    CREATE INDEX IF NOT EXISTS idx_stock_reservations_so ON StockReservations (so_id);
+    CREATE INDEX IF NOT EXISTS idx_sales_orders_status_date ON SalesOrders (status, IFNULL(order_date, ''), so_id);
+
+    -- Reservations only hold for Pending orders and the lines as they were allocated
+    CREATE TRIGGER IF NOT EXISTS trg_reservations_order_closed AFTER UPDATE OF status ON SalesOrders
+    WHEN NEW.status != 'Pending'
+    BEGIN
+        DELETE FROM StockReservations WHERE so_id = NEW.so_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reservations_order_delete AFTER DELETE ON SalesOrders
+    BEGIN
+        DELETE FROM StockReservations WHERE so_id = OLD.so_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reservations_line_update AFTER UPDATE OF item_id, quantity_sold ON SalesOrderDetails
+    WHEN NEW.item_id IS NOT OLD.item_id OR NEW.quantity_sold < OLD.quantity_sold
+    BEGIN
+        DELETE FROM StockReservations WHERE so_detail_id = OLD.so_detail_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reservations_line_delete AFTER DELETE ON SalesOrderDetails
+    BEGIN
+        DELETE FROM StockReservations WHERE so_detail_id = OLD.so_detail_id;
+    END;
+'''
+
+
+def reserved(item_id, warehouse_id, excluding='NULL'):
+    # SQL for the quantity of item_id reserved in warehouse_id (columns or ?), leaving out the
+    # reservations of order excluding. Shared with the ledger's oversell guard.
+    return (f'(SELECT IFNULL(SUM(r.quantity), 0) FROM StockReservations r '
+            f'WHERE r.item_id = {item_id} AND r.warehouse_id = {warehouse_id} AND r.so_id IS NOT {excluding})')
+
+
+_RESERVED_FOR_LINE = '(SELECT IFNULL(SUM(r.quantity), 0) FROM StockReservations r WHERE r.so_detail_id = d.so_detail_id)'
+
+WAVE_QUERY = f'''
+    SELECT so.so_id, IFNULL(so.order_date, '') AS order_date, c.latitude, c.longitude,
+           d.so_detail_id, d.item_id, d.quantity_sold - {_RESERVED_FOR_LINE} AS outstanding
+    FROM (
+        SELECT so_id, customer_id, order_date FROM SalesOrders o
+        -- The >= lets the index seek to the cursor; the row value then skips past it
+        WHERE status = 'Pending' AND IFNULL(order_date, '') >= ? AND (IFNULL(order_date, ''), so_id) > (?, ?) {{only}}
+          AND EXISTS (SELECT 1 FROM SalesOrderDetails d
+                      WHERE d.so_id = o.so_id AND d.item_id IS NOT NULL AND d.quantity_sold > {_RESERVED_FOR_LINE})
+        ORDER BY IFNULL(order_date, ''), so_id
+        LIMIT ?
+    ) so
+    JOIN SalesOrderDetails d ON d.so_id = so.so_id
+    LEFT JOIN Customers c ON c.customer_id = so.customer_id
+    WHERE d.item_id IS NOT NULL AND d.quantity_sold > {_RESERVED_FOR_LINE}
+    ORDER BY IFNULL(so.order_date, ''), so.so_id, d.so_detail_id
+'''
+
+# Stock without a warehouse (bucket 0) can't be shipped, so it is never allocated
+STOCK_QUERY = f'''
+    SELECT t.item_id, t.warehouse_id,
+           t.total_qty - {reserved('t.item_id', 't.warehouse_id')} AS available,
+           (SELECT MIN(s.last_updated) FROM Stock s
+            WHERE s.item_id = t.item_id AND s.warehouse_id = t.warehouse_id AND s.quantity > 0) AS oldest
+    FROM ItemWarehouseStockTotals t
+    WHERE t.item_id IN (SELECT item_id FROM temp.allocation_items) AND t.warehouse_id != 0
+'''
+
+Line = namedtuple('Line', 'so_detail_id item_id outstanding')
+
+
+class AllocationError(ValueError):
+    pass
+
+
+def settings(config=None):
+    # ALLOCATION_* config keys as allocate() options: ALLOCATION_WAVE_SIZE -> wave_size
+    config = config if config is not None else current_app.config
+    return {key[len('ALLOCATION_'):].lower(): config[key] for key in DEFAULTS if key.startswith('ALLOCATION_')}
+
+
+def _radians(position):
+    # (lat, lon, cos lat) in radians, or None for an unknown position
+    if None in position:
+        return None
+    lat, lon = math.radians(position[0]), math.radians(position[1])
+    return lat, lon, math.cos(lat)
+
+
+def _distance(a, b):
+    # Great-circle km between _radians() positions; unknown positions are infinitely far
+    if a is None or b is None:
+        return math.inf
+    h = math.sin((b[0] - a[0]) / 2) ** 2 + a[2] * b[2] * math.sin((b[1] - a[1]) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, h)))
+
+
+class Allocator:
+    # In-memory availability for one wave. available: {item_id: {warehouse_id: quantity}}
+    def __init__(self, strategy, warehouses, available, oldest, partial=False):
+        if strategy not in STRATEGIES:
+            raise AllocationError(f'Unknown allocation strategy {strategy!r}; use one of {", ".join(STRATEGIES)}')
+        self.strategy = strategy
+        self.warehouses = {warehouse_id: _radians(position) for warehouse_id, position in warehouses.items()}
+        self.available = available
+        self.oldest = oldest
+        self.partial = partial
+        self._nearest = {}
+
+    def _by_distance(self, position):
+        # Every warehouse id, nearest first; shared by customers at the same position
+        ranked = self._nearest.get(position)
+        if ranked is None:
+            origin = _radians(position)
+            ranked = self._nearest[position] = sorted(
+                self.warehouses, key=lambda warehouse_id: (_distance(origin, self.warehouses[warehouse_id]),
+                                                           warehouse_id))
+        return ranked
+
+    def _sources(self, item_id, nearest):
+        stock = self.available.get(item_id, {})
+        if self.strategy == 'fifo':
+            return sorted(stock, key=lambda warehouse_id: (self.oldest.get((item_id, warehouse_id)) or '~',
+                                                           warehouse_id))
+        return [warehouse_id for warehouse_id in nearest if warehouse_id in stock]
+
+    def allocate(self, lines, position):
+        # Returns [(line, warehouse_id, quantity)] and takes it off availability, or None
+        # when the order can't be filled (and partial allocation is off)
+        nearest = self._by_distance(position)
+        taken = {}
+
+        def free(item_id, warehouse_id):
+            return self.available.get(item_id, {}).get(warehouse_id, 0) - taken.get((item_id, warehouse_id), 0)
+
+        def take(line, warehouse_id, quantity):
+            taken[(line.item_id, warehouse_id)] = taken.get((line.item_id, warehouse_id), 0) + quantity
+            picks.append((line, warehouse_id, quantity))
+
+        picks = []
+        pending = list(lines)
+        if self.strategy == 'least_splits':
+            candidates = [warehouse_id for warehouse_id in nearest
+                          if any(free(line.item_id, warehouse_id) > 0 for line in pending)]
+            while pending:
+                best, best_lines = None, []
+                for warehouse_id in candidates:
+                    claimed = {}
+                    filled = []
+                    for line in pending:
+                        if free(line.item_id, warehouse_id) - claimed.get(line.item_id, 0) >= line.outstanding:
+                            claimed[line.item_id] = claimed.get(line.item_id, 0) + line.outstanding
+                            filled.append(line)
+                    if len(filled) > len(best_lines):
+                        best, best_lines = warehouse_id, filled
+                if best is None:
+                    break
+                for line in best_lines:
+                    take(line, best, line.outstanding)
+                pending = [line for line in pending if line not in best_lines]
+
+        short = False
+        for line in pending:
+            needed = line.outstanding
+            for warehouse_id in self._sources(line.item_id, nearest):
+                quantity = min(needed, free(line.item_id, warehouse_id))
+                if quantity > 0:
+                    take(line, warehouse_id, quantity)
+                    needed -= quantity
+                    if not needed:
+                        break
+            short = short or needed > 0
+        if short and not self.partial:
+            return None
+        for (item_id, warehouse_id), quantity in taken.items():
+            self.available[item_id][warehouse_id] -= quantity
+        return picks
+
+
+def _load(conn, items):
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS allocation_items (item_id INTEGER PRIMARY KEY)')
+    conn.execute('DELETE FROM temp.allocation_items')
+    conn.executemany('INSERT INTO temp.allocation_items (item_id) VALUES (?)', ((item_id,) for item_id in items))
+    available = {}
+    oldest = {}
+    for row in conn.execute(STOCK_QUERY):
+        if row['available'] > 0:
+            available.setdefault(row['item_id'], {})[row['warehouse_id']] = row['available']
+            oldest[(row['item_id'], row['warehouse_id'])] = row['oldest']
+    return available, oldest
+
+
+def allocate(conn, options=None, after=None, so_id=None):
+    # One wave: the oldest Pending orders after the (order_date, so_id) cursor, or just so_id.
+    # Returns a summary; 'last' is the cursor for the next wave, None once none are left.
+    options = options or settings(DEFAULTS)
+    started = time.perf_counter()
+    after = after or ('', 0)
+    sql = WAVE_QUERY.format(only='AND so_id = ?' if so_id is not None else '')
+    params = [after[0]] + list(after) + ([so_id] if so_id is not None else []) + [options['wave_size']]
+    summary = {'strategy': options['strategy'], 'orders': 0, 'allocated': 0, 'short': [], 'lines': 0,
+               'split_lines': 0, 'reservations': 0, 'last': None}
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        orders = {}
+        for row in conn.execute(sql, params):
+            order = orders.setdefault(row['so_id'], ((row['order_date'], row['so_id']),
+                                                     (row['latitude'], row['longitude']), []))
+            order[2].append(Line(row['so_detail_id'], row['item_id'], row['outstanding']))
+        available, oldest = _load(conn, {line.item_id for _, _, lines in orders.values() for line in lines})
+        warehouses = {row['warehouse_id']: (row['latitude'], row['longitude'])
+                      for row in conn.execute('SELECT warehouse_id, latitude, longitude FROM Warehouses')}
+        allocator = Allocator(options['strategy'], warehouses, available, oldest, options['partial'])
+
+        reservations = []
+        for so_id_, (cursor, position, lines) in orders.items():
+            picks = allocator.allocate(lines, position)
+            summary['last'] = cursor
+            if picks is None:
+                summary['short'].append(so_id_)
+                continue
+            summary['allocated'] += 1
+            sources = {}
+            for line, warehouse_id, quantity in picks:
+                sources.setdefault(line.so_detail_id, set()).add(warehouse_id)
+                reservations.append((so_id_, line.so_detail_id, line.item_id, warehouse_id, quantity))
+            summary['lines'] += len(sources)
+            summary['split_lines'] += sum(1 for used in sources.values() if len(used) > 1)
+        conn.executemany('''
+            INSERT INTO StockReservations (so_id, so_detail_id, item_id, warehouse_id, quantity)
+            VALUES (?, ?, ?, ?, ?)
+        ''', reservations)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    summary['orders'] = len(orders)
+    summary['reservations'] = len(reservations)
+    if len(orders) < options['wave_size']:
+        summary['last'] = None
+    summary['seconds'] = round(time.perf_counter() - started, 4)
+    return summary
+
+
+def allocate_all(conn, options=None, progress=None):
+    # Waves until every Pending order has been tried once; returns the combined summary
+    progress = progress or (lambda summary: None)
+    total = None
+    after = None
+    while True:
+        summary = allocate(conn, options, after)
+        progress(summary)
+        if total is None:
+            total = summary
+        else:
+            for key in ('orders', 'allocated', 'lines', 'split_lines', 'reservations', 'seconds'):
+                total[key] += summary[key]
+            total['short'] += summary['short']
+        after = total['last'] = summary['last']
+        if after is None:
+            total['seconds'] = round(total['seconds'], 4)
+            return total
+
+
+def reservations(conn, so_id):
+    return conn.execute('''
+        SELECT r.so_detail_id, r.item_id, i.item_name, r.warehouse_id, w.warehouse_name, r.quantity
+        FROM StockReservations r
+        LEFT JOIN Items i ON i.item_id = r.item_id
+        LEFT JOIN Warehouses w ON w.warehouse_id = r.warehouse_id
+        WHERE r.so_id = ?
+        ORDER BY r.so_detail_id, r.warehouse_id
+    ''', (so_id,)).fetchall()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    if app.config['ALLOCATION_STRATEGY'] not in STRATEGIES:
+        raise ValueError(f"Unknown ALLOCATION_STRATEGY {app.config['ALLOCATION_STRATEGY']!r}")
+    app.cli.add_command(allocate_command)
+
+
+@click.command('allocate-orders')
+@click.option('--strategy', type=click.Choice(STRATEGIES), default=None, help='Default: ALLOCATION_STRATEGY.')
+@click.option('--wave-size', type=int, default=None, help='Orders per wave. Default: ALLOCATION_WAVE_SIZE.')
+@click.option('--all', 'every_wave', is_flag=True, help='Keep going until every Pending order has been tried.')
+@with_appcontext
+def allocate_command(strategy, wave_size, every_wave):
+    options = settings()
+    if strategy:
+        options['strategy'] = strategy
+    if wave_size:
+        options['wave_size'] = wave_size
+    conn = get_db_connection()
+    summary = allocate_all(conn, options) if every_wave else allocate(conn, options)
+    click.echo(f"{summary['strategy']}: allocated {summary['allocated']} of {summary['orders']} orders "
+               f"({summary['lines']} lines, {summary['split_lines']} split) in {summary['seconds']}s.")
+    if summary['short']:
+        click.echo(f"{len(summary['short'])} orders can't be filled yet.")
@@ -0,0 +1,169 @@
+import math
+from email.utils import formatdate
+
+from flask import Blueprint, Response, abort, jsonify, request, url_for
+
+import catalog
+import reporting
+import versions
+from db import get_db_connection
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+# name: (tables the data is derived from, keyset column, base query, reads report summaries)
+RESOURCES = {
+    'suppliers': (
+        ('Suppliers',), 'supplier_id',
+        '''SELECT supplier_id, supplier_name, contact_person, phone, email, address, updated_at
+           FROM Suppliers''',
+        False,
+    ),
+    'inventory': (
+        ('Items', 'Categories', 'Suppliers', 'Stock'), 'item_id',
+        '''SELECT Items.item_id, Items.item_name, Items.description,
+                  Categories.category_name, Suppliers.supplier_name,
+                  Items.unit_price, Items.reorder_level,
+                  IFNULL(ItemStockTotals.total_qty, 0) AS total_stock
+           FROM Items
+           LEFT JOIN Categories ON Items.category_id = Categories.category_id
+           LEFT JOIN Suppliers ON Items.supplier_id = Suppliers.supplier_id
+           LEFT JOIN ItemStockTotals ON Items.item_id = ItemStockTotals.item_id''',
+        False,
+    ),
+    'orders': (
+        ('PurchaseOrders', 'PurchaseOrderDetails', 'Suppliers', 'Items'), 'po_detail_id',
+        '''SELECT pod.po_detail_id, po.po_id, s.supplier_name, po.order_date, po.status,
+                  po.expected_delivery_date, pod.item_id, i.item_name, pod.quantity_ordered,
+                  pod.unit_cost, pod.quantity_received
+           FROM PurchaseOrders po
+           JOIN Suppliers s ON po.supplier_id = s.supplier_id
+           JOIN PurchaseOrderDetails pod ON po.po_id = pod.po_id
+           JOIN Items i ON pod.item_id = i.item_id''',
+        False,
+    ),
+    'sales_orders': (
+        ('SalesOrders', 'SalesOrderDetails', 'Customers'), 'so_id',
+        '''SELECT so.so_id, c.customer_name, so.order_date, so.status,
+                  so.total_items, so.total_value
+           FROM SalesOrderSummary so
+           JOIN Customers c ON so.customer_id = c.customer_id''',
+        True,
+    ),
+    'reports': (
+        ('Categories', 'Items', 'Stock'), 'category_id',
+        'SELECT category_id, category_name, total_stock FROM CategoryStockSummary',
+        True,
+    ),
+    'performance': (
+        ('Items', 'Stock'), 'item_id',
+        '''SELECT i.item_id, i.item_name, IFNULL(t.total_qty, 0) AS total_stock, i.reorder_level
+           FROM Items i
+           LEFT JOIN ItemStockTotals t ON i.item_id = t.item_id
+           WHERE IFNULL(t.total_qty, 0) < i.reorder_level''',
+        False,
+    ),
+    'users': (
+        ('Users',), 'user_id',
+        'SELECT user_id, username, role, email, updated_at FROM Users',
+        False,
+    ),
+}
+
+_columns = {}
+
+
+def _error(message, status=400):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+
+def _resource_columns(conn, name, query):
+    if name not in _columns:
+        cursor = conn.execute(f'SELECT * FROM ({query}) LIMIT 0')
+        _columns[name] = [column[0] for column in cursor.description]
+    return _columns[name]
+
+
+@api.route('/<name>')
+def list_resource(name):
+    if name not in RESOURCES:
+        abort(404)
+    tables, key, query, uses_summaries = RESOURCES[name]
+    conn = get_db_connection()
+
+    # Answer unchanged polls from TableVersions alone, before any list or aggregate query runs.
+    # Summaries may lag their tables, so those resources are refreshed first and also keyed
+    # on how far the summaries have got.
+    extra = ()
+    refreshed_at = None
+    if uses_summaries:
+        state = reporting.ensure_fresh(conn)
+        extra = (state['high_water_mark'],)
+        refreshed_at = state['refreshed_at']
+    etag, last_modified = versions.fingerprint(conn, tables, name, request.query_string, *extra)
+    if refreshed_at is not None:
+        # The header has whole seconds, so round up or If-Modified-Since never matches
+        last_modified = max(last_modified, int(math.ceil(refreshed_at)))
+    if etag in request.if_none_match or (
+            not request.if_none_match and request.if_modified_since
+            and last_modified <= request.if_modified_since.timestamp()):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+        return response
+
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    if limit < 1 or limit > MAX_LIMIT:
+        return _error(f'limit must be between 1 and {MAX_LIMIT}')
+    after = request.args.get('after', type=int)
+
+    columns = _resource_columns(conn, name, query)
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+    unknown = [field for field in fields if field not in columns]
+    if unknown:
+        return _error(f"Unknown fields: {', '.join(unknown)}")
+    selected = fields or columns
+    # The keyset column is always read so the next cursor can be produced
+    select_list = ', '.join(selected if key in selected else selected + [key])
+
+    sql = f'SELECT {select_list} FROM ({query})'
+    params = []
+    if after is not None:
+        sql += f' WHERE {key} > ?'
+        params.append(after)
+    sql += f' ORDER BY {key} LIMIT ?'
+    params.append(limit + 1)
+    rows = conn.execute(sql, params).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_after = rows[-1][key] if has_more else None
+    next_url = None
+    if next_after is not None:
+        args = request.args.to_dict()
+        args['after'] = next_after
+        next_url = url_for('api.list_resource', name=name, **args)
+
+    response = jsonify({
+        'data': [{field: row[field] for field in selected} for row in rows],
+        'next_after': next_after,
+        'next': next_url,
+    })
+    response.set_etag(etag)
+    response.headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@api.route('/items/suggest')
+def suggest_items():
+    # Typeahead for the order forms, answered from the in-memory catalog index
+    limit = request.args.get('limit', type=int)
+    if limit is not None and not 1 <= limit <= catalog.MAX_SUGGEST_LIMIT:
+        return _error(f'limit must be between 1 and {catalog.MAX_SUGGEST_LIMIT}')
+    query = request.args.get('q', '')
+    return jsonify({'query': query, 'data': catalog.suggest(query, limit)})
@@ -1,17 +1,55 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-import sqlite3
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort, Response, stream_with_context
+from collections import namedtuple
 from datetime import date
-import os
-DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inventory.db')
+import io
+
+import allocation
+import archive
+import assets
+import bulk
+import cache
+import catalog
+import changefeed
+import db
+import fragments
+import jobs
+import ledger
+import migrations
+import order_lines
+import passwords
+import planning
+import profiling
+import replica
+import reporting
+import search
+import stock_totals
+from api import api
+from db import get_db_connection
 
 app = Flask(__name__)
 app.secret_key = 'GitHubActionsSecretKey'
-
-
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+app.config.setdefault('INVENTORY_PAGE_SIZE', 50)
+app.config.setdefault('INVENTORY_MAX_PAGE_SIZE', 500)
+app.config.setdefault('SALES_ORDERS_PAGE_SIZE', 100)
+db.init_app(app)
+replica.init_app(app)
+profiling.init_app(app)
+passwords.init_app(app)
+cache.init_app(app)
+fragments.init_app(app)
+assets.init_app(app)
+migrations.init_app(app)
+catalog.init_app(app)
+stock_totals.init_app(app)
+reporting.init_app(app)
+bulk.init_app(app)
+ledger.init_app(app)
+jobs.init_app(app)
+planning.init_app(app)
+archive.init_app(app)
+changefeed.init_app(app)
+allocation.init_app(app)
+app.register_blueprint(api)
 
 @app.route('/', methods=['GET', 'POST'])
 def login():
@@ -20,12 +58,22 @@ def login():
         username = request.form['username']
         password = request.form['password']
 
-        conn = get_db_connection()
-        user = conn.execute('SELECT * FROM Users WHERE username = ? AND password_hash = ?', 
-                            (username, password)).fetchone()
-        conn.close()
+        # Throttled attempts are refused before any hashing work is done
+        throttle = passwords.throttle()
+        retry_after = throttle.check(username, request.remote_addr)
+        if retry_after:
+            error = f"Too many login attempts. Try again in {retry_after} seconds."
+            return render_template('login.html', error=error), 429, {'Retry-After': str(retry_after)}
+
+        try:
+            user = passwords.authenticate(get_db_connection(), username, password)
+        except passwords.HasherBusy:
+            throttle.refund(username)
+            error = "The server is busy. Please try again in a moment."
+            return render_template('login.html', error=error), 503, {'Retry-After': '1'}
 
         if user:
+            throttle.succeeded(username)
             session['user_id'] = user['user_id']
             session['username'] = user['username']
             return redirect(url_for('index'))
@@ -52,16 +100,18 @@ def register():
         if existing_user:
             error = "Username already exists"
         else:
+            try:
+                password_hash = passwords.hasher().hash(password)
+            except passwords.HasherBusy:
+                error = "The server is busy. Please try again in a moment."
+                return render_template('register.html', error=error), 503, {'Retry-After': '1'}
             conn.execute(
                 'INSERT INTO Users (username, password_hash, role, email) VALUES (?, ?, ?, ?)',
-                (username, password, role, email)
+                (username, password_hash, role, email)
             )
             conn.commit()
-            conn.close()
             return redirect(url_for('index'))
 
-        conn.close()
-
     return render_template('register.html', error=error)
 
 @app.route('/index')
@@ -75,31 +125,77 @@ def index():
 def suppliers():
     conn = get_db_connection()
     suppliers = conn.execute('SELECT * FROM Suppliers').fetchall()
-    conn.close()
     return render_template('suppliers.html', suppliers=suppliers)
 
+INVENTORY_STOCK_FILTERS = {
+    'in-stock': 'IFNULL(ItemStockTotals.total_qty, 0) > Items.reorder_level',
+    'low-stock': 'IFNULL(ItemStockTotals.total_qty, 0) > 0 AND IFNULL(ItemStockTotals.total_qty, 0) <= Items.reorder_level',
+    'out-of-stock': 'IFNULL(ItemStockTotals.total_qty, 0) = 0',
+}
+# What an inventory page shows, so its cached fragment covers the pager too
+INVENTORY_TABLES = ('Items', 'Stock', 'Categories', 'Suppliers')
+InventoryPage = namedtuple('InventoryPage', 'items prev_url next_url')
+SalesOrdersPage = namedtuple('SalesOrdersPage', 'rows prev_url next_url')
+
+def parse_inventory_cursor(value, ranked):
+    # Cursors are "item_id", or "rank:item_id" when results are ordered by search relevance
+    if not value:
+        return None
+    try:
+        if ranked:
+            rank, item_id = value.split(':')
+            return [float(rank), int(item_id)]
+        return [int(value)]
+    except ValueError:
+        return None
+
+def inventory_cursor(row, ranked):
+    if ranked:
+        return f"{row['search_rank']!r}:{row['item_id']}"
+    return str(row['item_id'])
+
 @app.route('/inventory', methods=['GET'])
 def inventory():
     search_query = request.args.get('search', '').strip()
     category_filter = request.args.get('category', '').strip()
     stock_filter = request.args.get('stock', '').strip()
+    page_size = min(request.args.get('per_page', app.config['INVENTORY_PAGE_SIZE'], type=int),
+                    app.config['INVENTORY_MAX_PAGE_SIZE'])
+    page_size = max(page_size, 1)
 
     conn = get_db_connection()
 
+    match = search.match_expression(search_query) if search_query else ''
+    ranked = bool(match) and search.has_search_index(conn)
+    after = parse_inventory_cursor(request.args.get('after'), ranked)
+    before = parse_inventory_cursor(request.args.get('before'), ranked)
+
     query = '''
         SELECT Items.item_id, Items.item_name, Items.description,
                Categories.category_name, Suppliers.supplier_name,
                Items.unit_price, Items.reorder_level,
-               IFNULL(SUM(Stock.quantity), 0) AS total_stock
-        FROM Items
+               IFNULL(ItemStockTotals.total_qty, 0) AS total_stock
+    '''
+    if ranked:
+        query += ''',
+               ItemsSearch.rank AS search_rank
+        FROM ItemsSearch
+        JOIN Items ON Items.item_id = ItemsSearch.rowid
+        '''
+    else:
+        query += "FROM Items"
+    query += '''
         LEFT JOIN Categories ON Items.category_id = Categories.category_id
         LEFT JOIN Suppliers ON Items.supplier_id = Suppliers.supplier_id
-        LEFT JOIN Stock ON Items.item_id = Stock.item_id
+        LEFT JOIN ItemStockTotals ON Items.item_id = ItemStockTotals.item_id
     '''
     conditions = []
     params = []
 
-    if search_query:
+    if ranked:
+        conditions.append("ItemsSearch MATCH ?")
+        params.append(match)
+    elif search_query:
         conditions.append("(Items.item_name LIKE ? OR Items.description LIKE ?)")
         params.extend([f"%{search_query}%", f"%{search_query}%"])
 
@@ -107,88 +203,119 @@ def inventory():
         conditions.append("Categories.category_name = ?")
         params.append(category_filter)
 
+    if stock_filter in INVENTORY_STOCK_FILTERS:
+        conditions.append(INVENTORY_STOCK_FILTERS[stock_filter])
+
+    # Keyset pagination: seek past the cursor on the sort key instead of using OFFSET.
+    # Search results are ordered by bm25 relevance, with item_id breaking ties.
+    sort_key = "(ItemsSearch.rank, Items.item_id)" if ranked else "(Items.item_id)"
+    if before is not None:
+        conditions.append(f"{sort_key} < ({', '.join('?' * len(before))})")
+        params.extend(before)
+        order = "DESC"
+    else:
+        if after is not None:
+            conditions.append(f"{sort_key} > ({', '.join('?' * len(after))})")
+            params.extend(after)
+        order = "ASC"
+
     query += " WHERE " + " AND ".join(conditions) if conditions else ""
-    query += '''
-        GROUP BY Items.item_id
-        ORDER BY Items.item_id
+    order_by = f"ItemsSearch.rank {order}, Items.item_id {order}" if ranked else f"Items.item_id {order}"
+    query += f'''
+        ORDER BY {order_by}
+        LIMIT ?
     '''
-    items = conn.execute(query, params).fetchall()
-
-    if stock_filter:
-        filtered_items = []
-        for item in items:
-            total_stock = item['total_stock']
-            reorder_level = item['reorder_level']
-            if stock_filter == 'in-stock' and total_stock > reorder_level:
-                filtered_items.append(item)
-            elif stock_filter == 'low-stock' and 0 < total_stock <= reorder_level:
-                filtered_items.append(item)
-            elif stock_filter == 'out-of-stock' and total_stock == 0:
-                filtered_items.append(item)
-        items = filtered_items
-
-    conn.close()
-    return render_template('inventory.html', items=items)
-
+    def load_page():
+        # Fetch one extra row to learn whether another page exists in this direction
+        items = conn.execute(query, params + [page_size + 1]).fetchall()
+        has_more = len(items) > page_size
+        items = items[:page_size]
+        if before is not None:
+            items.reverse()
+
+        page_args = {key: value for key, value in request.args.items() if key not in ('after', 'before')}
+        prev_url = next_url = None
+        if items:
+            if (before is not None and has_more) or (before is None and after is not None):
+                prev_url = url_for('inventory', before=inventory_cursor(items[0], ranked), **page_args)
+            if (before is None and has_more) or before is not None:
+                next_url = url_for('inventory', after=inventory_cursor(items[-1], ranked), **page_args)
+        return InventoryPage(items, prev_url, next_url)
+
+    # The page is only queried when its fragment isn't cached
+    fragment_key = fragments.key(conn, 'inventory', INVENTORY_TABLES, request.query_string, page_size)
+    return render_template('inventory.html', page=fragments.Lazy(load_page), fragment_key=fragment_key,
+                           live_since=changefeed.current_version(conn))
 
 
 @app.route('/orders')
 def orders():
     conn = get_db_connection()
-    orders_list = conn.execute('''
-        SELECT 
-            po.po_id, 
-            s.supplier_name, 
-            po.order_date, 
-            po.status, 
-            po.expected_delivery_date,
-            i.item_name,
-            pod.quantity_ordered
-        FROM PurchaseOrders po
-        JOIN Suppliers s ON po.supplier_id = s.supplier_id
-        JOIN PurchaseOrderDetails pod ON po.po_id = pod.po_id
-        JOIN Items i ON pod.item_id = i.item_id
-        ORDER BY po.po_id
-    ''').fetchall()
-    conn.close()
-    return render_template('orders.html', orders=orders_list)
+    include_archive = archive.requested()
+    with archive.attached(conn, enabled=include_archive) as schemas:
+        orders_list = conn.execute(f'''
+            SELECT 
+                po.po_id, 
+                s.supplier_name, 
+                po.order_date, 
+                po.status, 
+                po.expected_delivery_date,
+                i.item_name,
+                pod.quantity_ordered
+            FROM {archive.union(conn, 'PurchaseOrders', schemas)} po
+            JOIN Suppliers s ON po.supplier_id = s.supplier_id
+            JOIN {archive.union(conn, 'PurchaseOrderDetails', schemas)} pod ON po.po_id = pod.po_id
+            JOIN Items i ON pod.item_id = i.item_id
+            ORDER BY po.po_id
+        ''').fetchall()
+    return render_template('orders.html', orders=orders_list, include_archive=include_archive)
+
+def order_form_data():
+    # The posted form, or the JSON body if it is an object; None for any other JSON
+    if not request.is_json:
+        return request.form
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else None
+
+def order_form_error(message, endpoint, **values):
+    if request.is_json:
+        return jsonify({'error': message}), 400
+    flash(message, "danger")
+    return redirect(url_for(endpoint, **values))
 
 @app.route('/orders/add', methods=['GET', 'POST'])
 def add_order():
     conn = get_db_connection()
 
     if request.method == 'POST':
-        supplier_id = int(request.form['supplier_id'])
-        item_id = int(request.form['item_id'])
-        quantity_ordered = int(request.form['quantity'])
-        unit_cost = float(request.form['unit_cost'])
-        expected_delivery_date = request.form['order_date']
-
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            INSERT INTO PurchaseOrders (supplier_id, order_date, status, expected_delivery_date)
-            VALUES (?, DATE('now'), 'Pending', ?)
-        """, (supplier_id, expected_delivery_date))
-
-        po_id = cursor.lastrowid
-
-        cursor.execute("""
-            INSERT INTO PurchaseOrderDetails (po_id, item_id, quantity_ordered)
-            VALUES (?, ?, ?)
-        """, (po_id, item_id, quantity_ordered))
-
-        conn.commit()
-        conn.close()
-
+        data = order_form_data()
+        if data is None:
+            return order_form_error("The request body must be a JSON object.", "add_order")
+        try:
+            supplier_id = int(data['supplier_id'])
+            expected_delivery_date = data.get('expected_delivery_date', data.get('order_date'))
+            lines = order_lines.new_lines_from_request(order_lines.PURCHASE)
+        except (KeyError, TypeError, ValueError):
+            return order_form_error("Please check the supplier and order lines.", "add_order")
+        if not lines:
+            return order_form_error("A purchase order needs at least one line.", "add_order")
+
+        with order_lines.immediate_transaction(conn):
+            cursor = conn.execute("""
+                INSERT INTO PurchaseOrders (supplier_id, order_date, status, expected_delivery_date)
+                VALUES (?, DATE('now'), 'Pending', ?)
+            """, (supplier_id, expected_delivery_date))
+            po_id = cursor.lastrowid
+            order_lines.insert_lines(conn, order_lines.PURCHASE, po_id, lines)
+
+        if request.is_json:
+            return jsonify({'po_id': po_id, 'lines': len(lines)}), 201
         flash("Purchase order created!", "success")
         return redirect(url_for("orders"))
 
-    suppliers = conn.execute("SELECT * FROM Suppliers").fetchall()
-    items = conn.execute("SELECT * FROM Items").fetchall()
-    conn.close()
+    suppliers = cache.get_reference('suppliers')
 
-    return render_template("add_order.html", suppliers=suppliers, items=items)
+    return render_template("add_order.html", suppliers=suppliers)
 
 @app.route('/orders/edit/<int:po_id>', methods=['GET', 'POST'])
 def edit_order(po_id):
@@ -198,46 +325,45 @@ def edit_order(po_id):
     order = conn.execute(
         "SELECT * FROM PurchaseOrders WHERE po_id = ?", (po_id,)
     ).fetchone()
-    
+    if order is None:
+        abort(404)
     
     order_details = conn.execute(
-        "SELECT * FROM PurchaseOrderDetails WHERE po_id = ?", (po_id,)
+        "SELECT * FROM PurchaseOrderDetails WHERE po_id = ? ORDER BY po_detail_id", (po_id,)
     ).fetchall()
     
     if request.method == 'POST':
-        supplier_id = int(request.form['supplier_id'])
-        order_date = request.form['order_date']
-        expected_delivery_date = request.form['expected_delivery_date']
-        status = request.form['status']
-
-       
-        conn.execute("""
-            UPDATE PurchaseOrders
-            SET supplier_id = ?, order_date = ?, expected_delivery_date = ?, status = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE po_id = ?
-        """, (supplier_id, order_date, expected_delivery_date, status, po_id))
-
-        
-        for detail in order_details:
-            quantity = int(request.form.get(f'quantity_{detail["po_detail_id"]}'))
-            unit_cost = float(request.form.get(f'unit_cost_{detail["po_detail_id"]}'))
+        data = order_form_data()
+        if data is None:
+            return order_form_error("The request body must be a JSON object.", "edit_order", po_id=po_id)
+        try:
+            supplier_id = int(data['supplier_id'])
+            order_date = data['order_date']
+            expected_delivery_date = data['expected_delivery_date']
+            status = data['status']
+            updates, deletes = order_lines.line_changes_from_request(order_lines.PURCHASE, order_details)
+            new_lines = order_lines.new_lines_from_request(order_lines.PURCHASE, prefix='new_')
+        except (KeyError, TypeError, ValueError):
+            return order_form_error("Please check the order details.", "edit_order", po_id=po_id)
+
+        with order_lines.immediate_transaction(conn):
             conn.execute("""
-                UPDATE PurchaseOrderDetails
-                SET quantity_ordered = ?, unit_cost = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE po_detail_id = ?
-            """, (quantity, unit_cost, detail["po_detail_id"]))
-
-        conn.commit()
-        conn.close()
-
+                UPDATE PurchaseOrders
+                SET supplier_id = ?, order_date = ?, expected_delivery_date = ?, status = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE po_id = ?
+            """, (supplier_id, order_date, expected_delivery_date, status, po_id))
+            changed = order_lines.apply_line_changes(conn, order_lines.PURCHASE, order_details, updates, deletes)
+            order_lines.insert_lines(conn, order_lines.PURCHASE, po_id, new_lines)
+
+        if request.is_json:
+            return jsonify({'po_id': po_id, 'updated': changed, 'deleted': len(deletes), 'added': len(new_lines)})
         flash("Purchase order updated!", "success")
         return redirect(url_for("orders"))
 
-    suppliers = conn.execute("SELECT * FROM Suppliers").fetchall()
-    items = conn.execute("SELECT * FROM Items").fetchall()
-    conn.close()
+    suppliers = cache.get_reference('suppliers')
+    warehouses = cache.get_reference('warehouses')
 
-    return render_template("edit_order.html", order=order, order_details=order_details, suppliers=suppliers, items=items)
+    return render_template("edit_order.html", order=order, order_details=order_details, suppliers=suppliers, warehouses=warehouses)
 
 @app.route('/orders/delete/<int:po_id>')
 def delete_order(po_id):
@@ -250,141 +376,227 @@ def delete_order(po_id):
     conn.execute("DELETE FROM PurchaseOrders WHERE po_id = ?", (po_id,))
     
     conn.commit()
-    conn.close()
     
     flash("Purchase order deleted successfully!", "success")
     return redirect(url_for('orders'))
 
+@app.route('/orders/receive/<int:po_id>', methods=['POST'])
+def receive_order(po_id):
+    data = request.get_json() if request.is_json else request.form
+    try:
+        warehouse_id = int(data['warehouse_id'])
+        quantities = None
+        # JSON may receive part of an order: {"lines": [{"po_detail_id": .., "quantity": ..}]}
+        if request.is_json and data.get('lines') is not None:
+            quantities = {int(line['po_detail_id']): int(line['quantity']) for line in data['lines']}
+    except (KeyError, TypeError, ValueError):
+        return order_form_error("Please choose a warehouse to receive into.", "edit_order", po_id=po_id)
+
+    try:
+        received = ledger.receive_purchase_order(
+            get_db_connection(), po_id, warehouse_id, quantities, session.get('user_id'))
+    except ledger.PostingError as exc:
+        return order_form_error(str(exc), "edit_order", po_id=po_id)
+
+    if request.is_json:
+        return jsonify({'po_id': po_id, 'received_lines': received})
+    flash("Purchase order received into stock!", "success")
+    return redirect(url_for("orders"))
+
 @app.route('/reports')
 def reports():
-    conn = get_db_connection()
-    report_data = conn.execute('''
-        SELECT c.category_name, SUM(IFNULL(s.quantity,0)) AS total_stock
-        FROM Categories c
-        LEFT JOIN Items i ON c.category_id = i.category_id
-        LEFT JOIN Stock s ON i.item_id = s.item_id
-        GROUP BY c.category_id
-    ''').fetchall()
-    conn.close()
-    return render_template('reports.html', report_data=report_data)
+    data, pending_job = jobs.fetch_report('reports', request.args.get('job', type=int))
+    if data is None:
+        return render_template('job_pending.html', job=pending_job, title='Reports'), 202
+    # Job results were built from the primary; inline runs read through the router
+    status_conn = get_db_connection() if app.config['JOB_QUEUE'] else replica.get_read_connection()
+    return render_template('reports.html', report_status=reporting.status(status_conn),
+                           read_source=replica.read_source(), pending_job=pending_job, **data)
 
 @app.route('/sales_orders')
 def sales_orders():
-    conn = get_db_connection()
-    sales_summary = conn.execute('''
-        SELECT 
-            so.so_id,
-            c.customer_name,
-            so.order_date,
-            so.status,
-            SUM(sod.quantity_sold) AS total_items,
-            SUM(sod.quantity_sold * sod.unit_price) AS total_value
-        FROM SalesOrders so
-        JOIN Customers c ON so.customer_id = c.customer_id
-        JOIN SalesOrderDetails sod ON so.so_id = sod.so_id
-        GROUP BY so.so_id
-        ORDER BY so.so_id DESC
-    ''').fetchall()
-    conn.close()
-    return render_template('sales_orders.html', sales_summary=sales_summary)
+    # The listing itself may come from the snapshot; its status says how current that is
+    conn = replica.get_read_connection()
+    if replica.read_source()['source'] != 'snapshot':
+        # A snapshot holds the summaries as they were copied, so refreshing the primary
+        # wouldn't change what is read; in that mode the RefreshScheduler keeps them current
+        reporting.ensure_fresh(get_db_connection())
+    report_status = reporting.status(conn)
+    include_archive = archive.requested()
+    page_size = max(min(request.args.get('per_page', app.config['SALES_ORDERS_PAGE_SIZE'], type=int),
+                        app.config['INVENTORY_MAX_PAGE_SIZE']), 1)
+    # Keyset pagination, newest first: after= pages to older orders, before= back to newer ones
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    # Summaries only change when the high-water mark moves; archiving moves it too
+    fragment_key = fragments.key(conn, 'sales_orders', ('Customers',), report_status['high_water_mark'],
+                                 include_archive, after, before, page_size)
+    with archive.attached(conn, enabled=include_archive) as schemas:
+        def load_page():
+            condition, order, params = '', 'DESC', []
+            if before is not None:
+                condition, order, params = 'WHERE so.so_id > ?', 'ASC', [before]
+            elif after is not None:
+                condition, params = 'WHERE so.so_id < ?', [after]
+            rows = conn.execute(f'''
+                SELECT 
+                    so.so_id,
+                    c.customer_name,
+                    so.order_date,
+                    so.status,
+                    so.total_items,
+                    so.total_value
+                FROM {archive.union(conn, 'SalesOrderSummary', schemas)} so
+                JOIN Customers c ON so.customer_id = c.customer_id
+                {condition}
+                ORDER BY so.so_id {order}
+                LIMIT ?
+            ''', params + [page_size + 1]).fetchall()
+            has_more = len(rows) > page_size
+            rows = rows[:page_size]
+            if before is not None:
+                rows.reverse()
+            page_args = {key: value for key, value in request.args.items() if key not in ('after', 'before')}
+            prev_url = next_url = None
+            if rows:
+                if (before is not None and has_more) or (before is None and after is not None):
+                    prev_url = url_for('sales_orders', before=rows[0]['so_id'], **page_args)
+                if (before is None and has_more) or before is not None:
+                    next_url = url_for('sales_orders', after=rows[-1]['so_id'], **page_args)
+            return SalesOrdersPage(rows, prev_url, next_url)
+
+        # Rendered inside the block: the rows are read from the archives as the template asks
+        return render_template('sales_orders.html', page=fragments.Lazy(load_page), report_status=report_status,
+                               read_source=replica.read_source(), include_archive=include_archive,
+                               fragment_key=fragment_key)
 
 @app.route('/performance')
 def performance():
+    include_archive = archive.requested()
+    params = {'archive_dir': archive.archive_dir()} if include_archive else None
+    data, pending_job = jobs.fetch_report('performance', request.args.get('job', type=int), params)
+    if data is None:
+        return render_template('job_pending.html', job=pending_job, title='Performance'), 202
+    # Live updates resume from the change-feed version the data was built at (live_since in
+    # the result), however old it is; results stored before it was recorded start from now
+    data.setdefault('live_since', None)
+    # Job results were built from the primary; inline runs read through the router
+    status_conn = get_db_connection() if app.config['JOB_QUEUE'] else replica.get_read_connection()
+    return render_template('performance.html', report_status=reporting.status(status_conn),
+                           read_source=replica.read_source(), pending_job=pending_job,
+                           include_archive=include_archive, fragment_key=f"fragment-performance-{data['result_key']}",
+                           **data)
+
+@app.route('/planning', methods=['GET', 'POST'])
+def planning_view():
     conn = get_db_connection()
-    performance_data = conn.execute('''
-        SELECT i.item_name, SUM(IFNULL(s.quantity,0)) AS total_stock, i.reorder_level
-        FROM Items i
-        LEFT JOIN Stock s ON i.item_id = s.item_id
-        GROUP BY i.item_id
-        HAVING total_stock < i.reorder_level
-    ''').fetchall()
-    
-    sales_summary = conn.execute('''
-        SELECT 
-            so.so_id,
-            c.customer_name,
-            so.order_date,
-            so.status,
-            SUM(sod.quantity_sold) AS total_items,
-            SUM(sod.quantity_sold * sod.unit_price) AS total_value
-        FROM SalesOrders so
-        JOIN Customers c ON so.customer_id = c.customer_id
-        JOIN SalesOrderDetails sod ON so.so_id = sod.so_id
-        GROUP BY so.so_id
-        ORDER BY so.so_id
-    ''').fetchall()
-    conn.close()
-    return render_template('performance.html', performance_data=performance_data, sales_summary=sales_summary)
+    summary = error = job = None
+    if request.method == 'POST':
+        as_of = request.form.get('as_of') or None
+        try:
+            if as_of:
+                date.fromisoformat(as_of)
+        except ValueError:
+            error = f'Invalid date: {as_of}'
+        else:
+            params = {'as_of': as_of, 'options': planning.settings(), 'apply': request.form.get('apply') == 'on'}
+            if app.config['JOB_QUEUE']:
+                job = jobs.submit(conn, 'planning', params, user_id=session.get('user_id'))
+                return redirect(url_for('planning_view', job=job['job_id']))
+            try:
+                summary = planning.plan(conn, as_of, params['options'], params['apply'])
+            except planning.PlanningError as exc:
+                error = str(exc)
+    elif request.args.get('job', type=int):
+        job = jobs.get_job(conn, request.args.get('job', type=int))
+        if job is not None and job['kind'] != 'planning':
+            job = None
+        if job is not None and job['status'] == 'done':
+            summary = jobs.job_result(job)
+        elif job is not None and job['status'] == 'failed':
+            error = job['error']
+    return render_template('planning.html', last_run=planning.last_run(conn), suggestions=planning.suggestions(conn),
+                           settings=planning.settings(), job=job, summary=summary, error=error)
 
 @app.route('/sales_orders/add', methods=['GET', 'POST'])
 def add_sales_order():
     conn = get_db_connection()
     if request.method == 'POST':
-        customer_id = request.form['customer_id']
-        item_id = request.form['item_id']
-        quantity_sold = request.form['quantity_sold']
-        unit_price = request.form['unit_price']
-        shipping_address = request.form['shipping_address']
-
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO SalesOrders (customer_id, order_date, status, shipping_address)
-            VALUES (?, DATE('now'), 'Pending', ?)
-        """, (customer_id, shipping_address))
-        so_id = cursor.lastrowid
-
-        cursor.execute("""
-            INSERT INTO SalesOrderDetails (so_id, item_id, quantity_sold, unit_price)
-            VALUES (?, ?, ?, ?)
-        """, (so_id, item_id, quantity_sold, unit_price))
-
-        conn.commit()
-        conn.close()
+        data = order_form_data()
+        if data is None:
+            return order_form_error("The request body must be a JSON object.", "add_sales_order")
+        try:
+            customer_id = int(data['customer_id'])
+            shipping_address = data['shipping_address']
+            lines = order_lines.new_lines_from_request(order_lines.SALES)
+        except (KeyError, TypeError, ValueError):
+            return order_form_error("Please check the customer and order lines.", "add_sales_order")
+        if not lines:
+            return order_form_error("A sales order needs at least one line.", "add_sales_order")
+
+        with order_lines.immediate_transaction(conn):
+            cursor = conn.execute("""
+                INSERT INTO SalesOrders (customer_id, order_date, status, shipping_address)
+                VALUES (?, DATE('now'), 'Pending', ?)
+            """, (customer_id, shipping_address))
+            so_id = cursor.lastrowid
+            order_lines.insert_lines(conn, order_lines.SALES, so_id, lines)
+        allocated = None
+        if app.config['ALLOCATE_ON_CREATE']:
+            allocated = allocation.allocate(conn, allocation.settings(), so_id=so_id)['allocated'] == 1
+
+        if request.is_json:
+            return jsonify({'so_id': so_id, 'lines': len(lines), 'allocated': allocated}), 201
         flash("Sales order created!", "success")
+        if allocated is False:
+            flash("Not enough stock to allocate the order yet.", "warning")
         return redirect(url_for('performance'))
 
-    customers = conn.execute("SELECT * FROM Customers").fetchall()
-    items = conn.execute("SELECT * FROM Items").fetchall()
+    customers = cache.get_reference('customers')
     current_date = date.today().isoformat()
-    conn.close()
-    return render_template('add_sales_order.html', customers=customers, items=items, current_date=current_date)
+    return render_template('add_sales_order.html', customers=customers, current_date=current_date)
 
 @app.route('/sales_orders/edit/<int:so_id>', methods=['GET', 'POST'])
 def edit_sales_order(so_id):
     conn = get_db_connection()
     order = conn.execute("SELECT * FROM SalesOrders WHERE so_id = ?", (so_id,)).fetchone()
-    order_details = conn.execute("SELECT * FROM SalesOrderDetails WHERE so_id = ?", (so_id,)).fetchall()
+    if order is None:
+        abort(404)
+    order_details = conn.execute("SELECT * FROM SalesOrderDetails WHERE so_id = ? ORDER BY so_detail_id", (so_id,)).fetchall()
 
     if request.method == 'POST':
-        customer_id = request.form['customer_id']
-        status = request.form['status']
-        shipping_address = request.form['shipping_address']
-        order_date = request.form['order_date']
-
-        conn.execute("""
-            UPDATE SalesOrders
-            SET customer_id=?, status=?, shipping_address=?, order_date=?, updated_at=CURRENT_TIMESTAMP
-            WHERE so_id=?
-        """, (customer_id, status, shipping_address, order_date, so_id))
-
-        for detail in order_details:
-            quantity = request.form.get(f'quantity_{detail["so_detail_id"]}')
-            unit_price = request.form.get(f'unit_price_{detail["so_detail_id"]}')
+        data = order_form_data()
+        if data is None:
+            return order_form_error("The request body must be a JSON object.", "edit_sales_order", so_id=so_id)
+        try:
+            customer_id = int(data['customer_id'])
+            status = data['status']
+            shipping_address = data['shipping_address']
+            order_date = data['order_date']
+            updates, deletes = order_lines.line_changes_from_request(order_lines.SALES, order_details)
+            new_lines = order_lines.new_lines_from_request(order_lines.SALES, prefix='new_')
+        except (KeyError, TypeError, ValueError):
+            return order_form_error("Please check the order details.", "edit_sales_order", so_id=so_id)
+
+        with order_lines.immediate_transaction(conn):
             conn.execute("""
-                UPDATE SalesOrderDetails
-                SET quantity_sold=?, unit_price=?, updated_at=CURRENT_TIMESTAMP
-                WHERE so_detail_id=?
-            """, (quantity, unit_price, detail['so_detail_id']))
-
-        conn.commit()
-        conn.close()
+                UPDATE SalesOrders
+                SET customer_id=?, status=?, shipping_address=?, order_date=?, updated_at=CURRENT_TIMESTAMP
+                WHERE so_id=?
+            """, (customer_id, status, shipping_address, order_date, so_id))
+            changed = order_lines.apply_line_changes(conn, order_lines.SALES, order_details, updates, deletes)
+            order_lines.insert_lines(conn, order_lines.SALES, so_id, new_lines)
+
+        if request.is_json:
+            return jsonify({'so_id': so_id, 'updated': changed, 'deleted': len(deletes), 'added': len(new_lines)})
         flash("Sales order updated!", "success")
         return redirect(url_for('performance'))
 
-    customers = conn.execute("SELECT * FROM Customers").fetchall()
-    items = conn.execute("SELECT * FROM Items").fetchall()
-    conn.close()
-    return render_template('edit_sales_order.html', order=order, order_details=order_details, customers=customers, items=items)
+    customers = cache.get_reference('customers')
+    warehouses = cache.get_reference('warehouses')
+    reservations = allocation.reservations(conn, so_id)
+    return render_template('edit_sales_order.html', order=order, order_details=order_details, customers=customers,
+                           warehouses=warehouses, reservations=reservations)
 
 @app.route('/sales_orders/delete/<int:so_id>')
 def delete_sales_order(so_id):
@@ -392,15 +604,56 @@ def delete_sales_order(so_id):
     conn.execute("DELETE FROM SalesOrderDetails WHERE so_id = ?", (so_id,))
     conn.execute("DELETE FROM SalesOrders WHERE so_id = ?", (so_id,))
     conn.commit()
-    conn.close()
     flash("Sales order deleted successfully!", "success")
     return redirect(url_for('performance'))
 
+@app.route('/sales_orders/ship/<int:so_id>', methods=['POST'])
+def ship_sales_order(so_id):
+    data = request.get_json() if request.is_json else request.form
+    try:
+        # Empty or missing: ship as allocated
+        warehouse_id = int(data['warehouse_id']) if data.get('warehouse_id') not in (None, '') else None
+    except (TypeError, ValueError):
+        return order_form_error("Please choose a warehouse to ship from.", "edit_sales_order", so_id=so_id)
+
+    try:
+        shipped = ledger.ship_sales_order(get_db_connection(), so_id, warehouse_id, session.get('user_id'))
+    except ledger.InsufficientStock as exc:
+        if request.is_json:
+            return jsonify({'error': str(exc)}), 409
+        return order_form_error(str(exc), "edit_sales_order", so_id=so_id)
+    except ledger.PostingError as exc:
+        return order_form_error(str(exc), "edit_sales_order", so_id=so_id)
+
+    if request.is_json:
+        return jsonify({'so_id': so_id, 'shipped_lines': shipped})
+    flash("Sales order shipped!", "success")
+    return redirect(url_for('performance'))
+
+@app.route('/sales_orders/allocate', methods=['POST'])
+def allocate_sales_orders():
+    data = request.get_json() if request.is_json else request.form
+    options = allocation.settings()
+    if data.get('strategy'):
+        options['strategy'] = data['strategy']
+    try:
+        summary = allocation.allocate(get_db_connection(), options)
+    except allocation.AllocationError as exc:
+        if request.is_json:
+            return jsonify({'error': str(exc)}), 400
+        flash(str(exc), "danger")
+        return redirect(url_for('sales_orders'))
+
+    if request.is_json:
+        return jsonify(summary)
+    flash(f"Allocated {summary['allocated']} of {summary['orders']} pending orders "
+          f"({len(summary['short'])} short of stock).", "success")
+    return redirect(url_for('sales_orders'))
+
 @app.route('/settings')
 def settings():
     conn = get_db_connection()
     users = conn.execute('SELECT user_id, username, role, email FROM Users').fetchall()
-    conn.close()
     return render_template('settings.html', users=users)
 
 
@@ -420,13 +673,11 @@ def add_item():
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (name, description, category_id, supplier_id, unit_price, reorder_level))
         conn.commit()
-        conn.close()
         flash('Item added successfully!', 'success')
         return redirect(url_for('inventory'))
 
-    categories = conn.execute('SELECT * FROM Categories').fetchall()
-    suppliers = conn.execute('SELECT * FROM Suppliers').fetchall()
-    conn.close()
+    categories = cache.get_reference('categories')
+    suppliers = cache.get_reference('suppliers')
     return render_template('add_inventory.html', categories=categories, suppliers=suppliers)
 
 @app.route('/inventory/edit/<int:item_id>', methods=['GET', 'POST'])
@@ -448,24 +699,43 @@ def edit_item(item_id):
             WHERE item_id=?
         ''', (name, description, category_id, supplier_id, unit_price, reorder_level, item_id))
         conn.commit()
-        conn.close()
         flash('Item updated successfully!', 'success')
         return redirect(url_for('inventory'))
 
-    categories = conn.execute('SELECT * FROM Categories').fetchall()
-    suppliers = conn.execute('SELECT * FROM Suppliers').fetchall()
-    conn.close()
-    return render_template('edit_inventory.html', item=item, categories=categories, suppliers=suppliers)
+    categories = cache.get_reference('categories')
+    suppliers = cache.get_reference('suppliers')
+    warehouses = cache.get_reference('warehouses')
+    return render_template('edit_inventory.html', item=item, categories=categories, suppliers=suppliers, warehouses=warehouses)
 
 @app.route('/inventory/delete/<int:item_id>')
 def delete_item(item_id):
     conn = get_db_connection()
     conn.execute('DELETE FROM Items WHERE item_id = ?', (item_id,))
     conn.commit()
-    conn.close()
     flash('Item deleted successfully!', 'success')
     return redirect(url_for('inventory'))
 
+@app.route('/inventory/adjust/<int:item_id>', methods=['POST'])
+def adjust_stock(item_id):
+    data = request.get_json() if request.is_json else request.form
+    try:
+        warehouse_id = int(data['warehouse_id'])
+        quantity = int(data['quantity'])
+    except (KeyError, TypeError, ValueError):
+        return order_form_error("Please enter a warehouse and a whole-number adjustment.", "edit_item", item_id=item_id)
+
+    try:
+        ledger.adjust(get_db_connection(), item_id, warehouse_id, quantity, session.get('user_id'))
+    except ledger.InsufficientStock as exc:
+        if request.is_json:
+            return jsonify({'error': str(exc)}), 409
+        return order_form_error(str(exc), "edit_item", item_id=item_id)
+
+    if request.is_json:
+        return jsonify({'item_id': item_id, 'warehouse_id': warehouse_id, 'adjusted_by': quantity})
+    flash('Stock adjusted!', 'success')
+    return redirect(url_for('inventory'))
+
 @app.route('/suppliers/add', methods=['GET', 'POST'])
 def add_supplier():
     conn = get_db_connection()
@@ -482,12 +752,11 @@ def add_supplier():
         ''', (supplier_name, contact_person, phone, email))
 
         conn.commit()
-        conn.close()
+        cache.invalidate('suppliers')
 
         flash('New supplier added successfully!', 'success')
         return redirect(url_for('suppliers'))
 
-    conn.close()
     return render_template('add_supplier.html')
 
 @app.route('/suppliers/edit/<int:supplier_id>', methods=['GET', 'POST'])
@@ -496,7 +765,6 @@ def edit_supplier(supplier_id):
     supplier = conn.execute('SELECT * FROM Suppliers WHERE supplier_id = ?', (supplier_id,)).fetchone()
 
     if not supplier:
-        conn.close()
         flash('Supplier not found.', 'danger')
         return redirect(url_for('suppliers'))
 
@@ -513,11 +781,10 @@ def edit_supplier(supplier_id):
         ''', (supplier_name, contact_person, phone, email, supplier_id))
 
         conn.commit()
-        conn.close()
+        cache.invalidate('suppliers')
         flash('Supplier updated successfully!', 'success')
         return redirect(url_for('suppliers'))
 
-    conn.close()
     return render_template('edit_supplier.html', supplier=supplier)
 
 @app.route('/suppliers/delete/<int:supplier_id>', methods=['POST'])
@@ -525,7 +792,7 @@ def delete_supplier(supplier_id):
     conn = get_db_connection()
     conn.execute('DELETE FROM Suppliers WHERE supplier_id = ?', (supplier_id,))
     conn.commit()
-    conn.close()
+    cache.invalidate('suppliers')
     flash('Supplier deleted successfully!', 'success')
     return redirect(url_for('suppliers'))
 
@@ -533,7 +800,11 @@ def delete_supplier(supplier_id):
 def add_user():
     if request.method == 'POST':
         username = request.form['username']
-        password_hash = request.form['password']
+        try:
+            password_hash = passwords.hasher().hash(request.form['password'])
+        except passwords.HasherBusy:
+            flash('The server is busy. Please try again in a moment.', 'warning')
+            return render_template('add_user.html'), 503, {'Retry-After': '1'}
         role = request.form['role']
         email = request.form['email']
 
@@ -543,7 +814,6 @@ def add_user():
             VALUES (?, ?, ?, ?)
         ''', (username, password_hash, role, email))
         conn.commit()
-        conn.close()
 
         flash('User added successfully!', 'success')
         return redirect(url_for('settings'))
@@ -556,7 +826,6 @@ def edit_user(user_id):
     user = conn.execute('SELECT * FROM Users WHERE user_id = ?', (user_id,)).fetchone()
 
     if not user:
-        conn.close()
         flash('User not found.', 'danger')
         return redirect(url_for('settings'))
 
@@ -571,12 +840,10 @@ def edit_user(user_id):
             WHERE user_id=?
         ''', (username, role, email, user_id))
         conn.commit()
-        conn.close()
 
         flash('User updated successfully!', 'success')
         return redirect(url_for('settings'))
 
-    conn.close()
     return render_template('edit_user.html', user=user)
 
 @app.route('/users/delete/<int:user_id>', methods=['POST'])
@@ -584,10 +851,118 @@ def delete_user(user_id):
     conn = get_db_connection()
     conn.execute('DELETE FROM Users WHERE user_id = ?', (user_id,))
     conn.commit()
-    conn.close()
     flash('User deleted successfully!', 'success')
     return redirect(url_for('settings'))
 
+@app.route('/import/<kind>', methods=['POST'])
+def import_data(kind):
+    if kind not in bulk.IMPORTERS:
+        abort(404)
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify({'error': 'No file uploaded'}), 400
+    fmt = bulk.detect_format(upload.filename or '', request.args.get('format'))
+    if app.config['JOB_QUEUE']:
+        if fmt not in bulk.FORMATS:
+            return jsonify({'error': f'Unsupported import format: {fmt}'}), 400
+        job = jobs.submit(get_db_connection(), 'import',
+                          {'kind': kind, 'format': fmt, 'path': jobs.save_upload(upload)},
+                          user_id=session.get('user_id'))
+        return job_accepted(job)
+    stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    try:
+        report = bulk.IMPORTERS[kind](get_db_connection(), bulk.iter_records(stream, fmt))
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify(report.as_dict())
+
+def job_accepted(job):
+    info = jobs.job_info(job)
+    info['status_url'] = url_for('job_status', job_id=job['job_id'])
+    info['events_url'] = url_for('job_events', job_id=job['job_id'])
+    if job['status'] == 'done':
+        return jsonify(info)
+    return jsonify(info), 202, {'Location': info['status_url']}
+
+@app.route('/jobs', methods=['GET'])
+def job_queue():
+    return jsonify(jobs.queue_stats(get_db_connection()))
+
+@app.route('/jobs/<kind>', methods=['POST'])
+def submit_job(kind):
+    # Reusable reports only; imports and planning runs have their own routes with their inputs
+    if kind not in jobs.JOB_TYPES or jobs.JOB_TYPES[kind].tables is None:
+        abort(404)
+    return job_accepted(jobs.submit(get_db_connection(), kind, user_id=session.get('user_id')))
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    job = jobs.get_job(get_db_connection(), job_id)
+    if job is None:
+        abort(404)
+    return jsonify(jobs.job_info(job))
+
+@app.route('/jobs/<int:job_id>/events')
+def job_events(job_id):
+    if jobs.get_job(get_db_connection(), job_id) is None:
+        abort(404)
+    return Response(stream_with_context(jobs.iter_events(job_id, app.config['JOB_POLL_INTERVAL'])),
+                    mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/export/<kind>.csv')
+def export_data(kind):
+    if kind not in bulk.EXPORT_QUERIES:
+        abort(404)
+    return bulk.export_response(kind)
+
+@app.route('/pool_stats')
+def pool_stats():
+    return jsonify(db.pool_stats())
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(cache.cache_stats())
+
+@app.route('/stream')
+def stream():
+    # ?topics=inventory,sales_orders; the page passes ?since=<version it was rendered at>
+    topics = [topic for topic in request.args.get('topics', ','.join(changefeed.TOPICS)).split(',') if topic]
+    if not topics or any(topic not in changefeed.TOPICS for topic in topics):
+        abort(400)
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    return Response(stream_with_context(changefeed.iter_events(topics, since)),
+                    mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/stream_stats')
+def stream_stats():
+    return jsonify(changefeed.get_feed().stats())
+
+@app.route('/fragment_stats')
+def fragment_stats():
+    return jsonify(fragments.fragment_stats())
+
+@app.route('/asset_stats')
+def asset_stats():
+    return jsonify(assets.asset_stats())
+
+@app.route('/catalog_stats')
+def catalog_stats():
+    return jsonify(catalog.get_catalog().stats())
+
+@app.route('/metrics')
+def metrics():
+    return app.response_class(profiling.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/slow_queries')
+def slow_queries():
+    monitor = profiling.get_monitor()
+    return jsonify({
+        'slow_queries': list(monitor.slow_queries) if monitor else [],
+        'sampled_requests': list(monitor.samples) if monitor else [],
+    })
+
 if __name__ == '__main__':
     app.run(debug=True)
     
\ No newline at end of file
@@ -0,0 +1,436 @@
+import glob
+import os
+import re
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import click
+from flask import current_app, request
+from flask.cli import with_appcontext
+
+import ledger
+import reporting
+from db import get_db_connection
+
+# Closed orders and ledger rows older than ARCHIVE_HORIZON_DAYS move out of inventory.db into
+# one SQLite file per year (ARCHIVE_DIR/inventory-<year>.db), so the hot database only holds
+# recent and open data and stays small enough to live in the page cache.
+#
+# Rows move in two steps, because a commit spanning attached WAL databases is not atomic:
+#   1. copy the batch into the year's archive (a transaction on the archive only)
+#   2. in one transaction on inventory.db, fold the rows into the rollups and delete them,
+#      skipping any whose archived copy no longer matches (edited in between)
+# A run interrupted anywhere leaves each row in inventory.db, in the archive, or in both;
+# the next run drops archived copies of rows still in inventory.db before doing anything.
+#
+# Views read recent data by default. With archives included they ATTACH the year files and
+# read each table as main UNION ALL archive_<year> (see attached() and union()).
+
+DEFAULTS = {
+    'ARCHIVE_DIR': None,
+    'ARCHIVE_HORIZON_DAYS': 2 * 365,
+    'ARCHIVE_BATCH_SIZE': 2000,
+    'ARCHIVE_SALES_STATUSES': ('Shipped', 'Delivered', 'Cancelled'),
+    'ARCHIVE_PURCHASE_STATUSES': ('Received', 'Cancelled'),
+}
+# SQLite attaches at most 10 databases by default
+MAX_ATTACHED = 10
+
+MIGRATION = '''
+    CREATE TABLE IF NOT EXISTS ArchiveState (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        transactions_through INTEGER NOT NULL DEFAULT 0,
+        archived_before TEXT,
+        archived_at REAL
+    );
+    INSERT OR IGNORE INTO ArchiveState (id, transactions_through) VALUES (1, 0);
+
+    -- Archived sales that weren't cancelled, per day and item: planning's demand history
+    CREATE TABLE IF NOT EXISTS SalesHistoryRollup (
+        sale_date TEXT NOT NULL,
+        item_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (sale_date, item_id)
+    ) WITHOUT ROWID;
+
+    -- Archived purchase orders' promised lead times, per day and supplier: planning's lead times
+    CREATE TABLE IF NOT EXISTS SupplierLeadTimeRollup (
+        order_date TEXT NOT NULL,
+        supplier_id INTEGER NOT NULL,
+        orders INTEGER NOT NULL,
+        total_days REAL NOT NULL,
+        PRIMARY KEY (order_date, supplier_id)
+    ) WITHOUT ROWID;
+
+    -- Everything archived, per month: what the archives hold without attaching them
+    CREATE TABLE IF NOT EXISTS ArchiveMonthlyRollup (
+        month TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        records INTEGER NOT NULL,
+        lines INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (month, kind)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS idx_purchase_orders_order_date ON PurchaseOrders (order_date);
+'''
+
+# kind: (header table h, key, date column, line table l or None, statuses config key or None,
+#        summary table copied along, (quantity, value) expressions for the rollup)
+KINDS = {
+    'sales': ('SalesOrders', 'so_id', 'order_date', 'SalesOrderDetails', 'ARCHIVE_SALES_STATUSES',
+              'SalesOrderSummary', ('l.quantity_sold', 'l.quantity_sold * l.unit_price')),
+    'purchases': ('PurchaseOrders', 'po_id', 'order_date', 'PurchaseOrderDetails', 'ARCHIVE_PURCHASE_STATUSES',
+                  None, ('l.quantity_ordered', 'l.quantity_ordered * l.unit_cost')),
+    'transactions': ('Transactions', 'transaction_id', 'transaction_date', None, None,
+                     None, ('h.quantity', '0')),
+}
+# The batch being moved; a temp table rather than bound parameters, which older SQLite
+# builds limit to 999 per statement
+BATCH = '(SELECT key FROM temp.archive_batch)'
+ARCHIVE_INDEXES = '''
+    CREATE INDEX IF NOT EXISTS {schema}.idx_sales_orders_order_date ON SalesOrders (order_date);
+    CREATE INDEX IF NOT EXISTS {schema}.idx_sales_order_details_so ON SalesOrderDetails (so_id);
+    CREATE INDEX IF NOT EXISTS {schema}.idx_purchase_orders_order_date ON PurchaseOrders (order_date);
+    CREATE INDEX IF NOT EXISTS {schema}.idx_purchase_order_details_po ON PurchaseOrderDetails (po_id);
+    CREATE INDEX IF NOT EXISTS {schema}.idx_transactions_item_date ON Transactions (item_id, transaction_date);
+'''
+
+_YEAR_FILE = re.compile(r'inventory-(\d{4})\.db$')
+
+
+class ArchiveError(RuntimeError):
+    pass
+
+
+def archive_dir(config=None):
+    config = config if config is not None else current_app.config
+    return config['ARCHIVE_DIR'] or os.path.join(os.path.dirname(os.path.abspath(config['DATABASE'])), 'archive')
+
+
+def year_files(directory):
+    # {year: path} for every archive file present
+    files = {}
+    for path in glob.glob(os.path.join(directory, 'inventory-*.db')):
+        match = _YEAR_FILE.search(path)
+        if match:
+            files[int(match.group(1))] = path
+    return dict(sorted(files.items()))
+
+
+def requested():
+    # List and report views include archived rows when asked with ?archive=1
+    return request.args.get('archive') == '1'
+
+
+def _attach(conn, path, schema):
+    conn.execute('ATTACH DATABASE ? AS ' + schema, (path,))
+
+
+def _detach(conn, schema):
+    conn.execute('DETACH DATABASE ' + schema)
+
+
+@contextmanager
+def attached(conn, directory=None, enabled=True):
+    # Attaches every year's archive for the duration of the block and yields their schema
+    # names (none when disabled or nothing is archived yet). Not inside a transaction.
+    if not enabled:
+        yield []
+        return
+    files = year_files(directory or archive_dir())
+    if len(files) > MAX_ATTACHED:
+        raise ArchiveError(f'{len(files)} archive files; at most {MAX_ATTACHED} can be read at once')
+    schemas = []
+    try:
+        for year, path in files.items():
+            _attach(conn, path, f'archive_{year}')
+            schemas.append(f'archive_{year}')
+        yield schemas
+    finally:
+        for schema in schemas:
+            _detach(conn, schema)
+
+
+def _columns(conn, schema, table):
+    return [row[1] for row in conn.execute(f'PRAGMA {schema}.table_info({table})')]
+
+
+def union(conn, table, schemas):
+    # The table as it reads with archives included: main's rows plus each archive's. Columns
+    # added to main after a year was archived read as NULL there.
+    if not schemas:
+        return table
+    columns = _columns(conn, 'main', table)
+    parts = [f"SELECT {', '.join(columns)} FROM main.{table}"]
+    for schema in schemas:
+        present = set(_columns(conn, schema, table))
+        select_list = ', '.join(column if column in present else f'NULL AS {column}' for column in columns)
+        parts.append(f'SELECT {select_list} FROM {schema}.{table}')
+    return '(' + ' UNION ALL '.join(parts) + ')'
+
+
+def _ensure_schema(conn, schema):
+    # Archive tables mirror main's definitions; columns main gained since are added
+    for kind in KINDS.values():
+        for table in (kind[0], kind[3], kind[5]):
+            if table is None:
+                continue
+            existing = _columns(conn, schema, table)
+            if not existing:
+                sql = conn.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?",
+                                   (table,)).fetchone()[0]
+                conn.execute(re.sub(r'^CREATE TABLE\s+(IF NOT EXISTS\s+)?"?\w+"?', f'CREATE TABLE {schema}.{table}', sql))
+                continue
+            for row in conn.execute(f'PRAGMA main.table_info({table})').fetchall():
+                if row[1] not in existing:
+                    conn.execute(f'ALTER TABLE {schema}.{table} ADD COLUMN {row[1]} {row[2]}')
+    conn.executescript(ARCHIVE_INDEXES.format(schema=schema))
+
+
+def _placeholders(values):
+    return ', '.join('?' * len(values))
+
+
+def _load_batch(conn, keys):
+    conn.execute('DELETE FROM temp.archive_batch')
+    conn.executemany('INSERT INTO temp.archive_batch (key) VALUES (?)', ((key,) for key in keys))
+
+
+def _reconcile(conn, schema):
+    # Drops archived copies of rows that are (still or again) in inventory.db
+    with conn:
+        for header, key, _, lines, _, summary, _ in KINDS.values():
+            for table in (header, lines, summary):
+                if table is not None:
+                    conn.execute(f'DELETE FROM {schema}.{table} WHERE {key} IN (SELECT {key} FROM main.{header})')
+
+
+def _eligible(conn, kind, config, cutoff, through=None):
+    # {year: [keys]} of rows old enough (and closed) to archive
+    header, key, date_column, _, statuses, _, _ = KINDS[kind]
+    sql = f'SELECT {key}, substr({date_column}, 1, 4) FROM {header} WHERE {date_column} < ?'
+    params = [cutoff]
+    if statuses is not None:
+        sql += f' AND status IN ({_placeholders(config[statuses])})'
+        params += list(config[statuses])
+    if through is not None:
+        sql += f' AND {key} <= ?'
+        params.append(through)
+    years = {}
+    for row in conn.execute(sql, params):
+        if row[1] and row[1].isdigit():
+            years.setdefault(int(row[1]), []).append(row[0])
+    return years
+
+
+def _copy(conn, schema, kind):
+    header, key, _, lines, _, summary, _ = KINDS[kind]
+    with conn:
+        for table in (header, lines, summary):
+            if table is not None:
+                conn.execute(f'INSERT OR REPLACE INTO {schema}.{table} SELECT * FROM main.{table} '
+                             f'WHERE {key} IN {BATCH}')
+
+
+def _changed(conn, schema, kind):
+    # Keys in the batch whose rows in inventory.db no longer match their archived copy
+    header, key, _, lines, _, _, _ = KINDS[kind]
+    changed = set()
+    for table in (header, lines):
+        if table is None:
+            continue
+        for first, second in (('main', schema), (schema, 'main')):
+            changed.update(row[0] for row in conn.execute(f'''
+                SELECT {key} FROM (
+                    SELECT * FROM {first}.{table} WHERE {key} IN {BATCH}
+                    EXCEPT
+                    SELECT * FROM {second}.{table} WHERE {key} IN {BATCH}
+                )'''))
+    return changed
+
+
+def _roll_up(conn, kind):
+    header, key, date_column, lines, _, _, (quantity, value) = KINDS[kind]
+    if lines is None:
+        source = f'FROM main.{header} h WHERE h.{key} IN {BATCH}'
+        counts = f'COUNT(*), COUNT(*), IFNULL(SUM({quantity}), 0), {value}'
+    else:
+        source = f'FROM main.{header} h LEFT JOIN main.{lines} l ON l.{key} = h.{key} WHERE h.{key} IN {BATCH}'
+        counts = (f'COUNT(DISTINCT h.{key}), COUNT(l.{key}), IFNULL(SUM({quantity}), 0), '
+                  f'IFNULL(SUM({value}), 0)')
+    conn.execute(f'''
+        INSERT INTO ArchiveMonthlyRollup (month, kind, records, lines, quantity, value)
+        SELECT substr(h.{date_column}, 1, 7), ?, {counts} {source}
+        GROUP BY substr(h.{date_column}, 1, 7)
+        ON CONFLICT (month, kind) DO UPDATE SET
+            records = records + excluded.records, lines = lines + excluded.lines,
+            quantity = quantity + excluded.quantity, value = value + excluded.value
+    ''', (kind,))
+    if kind == 'sales':
+        conn.execute(f'''
+            INSERT INTO SalesHistoryRollup (sale_date, item_id, quantity, value)
+            SELECT h.order_date, l.item_id, SUM(l.quantity_sold), SUM(l.quantity_sold * l.unit_price)
+            FROM main.SalesOrders h JOIN main.SalesOrderDetails l ON l.so_id = h.so_id
+            WHERE h.so_id IN {BATCH} AND h.status != 'Cancelled'
+              AND l.item_id IS NOT NULL AND l.quantity_sold > 0
+            GROUP BY h.order_date, l.item_id
+            ON CONFLICT (sale_date, item_id) DO UPDATE SET
+                quantity = quantity + excluded.quantity, value = value + excluded.value
+        ''')
+    elif kind == 'purchases':
+        conn.execute(f'''
+            INSERT INTO SupplierLeadTimeRollup (order_date, supplier_id, orders, total_days)
+            SELECT order_date, supplier_id, COUNT(*), SUM(julianday(expected_delivery_date) - julianday(order_date))
+            FROM main.PurchaseOrders
+            WHERE po_id IN {BATCH} AND expected_delivery_date IS NOT NULL AND supplier_id IS NOT NULL
+            GROUP BY order_date, supplier_id
+            ON CONFLICT (order_date, supplier_id) DO UPDATE SET
+                orders = orders + excluded.orders, total_days = total_days + excluded.total_days
+        ''')
+
+
+def _remove(conn, schema, kind, keys):
+    # Step 2 for one batch: roll up and delete what was archived intact; returns rows moved
+    header, key, _, lines, _, summary, _ = KINDS[kind]
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        changed = sorted(_changed(conn, schema, kind))
+        conn.executemany('DELETE FROM temp.archive_batch WHERE key = ?', ((key_value,) for key_value in changed))
+        _roll_up(conn, kind)
+        for table in (lines, header):
+            if table is not None:
+                conn.execute(f'DELETE FROM main.{table} WHERE {key} IN {BATCH}')
+        if kind == 'transactions':
+            conn.execute(f'UPDATE ArchiveState SET transactions_through = MAX(transactions_through, '
+                         f'(SELECT IFNULL(MAX(key), 0) FROM temp.archive_batch)) WHERE id = 1')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if changed:
+        # Edited after the copy: forget the copy, a later run archives the current version
+        _load_batch(conn, changed)
+        with conn:
+            for table in (header, lines, summary):
+                if table is not None:
+                    conn.execute(f'DELETE FROM {schema}.{table} WHERE {key} IN {BATCH}')
+    return len(keys) - len(changed)
+
+
+def run(conn, config, today=None, dry_run=False, progress=None):
+    # Archives everything past the horizon; returns {kind: {year: rows}}
+    progress = progress or (lambda *args: None)
+    today = today or date.today()
+    cutoff = (today - timedelta(days=config['ARCHIVE_HORIZON_DAYS'])).isoformat()
+    directory = archive_dir(config)
+    batch_size = config['ARCHIVE_BATCH_SIZE']
+
+    # Summaries go along with their orders, so they have to be current first
+    reporting.refresh(conn)
+    # Ledger rows only leave once a snapshot covers them, so replays from then on don't
+    # need the archive
+    newest = conn.execute('SELECT IFNULL(MAX(transaction_id), 0) FROM Transactions WHERE transaction_date < ?',
+                          (cutoff,)).fetchone()[0]
+    covered = conn.execute('SELECT IFNULL(MAX(last_transaction_id), 0) FROM StockSnapshots').fetchone()[0]
+    if newest > covered and not dry_run:
+        ledger.take_snapshot(conn)
+
+    plan = {kind: _eligible(conn, kind, config, cutoff, newest if kind == 'transactions' else None)
+            for kind in KINDS}
+    if dry_run:
+        return {kind: {year: len(keys) for year, keys in years.items()} for kind, years in plan.items()}
+
+    os.makedirs(directory, exist_ok=True)
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS archive_batch (key INTEGER PRIMARY KEY)')
+    moved = {kind: {} for kind in KINDS}
+    for year in sorted({year for years in plan.values() for year in years}):
+        schema = f'archive_{year}'
+        _attach(conn, os.path.join(directory, f'inventory-{year}.db'), schema)
+        try:
+            _ensure_schema(conn, schema)
+            _reconcile(conn, schema)
+            for kind, years in plan.items():
+                keys = years.get(year, [])
+                for start in range(0, len(keys), batch_size):
+                    batch = keys[start:start + batch_size]
+                    _load_batch(conn, batch)
+                    _copy(conn, schema, kind)
+                    moved[kind][year] = moved[kind].get(year, 0) + _remove(conn, schema, kind, batch)
+                    progress(kind, year, moved[kind][year], len(keys))
+        finally:
+            _detach(conn, schema)
+    with conn:
+        conn.execute('UPDATE ArchiveState SET archived_before = ?, archived_at = ? WHERE id = 1',
+                     (cutoff, time.time()))
+    # Deleting archived orders queued summary changes; apply them now rather than on a page view
+    reporting.refresh(conn)
+    return moved
+
+
+def state(conn):
+    row = conn.execute('SELECT * FROM ArchiveState WHERE id = 1').fetchone()
+    return dict(row) if row else {}
+
+
+def monthly_rollup(conn):
+    return conn.execute('SELECT * FROM ArchiveMonthlyRollup ORDER BY month, kind').fetchall()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.cli.add_command(archive_command)
+
+
+@click.group('archive')
+def archive_command():
+    """Move old closed orders and ledger rows to per-year archive databases."""
+
+
+@archive_command.command('run')
+@click.option('--horizon-days', type=int, default=None, help='Archive rows older than this (ARCHIVE_HORIZON_DAYS).')
+@click.option('--dry-run', is_flag=True, help='Only count what would be archived.')
+@click.option('--vacuum', is_flag=True, help='VACUUM inventory.db afterwards to give the space back (locks it).')
+@with_appcontext
+def run_command(horizon_days, dry_run, vacuum):
+    config = dict(current_app.config)
+    if horizon_days is not None:
+        config['ARCHIVE_HORIZON_DAYS'] = horizon_days
+    conn = get_db_connection()
+    size_before = _size(conn)
+    moved = run(conn, config, dry_run=dry_run)
+    verb = 'would archive' if dry_run else 'archived'
+    for kind, years in moved.items():
+        for year, count in years.items():
+            click.echo(f'{kind} {year}: {verb} {count}')
+    if not any(years for years in moved.values()):
+        click.echo('Nothing to archive.')
+    if vacuum and not dry_run:
+        conn.execute('VACUUM')
+    if not dry_run:
+        click.echo(f'inventory.db: {size_before / 1e6:.1f} MB -> {_size(conn) / 1e6:.1f} MB in use')
+
+
+@archive_command.command('status')
+@with_appcontext
+def status_command():
+    conn = get_db_connection()
+    current = state(conn)
+    click.echo(f"Archived before {current.get('archived_before') or '-'}; "
+               f"ledger rows through {current.get('transactions_through', 0)}.")
+    for year, path in year_files(archive_dir()).items():
+        click.echo(f'{year}\t{path}\t{os.path.getsize(path) / 1e6:.1f} MB')
+    for row in monthly_rollup(conn):
+        click.echo(f"{row['month']}\t{row['kind']}\t{row['records']} records\t{row['lines']} lines\t"
+                   f"{row['quantity']} units\t{row['value']:.2f}")
+
+
+def _size(conn):
+    # Bytes of inventory.db in use (excluding free pages)
+    row = conn.execute('SELECT (page_count - freelist_count) * page_size '
+                       'FROM pragma_page_count, pragma_freelist_count, pragma_page_size').fetchone()
+    return row[0]
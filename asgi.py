@@ -0,0 +1,229 @@
+import asyncio
+import contextvars
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException
+
+import db
+from app import app
+
+# ASGI entry point: uvicorn asgi:application --workers 4
+#
+# The views stay synchronous; this adapter runs each request on a bounded thread pool picked
+# by endpoint. Heavy report/list endpoints get their own small lane, so however many of
+# them are in flight, inventory lookups and form posts still have free threads. When a
+# lane's queue is full the request is refused with 503 instead of waiting indefinitely.
+
+DEFAULT_HEAVY_ENDPOINTS = ('orders', 'sales_orders', 'reports', 'performance', 'export_data', 'import_data')
+# Server-sent event streams hold a thread for as long as the page is open, mostly waiting
+DEFAULT_STREAM_ENDPOINTS = ('stream', 'job_events')
+
+
+class Lane:
+    def __init__(self, name, workers, max_pending):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'asgi-{name}')
+
+    def reserve(self):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.pending -= 1
+
+    async def run(self, context, fn, *args):
+        # Calls for one request share a context: Flask's request/app context lives in
+        # contextvars, and a streamed body is pulled on whichever lane thread is free
+        return await asyncio.get_running_loop().run_in_executor(self._executor, context.run, fn, *args)
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers, 'pending': self.pending,
+                    'max_pending': self.max_pending, 'rejected': self.rejected}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def build_environ(scope, body):
+    # WSGI wants the decoded path, as bytes carried in a latin-1 str; lane_for() matches on it too
+    path = scope['path'].encode('utf-8').decode('latin-1')
+    root_path = scope.get('root_path', '').encode('utf-8').decode('latin-1')
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path,
+        'PATH_INFO': path[len(root_path):] if root_path and path.startswith(root_path) else path,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class ASGIAdapter:
+    def __init__(self, flask_app):
+        self.app = flask_app
+        config = flask_app.config
+        config.setdefault('ASYNC_WORKERS', 8)
+        config.setdefault('ASYNC_HEAVY_WORKERS', 2)
+        config.setdefault('ASYNC_MAX_PENDING', 256)
+        config.setdefault('ASYNC_HEAVY_ENDPOINTS', DEFAULT_HEAVY_ENDPOINTS)
+        config.setdefault('ASYNC_STREAM_WORKERS', 64)
+        config.setdefault('ASYNC_STREAM_ENDPOINTS', DEFAULT_STREAM_ENDPOINTS)
+        self.heavy_endpoints = frozenset(config['ASYNC_HEAVY_ENDPOINTS'])
+        self.stream_endpoints = frozenset(config['ASYNC_STREAM_ENDPOINTS'])
+        self.lanes = {
+            'default': Lane('default', config['ASYNC_WORKERS'], config['ASYNC_MAX_PENDING']),
+            'heavy': Lane('heavy', config['ASYNC_HEAVY_WORKERS'], config['ASYNC_MAX_PENDING']),
+            'stream': Lane('stream', config['ASYNC_STREAM_WORKERS'], config['ASYNC_STREAM_WORKERS']),
+        }
+        # Every lane thread may hold a pooled connection at once; streams only borrow one briefly
+        total = sum(lane.workers for name, lane in self.lanes.items() if name != 'stream')
+        config['DB_POOL_SIZE'] = max(config['DB_POOL_SIZE'], total)
+        pool = db.get_pool(flask_app)
+        pool.max_size = max(pool.max_size, total)
+        flask_app.extensions['asgi_lanes'] = self.lanes
+        self._adapter = flask_app.url_map.bind('localhost')
+
+    def lane_for(self, scope):
+        try:
+            endpoint, _ = self._adapter.match(scope['path'], method=scope['method'])
+        except HTTPException:
+            return self.lanes['default']
+        if endpoint in self.stream_endpoints:
+            return self.lanes['stream']
+        return self.lanes['heavy' if endpoint in self.heavy_endpoints else 'default']
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise RuntimeError(f"Unsupported ASGI scope type {scope['type']!r}")
+
+        lane = self.lane_for(scope)
+        if not lane.reserve():
+            await self._send_simple(send, 503, b'Server busy, try again shortly.', [(b'retry-after', b'1')])
+            return
+        try:
+            body = await self._read_body(receive)
+            await self._respond(lane, build_environ(scope, body), receive, send)
+        finally:
+            lane.release()
+
+    async def _read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    async def _respond(self, lane, environ, receive, send):
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                  for name, value in headers]
+
+        def call():
+            result = self.app(environ, start_response)
+            iterator = iter(result)
+            # Pull the first chunk here so start_response has run for generators too
+            chunk = next(iterator, None)
+            if any(name == b'content-length' for name, _ in started['headers']):
+                # Not streamed: finish in this hop, each extra hop costs a GIL handoff
+                body = b''.join([chunk or b''] + list(iterator))
+                if hasattr(result, 'close'):
+                    result.close()
+                return None, None, body
+            return result, iterator, chunk
+
+        context = contextvars.Context()
+        result, iterator, chunk = await lane.run(context, call)
+        if result is None:
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': False})
+            return
+        # Streams (event feeds) only end when the client leaves, and servers may silently drop
+        # sends after that, so watch for the disconnect and stop pulling from the generator
+        disconnected = asyncio.Event()
+
+        async def watch():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            # Streamed bodies (CSV exports) are read chunk by chunk on the same lane. A chunk
+            # already being produced is waited for: a running generator can't be closed.
+            while not disconnected.is_set():
+                following = None if chunk is None else await lane.run(context, next, iterator, None)
+                if disconnected.is_set():
+                    break
+                await send({'type': 'http.response.body', 'body': chunk or b'', 'more_body': following is not None})
+                if following is None:
+                    break
+                chunk = following
+        finally:
+            watcher.cancel()
+            if hasattr(result, 'close'):
+                await lane.run(context, result.close)
+
+    async def _send_simple(self, send, status, body, headers=()):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                                (b'content-length', str(len(body)).encode())] + list(headers)})
+        await send({'type': 'http.response.body', 'body': body, 'more_body': False})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for lane in self.lanes.values():
+                    lane.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = ASGIAdapter(app)
@@ -0,0 +1,172 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+from collections import namedtuple
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    # Optional (pip install brotli); without it responses are gzip-compressed only
+    brotli = None
+
+# Bytes on the wire, for the warehouse's slow Wi-Fi.
+#
+# Static files are served under content-hashed names (style.css -> style.<hash>.css) with a
+# far-future, immutable Cache-Control, so a browser fetches each version once. The names are
+# filled in by url_for('static', ...), and url() references inside CSS are rewritten to
+# them. The files are read, hashed and compressed (gzip, and brotli when installed) once at
+# startup; a request gets the smallest variant it accepts. Plain names still work, with the
+# usual short-lived caching.
+#
+# HTML responses above COMPRESS_MIN_SIZE are compressed on the way out. Streamed responses
+# (CSV exports, job events) are left alone.
+
+DEFAULTS = {
+    'ASSETS_FINGERPRINT': True,
+    'ASSETS_MAX_AGE': 365 * 24 * 3600,
+    'COMPRESS_RESPONSES': True,
+    'COMPRESS_MIN_SIZE': 1024,
+    'COMPRESS_LEVEL': 6,
+    # JSON is left out: API responses carry strong ETags, which must differ per encoding
+    'COMPRESS_MIMETYPES': ('text/html', 'text/css', 'text/plain', 'application/javascript'),
+}
+# Formats that are worth compressing at all; images and fonts already are
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+HASH_CHARS = 12
+# Precompressed static files get the slow, best settings
+STATIC_GZIP_LEVEL = 9
+STATIC_BROTLI_QUALITY = 11
+RESPONSE_BROTLI_QUALITY = 5
+
+_CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+# bodies: {content coding: bytes}, always with 'identity'
+Asset = namedtuple('Asset', 'source name mimetype bodies')
+
+
+def encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _compressible(mimetype):
+    return mimetype.startswith(COMPRESSIBLE)
+
+
+def _fingerprinted(source, data):
+    stem, ext = posixpath.splitext(source)
+    return f'{stem}.{hashlib.sha256(data).hexdigest()[:HASH_CHARS]}{ext}'
+
+
+def _rewrite_css(source, data, names):
+    # Points url() references at the other assets' hashed names, before this file is hashed
+    def replace(match):
+        quote, ref = match.groups()
+        if ref.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+            return match.group(0)
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(source), ref))
+        if target not in names:
+            return match.group(0)
+        return f'url({quote}{posixpath.relpath(names[target], posixpath.dirname(source) or ".")}{quote})'
+    return _CSS_URL.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+
+def build(folder):
+    # {source name: Asset} for every file under folder
+    sources = {}
+    for root, _, files in os.walk(folder):
+        for filename in files:
+            path = os.path.join(root, filename)
+            sources[os.path.relpath(path, folder).replace(os.sep, '/')] = path
+    assets = {}
+    names = {}
+    # Stylesheets last, so the files they reference already have their hashed names
+    for source in sorted(sources, key=lambda source: (source.endswith('.css'), source)):
+        with open(sources[source], 'rb') as f:
+            data = f.read()
+        if source.endswith('.css'):
+            data = _rewrite_css(source, data, names)
+        mimetype = mimetypes.guess_type(source)[0] or 'application/octet-stream'
+        bodies = {'identity': data}
+        if _compressible(mimetype):
+            for encoding in encodings():
+                level = STATIC_BROTLI_QUALITY if encoding == 'br' else STATIC_GZIP_LEVEL
+                compressed = compress(data, encoding, level)
+                if len(compressed) < len(data):
+                    bodies[encoding] = compressed
+        names[source] = _fingerprinted(source, data)
+        assets[source] = Asset(source, names[source], mimetype, bodies)
+    return assets
+
+
+class Manifest:
+    def __init__(self, assets):
+        self.by_source = assets
+        self.by_name = {asset.name: asset for asset in assets.values()}
+
+    def url_defaults(self, endpoint, values):
+        if endpoint == 'static' and values.get('filename') in self.by_source:
+            values['filename'] = self.by_source[values['filename']].name
+
+    def serve(self, filename):
+        asset = self.by_name.get(filename)
+        if asset is None:
+            return current_app.send_static_file(filename)
+        encoding = request.accept_encodings.best_match(
+            [encoding for encoding in ('br', 'gzip') if encoding in asset.bodies]) or 'identity'
+        response = current_app.response_class(asset.bodies[encoding], mimetype=asset.mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        if len(asset.bodies) > 1:
+            response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['ASSETS_MAX_AGE']
+        response.cache_control.immutable = True
+        return response
+
+    def stats(self):
+        return {asset.source: {'name': asset.name, 'bytes': {encoding: len(body) for encoding, body in
+                                                             asset.bodies.items()}}
+                for asset in self.by_source.values()}
+
+
+def compress_response(response):
+    config = current_app.config
+    if (response.direct_passthrough or response.is_streamed or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers or response.mimetype not in config['COMPRESS_MIMETYPES']):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(encodings())
+    if encoding is None or response.content_length is None or response.content_length < config['COMPRESS_MIN_SIZE']:
+        return response
+    level = RESPONSE_BROTLI_QUALITY if encoding == 'br' else config['COMPRESS_LEVEL']
+    response.set_data(compress(response.get_data(), encoding, level))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def asset_stats():
+    manifest = current_app.extensions.get('assets')
+    return manifest.stats() if manifest else {}
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    if app.config['ASSETS_FINGERPRINT'] and app.has_static_folder:
+        manifest = Manifest(build(app.static_folder))
+        app.extensions['assets'] = manifest
+        app.url_defaults(manifest.url_defaults)
+        app.view_functions['static'] = manifest.serve
+    if app.config['COMPRESS_RESPONSES']:
+        app.after_request(compress_response)
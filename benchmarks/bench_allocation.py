@@ -0,0 +1,128 @@
+"""Measure warehouse allocation throughput for waves of pending sales orders.
+
+Builds a database with warehouses and customers spread over a region, items stocked in a
+few warehouses each, and a backlog of Pending orders of a few lines. Each strategy then
+allocates the whole backlog wave by wave on its own copy of the database. Reported are
+orders and lines allocated per second, how many lines had to be split across warehouses,
+and how many orders were left short. Afterwards no item may have more reserved than stocked.
+
+    python benchmarks/bench_allocation.py --warehouses 20 --items 5000 --orders 5000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import allocation  # noqa: E402
+import db  # noqa: E402
+import migrations  # noqa: E402
+
+# Roughly the extent of a country: positions are drawn inside this box
+LATITUDES = (43.0, 55.0)
+LONGITUDES = (-5.0, 15.0)
+
+
+def _position(rng):
+    return rng.uniform(*LATITUDES), rng.uniform(*LONGITUDES)
+
+
+def create_database(path, warehouses, items, customers, orders, lines, stocked_in, seed):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    with open(os.path.join(ROOT, 'inventory.sql')) as schema:
+        conn.executescript(schema.read())
+    conn.commit()
+    conn.close()
+    conn = db.connect(path)
+    migrations.run_migrations(conn)
+    conn.execute('DELETE FROM Stock')
+    conn.execute('DELETE FROM SalesOrderDetails')
+    conn.execute('DELETE FROM SalesOrders')
+    conn.execute('DELETE FROM Warehouses')
+    conn.executemany('INSERT INTO Warehouses (warehouse_name, latitude, longitude) VALUES (?, ?, ?)',
+                     [(f'warehouse {n}',) + _position(rng) for n in range(warehouses)])
+    conn.executemany('INSERT INTO Customers (customer_name, latitude, longitude) VALUES (?, ?, ?)',
+                     [(f'customer {n}',) + _position(rng) for n in range(customers)])
+    conn.executemany(
+        'INSERT INTO Items (item_name, category_id, supplier_id, unit_price, reorder_level) VALUES (?, 1, 1, 1.0, 0)',
+        [(f'bench item {n}',) for n in range(items)])
+    warehouse_ids = [row[0] for row in conn.execute('SELECT warehouse_id FROM Warehouses')]
+    customer_ids = [row[0] for row in conn.execute("SELECT customer_id FROM Customers WHERE customer_name LIKE 'customer %'")]
+    item_ids = [row[0] for row in conn.execute("SELECT item_id FROM Items WHERE item_name LIKE 'bench item %'")]
+    # About twice the expected demand (lines of 3 units on average), so most orders can be filled
+    per_item = max(1, round(2 * orders * lines * 3 / (len(item_ids) * stocked_in)))
+    conn.executemany(
+        "INSERT INTO Stock (item_id, warehouse_id, quantity, last_updated) VALUES (?, ?, ?, datetime('now', ?))",
+        [(item_id, warehouse_id, rng.randint(0, 2 * per_item), f'-{rng.randint(0, 365)} days')
+         for item_id in item_ids for warehouse_id in rng.sample(warehouse_ids, stocked_in)])
+    for n in range(orders):
+        so_id = conn.execute(
+            "INSERT INTO SalesOrders (customer_id, order_date, status) VALUES (?, date('now', ?), 'Pending')",
+            (rng.choice(customer_ids), f'-{orders - n} minutes')).lastrowid
+        conn.executemany(
+            'INSERT INTO SalesOrderDetails (so_id, item_id, quantity_sold, unit_price) VALUES (?, ?, ?, 1.0)',
+            [(so_id, item_id, rng.randint(1, 5)) for item_id in rng.sample(item_ids, rng.randint(1, 2 * lines - 1))])
+    conn.commit()
+    conn.close()
+
+
+def copy_database(source, target):
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    src.backup(dst)
+    src.close()
+    dst.close()
+
+
+def run(path, strategy, wave_size):
+    conn = db.connect(path)
+    options = dict(allocation.settings(allocation.DEFAULTS), strategy=strategy, wave_size=wave_size)
+    summary = allocation.allocate_all(conn, options)
+    oversold = conn.execute('''
+        SELECT COUNT(*) FROM (
+            SELECT r.item_id, r.warehouse_id, SUM(r.quantity) AS reserved FROM StockReservations r
+            GROUP BY r.item_id, r.warehouse_id) r
+        LEFT JOIN ItemWarehouseStockTotals t ON t.item_id = r.item_id AND t.warehouse_id = r.warehouse_id
+        WHERE r.reserved > IFNULL(t.total_qty, 0)
+    ''').fetchone()[0]
+    conn.close()
+    return summary, oversold
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--warehouses', type=int, default=20)
+    parser.add_argument('--items', type=int, default=5000)
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=5000, help='Pending orders in the backlog')
+    parser.add_argument('--lines', type=int, default=5, help='average lines per order')
+    parser.add_argument('--stocked-in', type=int, default=5, help='warehouses holding each item')
+    parser.add_argument('--wave-size', type=int, nargs='+', default=[500])
+    parser.add_argument('--strategy', nargs='+', choices=allocation.STRATEGIES, default=list(allocation.STRATEGIES))
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'bench_allocation.db')
+    create_database(source, args.warehouses, args.items, args.customers, args.orders, args.lines,
+                    min(args.stocked_in, args.warehouses), args.seed)
+
+    print(f"{'strategy':>12} {'wave':>5} {'orders/s':>9} {'lines/s':>9} {'allocated':>9} {'short':>6} "
+          f"{'split':>6} {'oversold':>8}")
+    for strategy in args.strategy:
+        for wave_size in args.wave_size:
+            path = os.path.join(directory, f'{strategy}-{wave_size}.db')
+            copy_database(source, path)
+            summary, oversold = run(path, strategy, wave_size)
+            seconds = summary['seconds'] or 1e-9
+            print(f"{strategy:>12} {wave_size:>5} {summary['orders'] / seconds:>9.0f} {summary['lines'] / seconds:>9.0f} "
+                  f"{summary['allocated']:>9} {len(summary['short']):>6} {summary['split_lines']:>6} {oversold:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Compare how cheap lookups hold up under heavy report load: sync worker pool vs the ASGI lanes.
+
+Heavy clients loop on /performance while light clients loop on /inventory. The sync run
+gives all requests one pool of ASYNC_WORKERS + ASYNC_HEAVY_WORKERS threads, like a
+threaded WSGI server. The async run sends the same requests through asgi.application,
+where heavy endpoints only get their own lane. Both run in-process, so only the scheduling
+differs. The async side needs no ASGI server. First it checks that event streams are closed
+when their clients disconnect.
+
+    python benchmarks/generate_data.py /tmp/large.db
+    python benchmarks/bench_async.py /tmp/large.db --heavy 0 4 16 --light 8 --seconds 10
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+HEAVY = '/performance'
+LIGHT = '/inventory'
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(samples, seconds):
+    samples.sort()
+    return {'rps': len(samples) / seconds, 'p50': percentile(samples, 50) * 1000, 'p95': percentile(samples, 95) * 1000}
+
+
+def run_sync(app, workers, heavy, light, seconds):
+    from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    samples = {HEAVY: [], LIGHT: []}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def request(path):
+        environ = EnvironBuilder(path=path).get_environ()
+        app_iter, status, headers = run_wsgi_app(app, environ, buffered=True)
+        return status
+
+    def client(path):
+        local = []
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            pool.submit(request, path).result()
+            local.append(time.perf_counter() - started)
+        with lock:
+            samples[path].extend(local)
+
+    clients = [threading.Thread(target=client, args=(HEAVY,)) for _ in range(heavy)]
+    clients += [threading.Thread(target=client, args=(LIGHT,)) for _ in range(light)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    pool.shutdown()
+    return {path: summarize(values, seconds) for path, values in samples.items()}
+
+
+def run_async(application, heavy, light, seconds):
+    samples = {HEAVY: [], LIGHT: []}
+
+    async def request(path):
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+                 'headers': [], 'server': ('bench', 80), 'client': ('127.0.0.1', 0),
+                 'http_version': '1.1', 'scheme': 'http', 'root_path': ''}
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            pass
+
+        await application(scope, receive, send)
+
+    async def client(path, deadline):
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            await request(path)
+            samples[path].append(time.perf_counter() - started)
+
+    async def main():
+        deadline = time.perf_counter() + seconds
+        await asyncio.gather(*[client(HEAVY, deadline) for _ in range(heavy)],
+                             *[client(LIGHT, deadline) for _ in range(light)])
+
+    asyncio.run(main())
+    return {path: summarize(values, seconds) for path, values in samples.items()}
+
+
+def check_stream_disconnect(application, app, clients=20, stay=0.5):
+    # Dashboards that open /stream and then leave must release their subscription and lane slot
+    app.config['CHANGEFEED_KEEPALIVE'] = 0.2
+
+    async def dashboard():
+        scope = {'type': 'http', 'method': 'GET', 'path': '/stream', 'raw_path': b'/stream',
+                 'query_string': b'topics=inventory', 'headers': [], 'server': ('bench', 80),
+                 'client': ('127.0.0.1', 0), 'http_version': '1.1', 'scheme': 'http', 'root_path': ''}
+        messages = iter([{'type': 'http.request', 'body': b'', 'more_body': False}])
+
+        async def receive():
+            message = next(messages, None)
+            if message is None:
+                await asyncio.sleep(stay)
+                message = {'type': 'http.disconnect'}
+            return message
+
+        async def send(message):
+            pass
+
+        await application(scope, receive, send)
+
+    async def main():
+        done, running = await asyncio.wait([asyncio.ensure_future(dashboard()) for _ in range(clients)],
+                                           timeout=stay + 5)
+        assert not running, f'{len(running)} of {clients} streams kept running after their client left'
+
+    asyncio.run(main())
+    subscribers = app.extensions['changefeed'].stats()['subscribers']
+    pending = application.lanes['stream'].stats()['pending']
+    assert subscribers == 0 and pending == 0, f'{subscribers} subscriptions and {pending} stream slots left open'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database')
+    parser.add_argument('--heavy', type=int, nargs='+', default=[0, 4, 16], help='concurrent /performance clients')
+    parser.add_argument('--light', type=int, default=8, help='concurrent /inventory clients')
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    os.environ['INVENTORY_DATABASE'] = os.path.abspath(args.database)
+    from asgi import application  # noqa: E402  (reads INVENTORY_DATABASE at import)
+    from app import app  # noqa: E402
+    logging.getLogger('inventory.slow_queries').disabled = True  # every heavy request is a slow query
+    app.config['JOB_QUEUE'] = False  # build /performance in the request rather than reuse a job result
+
+    check_stream_disconnect(application, app)
+
+    workers = app.config['ASYNC_WORKERS'] + app.config['ASYNC_HEAVY_WORKERS']
+    print(f'sync pool: {workers} threads; async lanes: {app.config["ASYNC_WORKERS"]} default + '
+          f'{app.config["ASYNC_HEAVY_WORKERS"]} heavy\n')
+    print(f"{'mode':<6} {'heavy':>5} {'light req/s':>11} {'light p50':>10} {'light p95':>10} {'heavy req/s':>11}")
+    for heavy in args.heavy:
+        for mode in ('sync', 'async'):
+            if mode == 'sync':
+                result = run_sync(app, workers, heavy, args.light, args.seconds)
+            else:
+                result = run_async(application, heavy, args.light, args.seconds)
+            light, slow = result[LIGHT], result[HEAVY]
+            print(f"{mode:<6} {heavy:>5} {light['rps']:>11.1f} {light['p50']:>9.1f}ms {light['p95']:>9.1f}ms "
+                  f"{slow['rps']:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Measure stock posting throughput with many threads hammering the same hot items.
+
+Every thread has its own connection and posts a mix of OUT and IN movements against a
+handful of items in one warehouse, one batch per transaction. Rejected batches (a batch is
+all-or-nothing) are the oversell guard at work. After each run the benchmark checks that no
+position went negative and that replaying the ledger from the opening snapshot reproduces
+Stock exactly.
+
+    python benchmarks/bench_ledger.py --threads 1 4 16 --batch 1 20
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db  # noqa: E402
+import ledger  # noqa: E402
+import migrations  # noqa: E402
+
+WAREHOUSE = 1
+
+
+def create_database(path, hot_items, opening):
+    conn = sqlite3.connect(path)
+    with open(os.path.join(ROOT, 'inventory.sql')) as schema:
+        conn.executescript(schema.read())
+    conn.executemany(
+        'INSERT INTO Items (item_name, category_id, supplier_id, unit_price, reorder_level) VALUES (?, 1, 1, 1.0, 0)',
+        [(f'hot item {n}',) for n in range(hot_items)])
+    conn.execute('''
+        INSERT INTO Stock (item_id, warehouse_id, quantity)
+        SELECT item_id, ?, ? FROM Items WHERE item_name LIKE 'hot item %'
+    ''', (WAREHOUSE, opening))
+    conn.commit()
+    conn.close()
+    conn = db.connect(path)
+    migrations.run_migrations(conn)
+    items = [row[0] for row in conn.execute("SELECT item_id FROM Items WHERE item_name LIKE 'hot item %'")]
+    conn.close()
+    return items
+
+
+def worker(path, items, batches, batch_size, out_share, seed, counts, lock):
+    conn = db.connect(path)
+    rng = random.Random(seed)
+    posted = rejected = 0
+    for _ in range(batches):
+        movements = [
+            ledger.Movement(rng.choice(items), WAREHOUSE, 'OUT' if rng.random() < out_share else 'IN',
+                            rng.randint(1, 3))
+            for _ in range(batch_size)
+        ]
+        try:
+            posted += ledger.post_movements(conn, movements)
+        except ledger.InsufficientStock:
+            rejected += 1
+    conn.close()
+    with lock:
+        counts['posted'] += posted
+        counts['rejected'] += rejected
+
+
+def run(threads, batch_size, movements, hot_items, opening, out_share):
+    path = os.path.join(tempfile.mkdtemp(), 'bench_ledger.db')
+    items = create_database(path, hot_items, opening)
+    batches = max(1, movements // (threads * batch_size))
+    counts = {'posted': 0, 'rejected': 0}
+    lock = threading.Lock()
+    pool = [threading.Thread(target=worker, args=(path, items, batches, batch_size, out_share, n, counts, lock))
+            for n in range(threads)]
+    started = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    conn = db.connect(path)
+    negative = conn.execute('SELECT COUNT(*) FROM Stock WHERE quantity < 0').fetchone()[0]
+    stock = {(row[0], row[1]): row[2] for row in conn.execute(
+        'SELECT item_id, warehouse_id, total_qty FROM ItemWarehouseStockTotals')}
+    consistent = ledger.stock_as_of(conn) == stock
+    conn.close()
+    return counts, elapsed, negative, consistent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 20])
+    parser.add_argument('--movements', type=int, default=20000, help='movements attempted per run')
+    parser.add_argument('--hot-items', type=int, default=4)
+    parser.add_argument('--opening', type=int, default=200, help='opening quantity per hot item')
+    parser.add_argument('--out-share', type=float, default=0.55, help='fraction of movements that are OUT')
+    args = parser.parse_args()
+
+    print(f"{'threads':>7} {'batch':>5} {'posted/s':>10} {'posted':>8} {'rejected':>8} {'negative':>8} {'replay':>7}")
+    for threads in args.threads:
+        for batch_size in args.batch:
+            counts, elapsed, negative, consistent = run(
+                threads, batch_size, args.movements, args.hot_items, args.opening, args.out_share)
+            print(f"{threads:>7} {batch_size:>5} {counts['posted'] / elapsed:>10.0f} {counts['posted']:>8} "
+                  f"{counts['rejected']:>8} {negative:>8} {'ok' if consistent else 'DIFF':>7}")
+
+
+if __name__ == '__main__':
+    main()
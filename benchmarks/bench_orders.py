@@ -0,0 +1,101 @@
+"""Measure order entry throughput for 1, 10 and 100-line purchase and sales orders.
+
+Each N-line order is one JSON request written in one transaction. The 1-line row is the
+old one-order-per-line workflow, so compare its lines/s with the multi-line rows.
+
+    python benchmarks/bench_orders.py --orders 200
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def create_database(path):
+    conn = sqlite3.connect(path)
+    with open(os.path.join(ROOT, 'inventory.sql')) as schema:
+        conn.executescript(schema.read())
+    conn.close()
+
+
+def run(client, endpoint, payloads):
+    started = time.perf_counter()
+    for payload in payloads:
+        response = client.post(endpoint, json=payload)
+        assert response.status_code == 201, response.get_data(as_text=True)
+    return time.perf_counter() - started
+
+
+def check_header_edit(client):
+    # A JSON edit that only sends header fields must leave the order's lines alone
+    lines = [{'item_id': 1, 'quantity_sold': 1, 'unit_price': 10.0}, {'item_id': 2, 'quantity_sold': 2, 'unit_price': 5.0}]
+    so_id = client.post('/sales_orders/add', json={
+        'customer_id': 1, 'shipping_address': '789 Acme Blvd', 'lines': lines}).get_json()['so_id']
+    response = client.post(f'/sales_orders/edit/{so_id}', json={
+        'customer_id': 1, 'status': 'Pending', 'shipping_address': '1 New Road', 'order_date': '2025-12-01'})
+    assert response.get_json()['deleted'] == 0, response.get_data(as_text=True)
+    response = client.post(f'/sales_orders/edit/{so_id}', json={
+        'customer_id': 1, 'status': 'Pending', 'shipping_address': '1 New Road', 'order_date': '2025-12-01',
+        'lines': []})
+    assert response.get_json()['deleted'] == len(lines), response.get_data(as_text=True)
+
+
+def check_bad_edits(client):
+    # Edits of orders that don't exist must not leave lines behind; non-object bodies are refused
+    edit = {'status': 'Pending', 'order_date': '2025-12-01', 'lines': [{'item_id': 1, 'quantity': 1, 'unit_cost': 1.0}]}
+    for path, header in (('/orders/edit/99999999', {'supplier_id': 1, 'expected_delivery_date': '2026-01-01'}),
+                         ('/sales_orders/edit/99999999', {'customer_id': 1, 'shipping_address': 'x'})):
+        response = client.post(path, json=dict(edit, **header))
+        assert response.status_code == 404, f'{path}: {response.status_code}'
+    so_id = client.post('/sales_orders/add', json={'customer_id': 1, 'shipping_address': 'x', 'lines': [
+        {'item_id': 1, 'quantity_sold': 1, 'unit_price': 1.0}]}).get_json()['so_id']
+    for body in ([1, 2], 'text', {'customer_id': 1, 'status': 'Pending', 'shipping_address': 'x',
+                                  'order_date': '2025-12-01', 'lines': ['item_id']}):
+        response = client.post(f'/sales_orders/edit/{so_id}', json=body)
+        assert response.status_code == 400, f'{body!r}: {response.status_code}'
+    conn = sqlite3.connect(os.environ['INVENTORY_DATABASE'])
+    orphans = conn.execute('SELECT (SELECT COUNT(*) FROM PurchaseOrderDetails WHERE po_id = 99999999) + '
+                           '(SELECT COUNT(*) FROM SalesOrderDetails WHERE so_id = 99999999)').fetchone()[0]
+    conn.close()
+    assert orphans == 0, f'{orphans} lines written for orders that do not exist'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=200, help='orders posted per line count')
+    parser.add_argument('--lines', type=int, nargs='+', default=[1, 10, 100])
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    os.environ['INVENTORY_DATABASE'] = os.path.join(tmp, 'bench_orders.db')
+    create_database(os.environ['INVENTORY_DATABASE'])
+    sys.path.insert(0, ROOT)
+    from app import app  # noqa: E402  (reads INVENTORY_DATABASE at import)
+
+    app.config['REPORT_REFRESH_INTERVAL'] = 0
+    client = app.test_client()
+
+    kinds = {
+        'purchase': ('/orders/add', lambda n: {
+            'supplier_id': 1, 'expected_delivery_date': '2025-12-01',
+            'lines': [{'item_id': i % 8 + 1, 'quantity': 5, 'unit_cost': 10.0} for i in range(n)]}),
+        'sales': ('/sales_orders/add', lambda n: {
+            'customer_id': 1, 'shipping_address': '789 Acme Blvd',
+            'lines': [{'item_id': i % 8 + 1, 'quantity_sold': 1, 'unit_price': 10.0} for i in range(n)]}),
+    }
+
+    print(f"{'kind':<9} {'lines':>5} {'orders/s':>10} {'lines/s':>10}")
+    for kind, (endpoint, make) in kinds.items():
+        for n in args.lines:
+            elapsed = run(client, endpoint, [make(n)] * args.orders)
+            print(f'{kind:<9} {n:>5} {args.orders / elapsed:>10.1f} {args.orders * n / elapsed:>10.1f}')
+    check_header_edit(client)
+    check_bad_edits(client)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Measure logins per second at each password hashing cost, and what the throttle saves.
+
+For every setting the benchmark stores a user hashed at that cost, then client threads
+post correct credentials to the login route for a fixed time. The verify column is the
+cost of one hash on its own. The final row replays a credential-stuffing run from one IP
+with the default throttle on: almost every attempt is refused before hashing, so the
+server's CPU isn't spent on it. A last run guesses at one account from many addresses at
+once and checks that no more guesses are hashed than LOGIN_USER_FAILURES allows.
+
+    python benchmarks/bench_passwords.py --settings scrypt:16384 scrypt:65536 pbkdf2_sha256:600000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_SETTINGS = ['scrypt:4096', 'scrypt:16384', 'scrypt:32768', 'scrypt:65536',
+                    'pbkdf2_sha256:100000', 'pbkdf2_sha256:310000', 'pbkdf2_sha256:600000']
+USERNAME = 'bench-user'
+PASSWORD = 'Bench-Password-1'
+
+
+def parse_setting(text):
+    scheme, cost = text.split(':')
+    return (scheme, int(cost), 8, 1) if scheme == 'scrypt' else (scheme, int(cost))
+
+
+def create_database(path):
+    conn = sqlite3.connect(path)
+    with open(os.path.join(ROOT, 'inventory.sql')) as schema:
+        conn.executescript(schema.read())
+    conn.close()
+
+
+def hammer(app, concurrency, seconds, form_for, addresses):
+    # Each thread posts the login form in a loop; returns {status: count}
+    counts = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client(number):
+        local = {}
+        test_client = app.test_client()
+        while time.perf_counter() < deadline:
+            response = test_client.post('/', data=form_for(number),
+                                        environ_base={'REMOTE_ADDR': addresses(number)})
+            local[response.status_code] = local.get(response.status_code, 0) + 1
+        with lock:
+            for status, count in local.items():
+                counts[status] = counts.get(status, 0) + count
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--settings', nargs='+', default=DEFAULT_SETTINGS, help='scheme:cost pairs')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench_passwords.db')
+    create_database(path)
+    # Must be set before anything imports db, which reads it once
+    os.environ['INVENTORY_DATABASE'] = path
+    import passwords  # noqa: E402
+    from app import app  # noqa: E402
+
+    config = app.config
+    print(f"hash pool: {config['PASSWORD_HASH_WORKERS']} threads, {os.cpu_count()} CPUs, "
+          f"{args.concurrency} clients\n")
+    print(f"{'setting':<22} {'verify':>9} {'logins/s':>9} {'refused':>8}")
+    # No throttling while measuring throughput: every client logs in as the same user
+    unlimited = 10 ** 9
+    app.extensions['login_throttle'] = passwords.LoginThrottle(unlimited, unlimited, 60, 1000)
+    conn = sqlite3.connect(path)
+    for setting in args.settings:
+        params = parse_setting(setting)
+        app.extensions['password_hasher'] = passwords.Hasher(params, config['PASSWORD_HASH_WORKERS'],
+                                                             config['PASSWORD_HASH_MAX_PENDING'])
+        stored = passwords.hash_password(PASSWORD, params)
+        conn.execute('DELETE FROM Users WHERE username = ?', (USERNAME,))
+        conn.execute("INSERT INTO Users (username, password_hash, role) VALUES (?, ?, 'staff')", (USERNAME, stored))
+        conn.commit()
+
+        started = time.perf_counter()
+        passwords.verify_password(PASSWORD, stored)
+        verify_ms = (time.perf_counter() - started) * 1000
+
+        counts = hammer(app, args.concurrency, args.seconds,
+                        lambda n: {'username': USERNAME, 'password': PASSWORD}, lambda n: f'10.0.0.{n}')
+        print(f"{setting:<22} {verify_ms:>7.1f}ms {counts.get(302, 0) / args.seconds:>9.1f} "
+              f"{sum(count for status, count in counts.items() if status != 302):>8}")
+
+    # Credential stuffing: wrong passwords for many usernames from one address, default cost and limits
+    app.extensions['password_hasher'] = passwords.Hasher(passwords.params_from_config(config),
+                                                         config['PASSWORD_HASH_WORKERS'],
+                                                         config['PASSWORD_HASH_MAX_PENDING'])
+    app.extensions['login_throttle'] = passwords.LoginThrottle(
+        config['LOGIN_IP_ATTEMPTS'], config['LOGIN_USER_FAILURES'],
+        config['LOGIN_THROTTLE_WINDOW'], config['LOGIN_THROTTLE_MAX_KEYS'])
+    attempt = iter(range(10 ** 9))
+    counts = hammer(app, args.concurrency, args.seconds,
+                    lambda n: {'username': f'victim{next(attempt)}', 'password': 'guess'}, lambda n: '203.0.113.7')
+    hashed = counts.get(200, 0)
+    total = sum(counts.values())
+    print(f"\nstuffing from one IP: {total / args.seconds:.0f} attempts/s, {hashed} hashed, "
+          f"{counts.get(429, 0)} throttled")
+
+    # Guessing one account from many addresses at once: no more guesses are hashed than the
+    # username's bucket holds, plus what it refills over the run
+    app.extensions['login_throttle'] = passwords.LoginThrottle(
+        config['LOGIN_IP_ATTEMPTS'], config['LOGIN_USER_FAILURES'],
+        config['LOGIN_THROTTLE_WINDOW'], config['LOGIN_THROTTLE_MAX_KEYS'])
+    counts = hammer(app, args.concurrency, args.seconds,
+                    lambda n: {'username': USERNAME, 'password': 'guess'}, lambda n: f'198.51.100.{n}')
+    hashed = counts.get(200, 0)
+    allowed = config['LOGIN_USER_FAILURES'] * (1 + args.seconds / config['LOGIN_THROTTLE_WINDOW']) + 1
+    print(f"guessing one account: {hashed} hashed, {counts.get(429, 0)} throttled")
+    assert hashed <= allowed, f'{hashed} guesses at one account were hashed, expected at most {allowed:.0f}'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+"""Drive every route and report p50/p95/p99 latency and throughput, optionally against a baseline.
+
+Run it against a database built by generate_data.py; the POST scenarios write to it.
+--mode client calls the app in-process through Flask's test client. --mode server starts
+a multi-worker server and sends real HTTP requests from --concurrency threads. Install
+gunicorn for meaningful server numbers: the Werkzeug fallback forks a process per request,
+so its latencies include fork and cold-cache costs. Reports are built in the request
+(JOB_QUEUE off), so the reports and performance rows time the report itself.
+
+    python benchmarks/generate_data.py /tmp/large.db
+    python benchmarks/bench_routes.py /tmp/large.db --output baseline.json
+    python benchmarks/bench_routes.py /tmp/large.db --mode server --workers 4 --baseline baseline.json
+
+With --baseline the run exits with status 1 if any scenario's p95 latency or throughput is
+worse than the baseline by more than --tolerance.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+Scenario = namedtuple('Scenario', 'name method make')
+
+
+def get(path):
+    return lambda: ('GET', path, None, {})
+
+
+def scale(path):
+    conn = sqlite3.connect(path)
+    counts = {table: conn.execute(f'SELECT MAX(rowid) FROM {table}').fetchone()[0] or 0
+              for table in ('Items', 'Stock', 'SalesOrders', 'SalesOrderDetails', 'PurchaseOrders',
+                            'PurchaseOrderDetails', 'Categories', 'Suppliers', 'Customers')}
+    conn.close()
+    return counts
+
+
+def category_names(path):
+    # /inventory filters on the category name, so the scenario needs real ones to match rows
+    conn = sqlite3.connect(path)
+    names = [row[0] for row in conn.execute('SELECT category_name FROM Categories')]
+    conn.close()
+    return names
+
+
+def build_scenarios(counts, rng, words, categories):
+    def pick(table):
+        return rng.randint(1, max(counts[table], 1))
+
+    def as_json(method, path, payload):
+        return method, path, json.dumps(payload).encode(), {'Content-Type': 'application/json'}
+
+    def as_form(method, path, fields):
+        return method, path, urlencode(fields, doseq=True).encode(), {
+            'Content-Type': 'application/x-www-form-urlencoded'}
+
+    return [
+        Scenario('inventory', 'GET', get('/inventory')),
+        Scenario('inventory_in_stock', 'GET', get('/inventory?stock=in-stock')),
+        Scenario('inventory_low_stock', 'GET', get('/inventory?stock=low-stock')),
+        Scenario('inventory_out_of_stock', 'GET', get('/inventory?stock=out-of-stock')),
+        Scenario('inventory_category', 'GET',
+                 lambda: get('/inventory?' + urlencode({'category': rng.choice(categories)}))()),
+        Scenario('inventory_search', 'GET', lambda: get(f'/inventory?search={rng.choice(words)}')()),
+        Scenario('inventory_deep_page', 'GET', lambda: get(f"/inventory?after={pick('Items')}")()),
+        Scenario('orders', 'GET', get('/orders')),
+        Scenario('sales_orders', 'GET', get('/sales_orders')),
+        Scenario('reports', 'GET', get('/reports')),
+        Scenario('performance', 'GET', get('/performance')),
+        Scenario('api_inventory', 'GET', lambda: get(f"/api/v1/inventory?after={pick('Items')}")()),
+        Scenario('add_order', 'POST', lambda: as_json('POST', '/orders/add', {
+            'supplier_id': pick('Suppliers'), 'expected_delivery_date': '2026-01-15',
+            'lines': [{'item_id': pick('Items'), 'quantity': rng.randint(1, 50), 'unit_cost': 9.5}
+                      for _ in range(3)]})),
+        Scenario('edit_order', 'POST', lambda: as_form('POST', f"/orders/edit/{pick('PurchaseOrders')}", {
+            'supplier_id': pick('Suppliers'), 'order_date': '2025-11-01',
+            'expected_delivery_date': '2025-11-20', 'status': 'Pending'})),
+        Scenario('add_sales_order', 'POST', lambda: as_json('POST', '/sales_orders/add', {
+            'customer_id': pick('Customers'), 'shipping_address': '1 Bench St',
+            'lines': [{'item_id': pick('Items'), 'quantity_sold': rng.randint(1, 5), 'unit_price': 19.0}
+                      for _ in range(3)]})),
+        Scenario('edit_sales_order', 'POST', lambda: as_form('POST', f"/sales_orders/edit/{pick('SalesOrders')}", {
+            'customer_id': pick('Customers'), 'status': 'Pending', 'shipping_address': '1 Bench St',
+            'order_date': '2025-11-01'})),
+        Scenario('add_item', 'POST', lambda: as_form('POST', '/inventory/add', {
+            'name': f'Bench item {rng.random():.8f}', 'description': ' '.join(rng.choices(words, k=8)),
+            'category_id': pick('Categories'), 'supplier_id': pick('Suppliers'),
+            'unit_price': 12.5, 'reorder_level': 5})),
+        Scenario('edit_item', 'POST', lambda: as_form('POST', f"/inventory/edit/{pick('Items')}", {
+            'name': f'Edited item {rng.random():.8f}', 'description': ' '.join(rng.choices(words, k=8)),
+            'category_id': pick('Categories'), 'supplier_id': pick('Suppliers'),
+            'unit_price': 13.0, 'reorder_level': 5})),
+    ]
+
+
+def percentile(sorted_values, pct):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'rps': round(len(latencies) / elapsed, 1),
+    }
+
+
+def create_app():
+    # Reports are built in the request, as bench_async does: with the job queue on, the
+    # reports and performance scenarios would only time the pending page or a stored result
+    from app import app  # noqa: E402  (reads INVENTORY_DATABASE at import)
+    app.config['JOB_QUEUE'] = False
+    return app
+
+
+def run_client(scenario, requests, warmup):
+    client = create_app().test_client()
+    latencies = []
+    errors = 0
+    for n in range(warmup + requests):
+        if n == warmup:
+            run_started = time.perf_counter()
+        method, path, body, headers = scenario.make()
+        started = time.perf_counter()
+        response = client.open(path, method=method, data=body, headers=headers)
+        elapsed = time.perf_counter() - started
+        if n >= warmup:
+            latencies.append(elapsed)
+            errors += response.status_code >= 400
+    return latencies, errors, time.perf_counter() - run_started
+
+
+def run_http(scenario, requests, warmup, port, concurrency):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    share = [requests // concurrency + (n < requests % concurrency) for n in range(concurrency)]
+
+    def worker(count):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        local = []
+        failed = 0
+        for n in range(count):
+            method, path, body, headers = scenario.make()
+            started = time.perf_counter()
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            local.append(time.perf_counter() - started)
+            failed += response.status >= 400
+        conn.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    worker(warmup)
+    latencies.clear()
+    errors[0] = 0
+    threads = [threading.Thread(target=worker, args=(count,)) for count in share if count]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - started
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers, port, env):
+    # Both servers load the app through create_app() above
+    if shutil.which('gunicorn'):
+        command = ['gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}',
+                   '--pythonpath', os.path.join(ROOT, 'benchmarks'), 'bench_routes:create_app()']
+    else:
+        command = [sys.executable, '-c',
+                   f'import sys; sys.path.insert(0, {os.path.join(ROOT, "benchmarks")!r}); '
+                   'from werkzeug.serving import run_simple; from bench_routes import create_app; '
+                   f'run_simple("127.0.0.1", {port}, create_app(), threaded=False, processes={workers})']
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return server, command[0]
+        except OSError:
+            if server.poll() is not None:
+                raise SystemExit('server exited during start-up')
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit('server did not start within 120s')
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key in ('mode', 'server', 'workers', 'concurrency'):
+        if results['meta'].get(key) != baseline['meta'].get(key):
+            print(f"warning: baseline {key} differs ({baseline['meta'].get(key)} vs {results['meta'].get(key)})")
+    print(f"\n{'scenario':<24} {'p95 base':>9} {'p95 now':>9} {'change':>8} {'rps base':>9} {'rps now':>9} {'change':>8}")
+    for name, current in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        p95_change = current['p95_ms'] / before['p95_ms'] - 1 if before['p95_ms'] else 0
+        rps_change = current['rps'] / before['rps'] - 1 if before['rps'] else 0
+        flag = ''
+        if p95_change > tolerance or rps_change < -tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<24} {before['p95_ms']:>9.2f} {current['p95_ms']:>9.2f} {p95_change:>+8.0%} "
+              f"{before['rps']:>9.1f} {current['rps']:>9.1f} {rps_change:>+8.0%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='database to run against (POST scenarios modify it)')
+    parser.add_argument('--mode', choices=['client', 'server'], default='client')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=4, help='server processes (server mode)')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads (server mode)')
+    parser.add_argument('--only', nargs='+', help='run only these scenarios')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--baseline', help='compare against this results JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown')
+    args = parser.parse_args()
+
+    database = os.path.abspath(args.database)
+    # Must be set before anything imports db, which reads it once
+    os.environ['INVENTORY_DATABASE'] = database
+    from generate_data import WORDS
+
+    counts = scale(database)
+    scenarios = build_scenarios(counts, random.Random(args.seed), WORDS, category_names(database))
+    if args.only:
+        scenarios = [scenario for scenario in scenarios if scenario.name in args.only]
+
+    server = None
+    meta = {'mode': args.mode, 'scale': counts, 'requests': args.requests,
+            'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version}
+    if args.mode == 'server':
+        port = free_port()
+        server, meta['server'] = start_server(args.workers, port, dict(os.environ))
+        meta.update(workers=args.workers, concurrency=args.concurrency)
+
+    results = {'meta': meta, 'scenarios': {}}
+    print(f"{'scenario':<24} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'errors':>6}")
+    try:
+        for scenario in scenarios:
+            if server is None:
+                latencies, errors, elapsed = run_client(scenario, args.requests, args.warmup)
+            else:
+                latencies, errors, elapsed = run_http(scenario, args.requests, args.warmup, port, args.concurrency)
+            summary = summarize(latencies, errors, elapsed)
+            results['scenarios'][scenario.name] = summary
+            print(f"{scenario.name:<24} {summary['p50_ms']:>8.2f} {summary['p95_ms']:>8.2f} "
+                  f"{summary['p99_ms']:>8.2f} {summary['rps']:>8.1f} {errors:>6}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2)
+    if args.baseline:
+        with open(args.baseline) as handle:
+            regressions = compare(results, json.load(handle), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Compare inventory search latency: LIKE '%q%' scan vs the FTS5 index.
+
+    python benchmarks/bench_search.py --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrations  # noqa: E402
+import search  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMON = ('jersey shorts gloves helmet bib fabric cloth womens mens').split()
+SYLLABLES = ('ka ro mi ten vo la zu pe shi na do re ul an ox be gri fa lo tu').split()
+# Rare words are the typical catalog lookup; 'jersey' matches ~1/3 of items, 'nomatch' nothing
+QUERIES = ('kamiro', 'tenzu shi', 'jersey kamiro', 'jersey', 'nomatch')
+
+
+def vocabulary(rng, size=20000):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choices(SYLLABLES, k=rng.randint(2, 4))))
+    return sorted(words)
+
+
+def build_database(path, count, seed=12):
+    rng = random.Random(seed)
+    words = vocabulary(rng)
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    with open(os.path.join(ROOT, 'inventory.sql')) as schema:
+        conn.executescript(schema.read())
+    batch = []
+    for n in range(count):
+        name = ' '.join([rng.choice(COMMON)] + rng.sample(words, 2)).title()
+        description = ' '.join(rng.choices(words, k=10) + rng.choices(COMMON, k=2))
+        batch.append((f'{name} {n}', description, rng.randint(1, 7), rng.randint(1, 2), 10.0, 10))
+        if len(batch) == 10000:
+            conn.executemany('INSERT INTO Items (item_name, description, category_id, supplier_id, unit_price, reorder_level) VALUES (?, ?, ?, ?, ?, ?)', batch)
+            batch.clear()
+    conn.executemany('INSERT INTO Items (item_name, description, category_id, supplier_id, unit_price, reorder_level) VALUES (?, ?, ?, ?, ?, ?)', batch)
+    conn.commit()
+    migrations.run_migrations(conn)
+    return conn
+
+
+def time_query(conn, sql, params, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+
+    like_sql = f'SELECT item_id FROM Items WHERE item_name LIKE ? OR description LIKE ? ORDER BY item_id LIMIT {args.limit}'
+    fts_sql = f'SELECT rowid FROM ItemsSearch WHERE ItemsSearch MATCH ? ORDER BY rank LIMIT {args.limit}'
+
+    print(f"{'items':>10} {'query':<20} {'LIKE ms':>10} {'FTS5 ms':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            conn = build_database(os.path.join(tmp, f'search_{size}.db'), size)
+            if not search.has_search_index(conn):
+                sys.exit('This SQLite build has no FTS5 support.')
+            for text in QUERIES:
+                like_ms = time_query(conn, like_sql, (f'%{text}%', f'%{text}%'), args.repeat)
+                fts_ms = time_query(conn, fts_sql, (search.match_expression(text),), args.repeat)
+                print(f'{size:>10} {text:<20} {like_ms:>10.2f} {fts_ms:>10.2f}')
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
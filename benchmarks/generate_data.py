@@ -0,0 +1,166 @@
+"""Fill an inventory database with synthetic data at production-like volumes.
+
+Rows are generated from a seeded RNG, so the same arguments always produce the same
+database. The base tables are loaded with executemany in large transactions with
+journaling off, and the migrations run afterwards, so derived tables, triggers, the search
+index and report summaries are built once in bulk rather than row by row.
+
+    python benchmarks/generate_data.py /tmp/large.db --items 1000000 --stock 10000000 \\
+        --sales-lines 5000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import migrations  # noqa: E402
+import reporting  # noqa: E402
+
+WORDS = ('steel aluminium carbon alloy road mountain gravel city touring race pro lite '
+         'jersey shorts gloves helmet bib jacket vest sock shoe pedal chain cassette wheel '
+         'tyre tube saddle bar stem light lock pump bottle cage rack bag mudguard').split()
+STATUSES = ('Pending', 'Shipped', 'Delivered', 'Cancelled')
+START_DATE = date(2023, 1, 1)
+
+
+def batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load(conn, label, sql, rows, batch_size):
+    started = time.perf_counter()
+    count = 0
+    for batch in batched(rows, batch_size):
+        conn.executemany(sql, batch)
+        conn.commit()
+        count += len(batch)
+    print(f'{label:<22} {count:>12,} rows in {time.perf_counter() - started:7.1f}s')
+
+
+def first_id(conn, table, key):
+    return (conn.execute(f'SELECT IFNULL(MAX({key}), 0) FROM {table}').fetchone()[0]) + 1
+
+
+def generate(path, args):
+    rng = random.Random(args.seed)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    with open(os.path.join(ROOT, 'inventory.sql')) as schema:
+        conn.executescript(schema.read())
+    conn.execute('PRAGMA foreign_keys = OFF')
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+
+    def day(span=730):
+        return (START_DATE + timedelta(days=rng.randrange(span))).isoformat()
+
+    category = first_id(conn, 'Categories', 'category_id')
+    load(conn, 'Categories', 'INSERT INTO Categories (category_name, description) VALUES (?, ?)',
+         ((f'Category {n}', f'Generated category {n}') for n in range(args.categories)), args.batch)
+    categories = (1, category + args.categories - 1)
+
+    supplier = first_id(conn, 'Suppliers', 'supplier_id')
+    load(conn, 'Suppliers',
+         'INSERT INTO Suppliers (supplier_name, contact_person, phone, email, address) VALUES (?, ?, ?, ?, ?)',
+         ((f'Supplier {n}', f'Contact {n}', f'555-{n:07d}', f'supplier{n}@example.com', f'{n} Supply Rd')
+          for n in range(args.suppliers)), args.batch)
+    suppliers = (1, supplier + args.suppliers - 1)
+
+    customer = first_id(conn, 'Customers', 'customer_id')
+    load(conn, 'Customers', 'INSERT INTO Customers (customer_name, email, phone, address) VALUES (?, ?, ?, ?)',
+         ((f'Customer {n}', f'customer{n}@example.com', f'555-{n:07d}', f'{n} Market St')
+          for n in range(args.customers)), args.batch)
+    customers = (1, customer + args.customers - 1)
+
+    warehouse = first_id(conn, 'Warehouses', 'warehouse_id')
+    load(conn, 'Warehouses', 'INSERT INTO Warehouses (warehouse_name, location, capacity) VALUES (?, ?, ?)',
+         ((f'Warehouse {n}', f'Site {n}', 100000) for n in range(args.warehouses)), args.batch)
+    warehouse_count = warehouse + args.warehouses - 1
+
+    item = first_id(conn, 'Items', 'item_id')
+    load(conn, 'Items', '''
+        INSERT INTO Items (item_name, description, category_id, supplier_id, unit_price, reorder_level)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', ((' '.join(rng.choices(WORDS, k=3)).title() + f' {n}', ' '.join(rng.choices(WORDS, k=12)),
+           rng.randint(*categories), rng.randint(*suppliers), round(rng.uniform(1, 2000), 2),
+           rng.randint(0, 50)) for n in range(args.items)), args.batch)
+    item_count = item + args.items - 1
+
+    # Stock rows walk the (item, warehouse) grid so each pair appears at most once
+    if args.stock > item_count * warehouse_count:
+        raise SystemExit('--stock exceeds items x warehouses')
+    load(conn, 'Stock', 'INSERT INTO Stock (item_id, warehouse_id, quantity) VALUES (?, ?, ?)',
+         ((n % item_count + 1, n // item_count % warehouse_count + 1,
+           0 if rng.random() < args.out_of_stock else rng.randint(1, 500)) for n in range(args.stock)),
+         args.batch)
+
+    orders = max(1, args.sales_lines // args.lines_per_order) if args.sales_lines else 0
+    so = first_id(conn, 'SalesOrders', 'so_id')
+    load(conn, 'SalesOrders', '''
+        INSERT INTO SalesOrders (customer_id, order_date, status, shipping_address) VALUES (?, ?, ?, ?)
+    ''', ((rng.randint(*customers), day(), rng.choice(STATUSES), f'{n} Delivery Ave') for n in range(orders)),
+         args.batch)
+    load(conn, 'SalesOrderDetails', '''
+        INSERT INTO SalesOrderDetails (so_id, item_id, quantity_sold, unit_price) VALUES (?, ?, ?, ?)
+    ''', ((so + n % orders, rng.randint(1, item_count), rng.randint(1, 10), round(rng.uniform(1, 2000), 2))
+          for n in range(args.sales_lines)), args.batch)
+
+    purchase_orders = max(1, args.purchase_lines // args.lines_per_order) if args.purchase_lines else 0
+    po = first_id(conn, 'PurchaseOrders', 'po_id')
+    load(conn, 'PurchaseOrders', '''
+        INSERT INTO PurchaseOrders (supplier_id, order_date, status, expected_delivery_date) VALUES (?, ?, ?, ?)
+    ''', ((rng.randint(*suppliers), day(), rng.choice(('Pending', 'Received')), day())
+          for _ in range(purchase_orders)), args.batch)
+    load(conn, 'PurchaseOrderDetails', '''
+        INSERT INTO PurchaseOrderDetails (po_id, item_id, quantity_ordered, unit_cost, quantity_received)
+        VALUES (?, ?, ?, ?, 0)
+    ''', ((po + n % purchase_orders, rng.randint(1, item_count), rng.randint(1, 100), round(rng.uniform(1, 1000), 2))
+          for n in range(args.purchase_lines)), args.batch)
+
+    conn.execute('PRAGMA journal_mode = WAL')
+    started = time.perf_counter()
+    applied = migrations.run_migrations(conn)
+    print(f'{"migrations":<22} {len(applied):>12} applied in {time.perf_counter() - started:7.1f}s')
+    # Build the report summaries now rather than on the first request
+    started = time.perf_counter()
+    conn.row_factory = sqlite3.Row
+    changes = reporting.refresh(conn)
+    print(f'{"report summaries":<22} {changes:>12,} keys in {time.perf_counter() - started:7.1f}s')
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='database file to create (replaced if it exists)')
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--stock', type=int, default=500000)
+    parser.add_argument('--sales-lines', type=int, default=300000, help='SalesOrderDetails rows')
+    parser.add_argument('--purchase-lines', type=int, default=100000, help='PurchaseOrderDetails rows')
+    parser.add_argument('--lines-per-order', type=int, default=5)
+    parser.add_argument('--categories', type=int, default=50)
+    parser.add_argument('--suppliers', type=int, default=500)
+    parser.add_argument('--customers', type=int, default=20000)
+    parser.add_argument('--warehouses', type=int, default=10)
+    parser.add_argument('--out-of-stock', type=float, default=0.05, help='share of stock rows at zero')
+    parser.add_argument('--seed', type=int, default=13)
+    parser.add_argument('--batch', type=int, default=50000, help='rows per transaction')
+    args = parser.parse_args()
+    generate(args.path, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+import csv
+import io
+import json
+import sqlite3
+
+import click
+from flask import Response, stream_with_context
+from flask.cli import with_appcontext
+
+import ledger
+from db import get_db_connection
+
+BATCH_SIZE = 1000
+# Per-row errors beyond this are counted but not listed
+MAX_REPORTED_ERRORS = 500
+# What a rejected batch or row raises
+WRITE_ERRORS = (sqlite3.Error, ledger.PostingError, ledger.InsufficientStock)
+
+
+class RowError(ValueError):
+    pass
+
+
+def iter_csv_records(stream):
+    yield from csv.DictReader(stream)
+
+
+def iter_json_records(stream, chunk_size=65536):
+    # Accepts JSON Lines or a top-level array of objects; either way only one chunk plus the
+    # current record is held in memory.
+    decoder = json.JSONDecoder()
+    buffer = ''
+    eof = False
+    while True:
+        stripped = buffer.lstrip(' \t\r\n,[')
+        if stripped.startswith(']'):
+            stripped = stripped[1:].lstrip()
+        buffer = stripped
+        if buffer:
+            try:
+                record, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                yield record
+                buffer = buffer[end:]
+                continue
+        if eof:
+            return
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer += chunk
+
+
+FORMATS = ('csv', 'json', 'jsonl', 'ndjson')
+
+
+def iter_records(stream, fmt):
+    if fmt == 'csv':
+        return iter_csv_records(stream)
+    if fmt in FORMATS:
+        return iter_json_records(stream)
+    raise ValueError(f'Unsupported import format: {fmt}')
+
+
+def _text(record, field, required=False):
+    if not isinstance(record, dict):
+        # A JSON array may hold anything; only objects name their fields
+        raise RowError(f'record must be an object with named fields, got {type(record).__name__}')
+    value = record.get(field)
+    if value is None or str(value).strip() == '':
+        if required:
+            raise RowError(f'{field} is required')
+        return None
+    return str(value).strip()
+
+
+def _int(record, field, required=False, valid_ids=None):
+    value = _text(record, field, required)
+    if value is None:
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        raise RowError(f'{field} must be a whole number, got {value!r}')
+    if valid_ids is not None and number not in valid_ids:
+        raise RowError(f'{field} {number} does not exist')
+    return number
+
+
+def _float(record, field, required=False):
+    value = _text(record, field, required)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise RowError(f'{field} must be a number, got {value!r}')
+
+
+def _ids(conn, table, column):
+    return {row[0] for row in conn.execute(f'SELECT {column} FROM {table}')}
+
+
+class ImportReport:
+    def __init__(self):
+        self.processed = 0
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, row_number, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row_number, 'error': message})
+
+    def as_dict(self):
+        return {'processed': self.processed, 'inserted': self.inserted,
+                'failed': self.failed, 'errors': self.errors}
+
+
+def _insert(conn, sql):
+    # A writer for _import: one executemany per batch, in its own transaction
+    def write(rows):
+        with conn:
+            conn.executemany(sql, rows)
+    return write
+
+
+def _write_batch(write, batch, report):
+    # batch holds (row_number, params). One write per batch; if it is rejected, redo the
+    # batch row by row so only the offending rows are reported.
+    try:
+        write([params for _, params in batch])
+        report.inserted += len(batch)
+        return
+    except WRITE_ERRORS:
+        pass
+    for row_number, params in batch:
+        try:
+            write([params])
+            report.inserted += 1
+        except WRITE_ERRORS as exc:
+            report.error(row_number, str(exc))
+
+
+def _import(records, parse, write, batch_size):
+    report = ImportReport()
+    batch = []
+    for row_number, record in enumerate(records, start=1):
+        report.processed += 1
+        try:
+            batch.append((row_number, parse(record)))
+        except RowError as exc:
+            report.error(row_number, str(exc))
+            continue
+        if len(batch) >= batch_size:
+            _write_batch(write, batch, report)
+            batch = []
+    if batch:
+        _write_batch(write, batch, report)
+    return report
+
+
+def import_items(conn, records, batch_size=BATCH_SIZE):
+    categories = _ids(conn, 'Categories', 'category_id')
+    suppliers = _ids(conn, 'Suppliers', 'supplier_id')
+
+    def parse(record):
+        return (
+            _text(record, 'item_name', required=True),
+            _text(record, 'description'),
+            _int(record, 'category_id', valid_ids=categories),
+            _int(record, 'supplier_id', valid_ids=suppliers),
+            _float(record, 'unit_price'),
+            _int(record, 'reorder_level'),
+        )
+
+    return _import(records, parse, _insert(conn, '''
+        INSERT INTO Items (item_name, description, category_id, supplier_id, unit_price, reorder_level)
+        VALUES (?, ?, ?, ?, ?, ?)
+    '''), batch_size)
+
+
+def import_stock(conn, records, batch_size=BATCH_SIZE):
+    # Opening stock is posted to the ledger as adjustments, so replaying the ledger from a
+    # snapshot still arrives at the imported quantities
+    items = _ids(conn, 'Items', 'item_id')
+    warehouses = _ids(conn, 'Warehouses', 'warehouse_id')
+
+    def parse(record):
+        quantity = _int(record, 'quantity', required=True)
+        if quantity < 0:
+            raise RowError(f'quantity must not be negative, got {quantity}')
+        return ledger.Movement(
+            _int(record, 'item_id', required=True, valid_ids=items),
+            _int(record, 'warehouse_id', required=True, valid_ids=warehouses),
+            'ADJUSTMENT',
+            quantity,
+        )
+
+    return _import(records, parse, lambda movements: ledger.post_movements(conn, movements), batch_size)
+
+
+def import_sales(conn, records, batch_size=BATCH_SIZE):
+    # One record per order line. Lines sharing an order_ref become one sales order;
+    # a line without order_ref is an order of its own.
+    customers = _ids(conn, 'Customers', 'customer_id')
+    items = _ids(conn, 'Items', 'item_id')
+    orders = {}
+    report = ImportReport()
+    pending = []
+
+    def write(lines):
+        # Headers of orders not seen before and all their lines, in one transaction
+        new_refs = []
+        try:
+            with conn:
+                # Reserve the header ids ourselves so headers can go through executemany too
+                conn.execute('BEGIN IMMEDIATE')
+                # Honour AUTOINCREMENT: never reuse the id of a deleted order
+                next_id = conn.execute('''
+                    SELECT MAX(IFNULL((SELECT seq FROM sqlite_sequence WHERE name = 'SalesOrders'), 0),
+                               IFNULL(MAX(so_id), 0)) + 1
+                    FROM SalesOrders
+                ''').fetchone()[0]
+                headers = []
+                for _, ref, header, _ in lines:
+                    if ref not in orders:
+                        orders[ref] = next_id
+                        new_refs.append(ref)
+                        headers.append((next_id,) + header)
+                        next_id += 1
+                conn.executemany('''
+                    INSERT INTO SalesOrders (so_id, customer_id, order_date, status, shipping_address)
+                    VALUES (?, ?, IFNULL(?, DATE('now')), IFNULL(?, 'Pending'), ?)
+                ''', headers)
+                conn.executemany('''
+                    INSERT INTO SalesOrderDetails (so_id, item_id, quantity_sold, unit_price)
+                    VALUES (?, ?, ?, ?)
+                ''', [(orders[ref],) + line for _, ref, _, line in lines])
+        except sqlite3.Error:
+            for ref in new_refs:
+                orders.pop(ref, None)
+            raise
+        report.inserted += len(lines)
+
+    def flush():
+        if not pending:
+            return
+        try:
+            write(pending)
+        except sqlite3.Error:
+            # As in _write_batch: redo the batch one order at a time, so only the lines of
+            # the orders the database rejects are reported
+            by_order = {}
+            for entry in pending:
+                by_order.setdefault(entry[1], []).append(entry)
+            for lines in by_order.values():
+                try:
+                    write(lines)
+                except sqlite3.Error as exc:
+                    for row_number, _, _, _ in lines:
+                        report.error(row_number, str(exc))
+        pending.clear()
+
+    for row_number, record in enumerate(records, start=1):
+        report.processed += 1
+        try:
+            ref = _text(record, 'order_ref') or f'row-{row_number}'
+            header = (
+                _int(record, 'customer_id', required=True, valid_ids=customers),
+                _text(record, 'order_date'),
+                _text(record, 'status'),
+                _text(record, 'shipping_address'),
+            )
+            line = (
+                _int(record, 'item_id', required=True, valid_ids=items),
+                _int(record, 'quantity_sold', required=True),
+                _float(record, 'unit_price', required=True),
+            )
+        except RowError as exc:
+            report.error(row_number, str(exc))
+            continue
+        pending.append((row_number, ref, header, line))
+        if len(pending) >= batch_size:
+            flush()
+    flush()
+    return report
+
+
+IMPORTERS = {
+    'items': import_items,
+    'stock': import_stock,
+    'sales': import_sales,
+}
+
+EXPORT_QUERIES = {
+    'items': '''
+        SELECT Items.item_id, Items.item_name, Items.description, Items.category_id,
+               Items.supplier_id, Items.unit_price, Items.reorder_level,
+               IFNULL(ItemStockTotals.total_qty, 0) AS total_stock
+        FROM Items
+        LEFT JOIN ItemStockTotals ON Items.item_id = ItemStockTotals.item_id
+        ORDER BY Items.item_id
+    ''',
+    'stock': '''
+        SELECT stock_id, item_id, warehouse_id, quantity, last_updated
+        FROM Stock
+        ORDER BY stock_id
+    ''',
+    'sales': '''
+        SELECT so.so_id, so.customer_id, so.order_date, so.status, so.shipping_address,
+               sod.item_id, sod.quantity_sold, sod.unit_price
+        FROM SalesOrders so
+        JOIN SalesOrderDetails sod ON so.so_id = sod.so_id
+        ORDER BY so.so_id, sod.so_detail_id
+    ''',
+    'orders': '''
+        SELECT po.po_id, po.supplier_id, po.order_date, po.status, po.expected_delivery_date,
+               pod.item_id, pod.quantity_ordered, pod.unit_cost, pod.quantity_received
+        FROM PurchaseOrders po
+        JOIN PurchaseOrderDetails pod ON po.po_id = pod.po_id
+        ORDER BY po.po_id, pod.po_detail_id
+    ''',
+}
+
+
+def iter_csv_export(conn, query, rows_per_chunk=500):
+    cursor = conn.execute(query)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column[0] for column in cursor.description])
+    while True:
+        rows = cursor.fetchmany(rows_per_chunk)
+        if not rows:
+            break
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_response(kind):
+    conn = get_db_connection()
+    return Response(
+        stream_with_context(iter_csv_export(conn, EXPORT_QUERIES[kind])),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={kind}.csv'},
+    )
+
+
+def detect_format(filename, requested=None):
+    if requested:
+        return requested.lower()
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else 'csv'
+    return 'json' if extension in ('json', 'jsonl', 'ndjson') else 'csv'
+
+
+def init_app(app):
+    for kind in IMPORTERS:
+        app.cli.add_command(_import_command(kind))
+
+
+def _import_command(kind):
+    @click.command(f'import-{kind}')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'fmt', type=click.Choice(['csv', 'json']), default=None)
+    @click.option('--batch-size', type=int, default=BATCH_SIZE, show_default=True)
+    @with_appcontext
+    def command(path, fmt, batch_size):
+        with open(path, newline='', encoding='utf-8-sig') as stream:
+            records = iter_records(stream, detect_format(path, fmt))
+            report = IMPORTERS[kind](get_db_connection(), records, batch_size)
+        click.echo(f'{report.inserted} of {report.processed} records imported, {report.failed} failed.')
+        for error in report.errors:
+            click.echo(f"  record {error['row']}: {error['error']}")
+
+    command.help = f'Import {kind} from a CSV or JSON file.'
+    return command
@@ -0,0 +1,181 @@
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+
+from db import get_db_connection
+
+# Dropdown reference lists. They change rarely, and every write route that touches one of
+# these tables must call invalidate() with its name after committing.
+REFERENCE_QUERIES = {
+    'suppliers': 'SELECT * FROM Suppliers',
+    'customers': 'SELECT * FROM Customers',
+    'categories': 'SELECT * FROM Categories',
+    'warehouses': 'SELECT * FROM Warehouses',
+}
+
+
+class MemoryBackend:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileBackend:
+    # Shared by every worker process on the host: one pickle file per key, replaced atomically,
+    # so an invalidation in one worker is seen by all of them on their next read.
+    def __init__(self, directory, max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.cache')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires_at, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires_at < time.time():
+            return None
+        return expires_at, value
+
+    def set(self, key, value, ttl):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((time.time() + ttl, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        files = [name for name in os.listdir(self.directory) if name.endswith('.cache')]
+        if len(files) <= self.max_entries:
+            return
+        files.sort(key=lambda name: os.path.getmtime(os.path.join(self.directory, name)))
+        for name in files[:len(files) - self.max_entries]:
+            self.delete(name[:-len('.cache')])
+            self.evictions += 1
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                self.delete(name[:-len('.cache')])
+
+
+class ReferenceCache:
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        entry = self.backend.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        with self._lock:
+            generation = self._generations.get(key, 0)
+        value = loader()
+        # Don't store a value that was loaded while an invalidation for the key happened
+        with self._lock:
+            if self._generations.get(key, 0) == generation:
+                self.backend.set(key, value, self.ttl)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._generations[key] = self._generations.get(key, 0) + 1
+                self.backend.delete(key)
+                self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+            'invalidations': self.invalidations,
+            'evictions': self.backend.evictions,
+        }
+
+
+def _cache():
+    return current_app.extensions['reference_cache']
+
+
+def get_reference(name):
+    def load():
+        rows = get_db_connection().execute(REFERENCE_QUERIES[name]).fetchall()
+        return [dict(row) for row in rows]
+    return _cache().get_or_load(name, load)
+
+
+def invalidate(*names):
+    # Background job processes have no app; their dispatcher invalidates once the job is done
+    if has_app_context():
+        _cache().invalidate(*names)
+
+
+def cache_stats():
+    return _cache().stats()
+
+
+def init_app(app):
+    app.config.setdefault('REFERENCE_CACHE_TTL', 300)
+    app.config.setdefault('REFERENCE_CACHE_SIZE', 64)
+    app.config.setdefault('REFERENCE_CACHE_DIR', None)
+    if app.config['REFERENCE_CACHE_DIR']:
+        backend = FileBackend(app.config['REFERENCE_CACHE_DIR'], app.config['REFERENCE_CACHE_SIZE'])
+    else:
+        backend = MemoryBackend(app.config['REFERENCE_CACHE_SIZE'])
+    app.extensions['reference_cache'] = ReferenceCache(backend, app.config['REFERENCE_CACHE_TTL'])
@@ -0,0 +1,317 @@
+import copy
+import math
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from flask import current_app
+
+import db
+
+# In-process index of item names for typeahead, so the order forms no longer render every
+# item into a <select>. Per item it keeps id, name and unit price in packed columns:
+#
+#   ids / prices      array('q') / array('d'), one slot per item, ordered by item_id
+#   names             all names joined into one str, sliced by name_offsets
+#   folded            the same names case-folded and '\n'-joined, sliced by folded_offsets
+#   name_starts       offsets into folded of every name, sorted by the text there
+#   word_starts       the same for every word start
+#
+# A query is a bisect over name_starts, then over word_starts for the rest of the page, so
+# "lin" lists "Linen Cloth" first and "clo" still finds it. At 100k items this is
+# a few MB instead of a tuple per row, and a suggestion takes microseconds.
+#
+# The packed columns are immutable. Items changed since the build (by Items.updated_at) go
+# into a small overlay that is searched linearly and shadows the packed rows; once it grows
+# past CATALOG_OVERLAY_MAX, or rows were deleted, the index is rebuilt from the table.
+
+DEFAULTS = {
+    'CATALOG_PRELOAD': True,
+    'CATALOG_REFRESH_SECONDS': 1.0,
+    'CATALOG_OVERLAY_MAX': 2000,
+    'CATALOG_SUGGEST_LIMIT': 10,
+}
+MAX_SUGGEST_LIMIT = 50
+# Sort keys are compared on this many characters; longer queries are cut to it
+KEY_CHARS = 32
+# Bound on packed matches examined for one query, so "a z" can't walk the whole catalog
+MAX_SCAN = 5000
+# Re-read rows stamped up to this long before the last one seen, in case a transaction that
+# started earlier committed after the previous refresh
+LOOKBACK_SECONDS = 60
+
+MIGRATION = '''
+    CREATE INDEX IF NOT EXISTS idx_items_updated_at ON Items (updated_at);
+
+    CREATE TRIGGER IF NOT EXISTS trg_items_touch_updated_at AFTER UPDATE OF item_name, unit_price ON Items
+    WHEN NEW.updated_at IS OLD.updated_at
+    BEGIN
+        UPDATE Items SET updated_at = CURRENT_TIMESTAMP WHERE item_id = NEW.item_id;
+    END;
+'''
+
+ITEMS_QUERY = 'SELECT item_id, item_name, unit_price, updated_at FROM Items'
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def _fold(text):
+    return text.casefold().replace('\n', ' ')
+
+
+def _tokens(text):
+    return _WORD.findall(_fold(text))
+
+
+def _matches(folded_name, tokens):
+    # Every query word must be the start of a word in the name
+    words = _WORD.findall(folded_name)
+    return all(any(word.startswith(token) for word in words) for token in tokens)
+
+
+class PackedCatalog:
+    def __init__(self, rows):
+        rows = sorted(rows, key=lambda row: row[0])
+        self.ids = array('q', (row[0] for row in rows))
+        self.id_total = sum(self.ids)
+        self.prices = array('d', (math.nan if row[2] is None else row[2] for row in rows))
+        names = [row[1] or '' for row in rows]
+        self.names, self.name_offsets = self._join(names)
+        self.folded, self.folded_offsets = self._join([_fold(name) for name in names])
+        folded = self.folded
+        key = lambda start: folded[start:start + KEY_CHARS]  # noqa: E731
+        self.name_starts = array('I', sorted(self.folded_offsets[:-1], key=key))
+        self.word_starts = array('I', sorted((match.start() for match in _WORD.finditer(folded)), key=key))
+
+    @staticmethod
+    def _join(parts):
+        offsets = array('I', [0])
+        for part in parts:
+            offsets.append(offsets[-1] + len(part) + 1)
+        return '\n'.join(parts) + '\n', offsets
+
+    def __len__(self):
+        return len(self.ids)
+
+    def name(self, row):
+        return self.names[self.name_offsets[row]:self.name_offsets[row + 1] - 1]
+
+    def folded_name(self, row):
+        return self.folded[self.folded_offsets[row]:self.folded_offsets[row + 1] - 1]
+
+    def price(self, row):
+        price = self.prices[row]
+        return None if math.isnan(price) else price
+
+    def row_of(self, item_id):
+        row = bisect_left(self.ids, item_id)
+        return row if row < len(self.ids) and self.ids[row] == item_id else None
+
+    def prefix_rows(self, token, starts):
+        # Rows where one of starts begins with token, in order of the matching text
+        token = token[:KEY_CHARS]
+        folded, size = self.folded, len(token)
+        key = lambda start: folded[start:start + size]  # noqa: E731
+        low = bisect_left(starts, token, key=key)
+        high = bisect_right(starts, token, lo=low, key=key)
+        for index in range(low, min(high, low + MAX_SCAN)):
+            yield bisect_right(self.folded_offsets, starts[index]) - 1
+
+
+class CatalogIndex:
+    def __init__(self, rows, version):
+        self.packed = PackedCatalog((row[0], row[1], row[2]) for row in rows)
+        self.version = version
+        self.high_water = max((row[3] for row in rows if row[3]), default='')
+        self.checked_at = time.monotonic()
+        # item_id -> (name, folded name, price), for rows changed since the packed build
+        self.overlay = {}
+        self.built_at = time.time()
+
+    def __len__(self):
+        return len(self.packed) + sum(1 for item_id in self.overlay if self.packed.row_of(item_id) is None)
+
+    def suggest(self, query, limit):
+        tokens = _tokens(query)
+        if not tokens:
+            return []
+        results = []
+        seen = set()
+        overlay = self.overlay
+        packed = self.packed
+
+        if len(tokens) == 1 and tokens[0].isdigit():
+            # A number also matches the item id, listed first
+            item_id = int(tokens[0])
+            if item_id in overlay:
+                name, folded, price = overlay[item_id]
+                results.append((0, folded, item_id, name, price))
+                seen.add(item_id)
+            else:
+                row = packed.row_of(item_id)
+                if row is not None:
+                    results.append((0, packed.folded_name(row), item_id, packed.name(row), packed.price(row)))
+                    seen.add(item_id)
+
+        # Names that start with the first word rank before those matching a later word. For
+        # those, the longest word is the most selective one to look up; the rest filter.
+        for rank, lookup, starts in ((1, tokens[0], packed.name_starts),
+                                     (2, max(tokens, key=len), packed.word_starts)):
+            for row in packed.prefix_rows(lookup, starts):
+                if len(results) >= limit:
+                    break
+                item_id = packed.ids[row]
+                if item_id in seen or item_id in overlay:
+                    continue
+                folded = packed.folded_name(row)
+                if len(tokens) > 1 and not _matches(folded, tokens):
+                    continue
+                seen.add(item_id)
+                results.append((rank, folded, item_id, packed.name(row), packed.price(row)))
+
+        for item_id, (name, folded, price) in overlay.items():
+            if item_id not in seen and _matches(folded, tokens):
+                results.append((1 if folded.startswith(tokens[0]) else 2, folded, item_id, name, price))
+
+        results.sort(key=lambda result: result[:2])
+        return [{'item_id': item_id, 'item_name': name, 'unit_price': price}
+                for _, _, item_id, name, price in results[:limit]]
+
+    def stats(self):
+        packed = self.packed
+        nbytes = sum(column.itemsize * len(column) for column in (
+            packed.ids, packed.prices, packed.name_offsets, packed.folded_offsets, packed.name_starts,
+            packed.word_starts))
+        return {
+            'items': len(self),
+            'packed_items': len(packed),
+            'overlay_items': len(self.overlay),
+            'word_keys': len(packed.word_starts),
+            'approx_bytes': nbytes + len(packed.names.encode()) + len(packed.folded.encode()),
+            'built_at': self.built_at,
+            'version': self.version,
+        }
+
+
+def _items_version(conn):
+    row = conn.execute("SELECT version FROM TableVersions WHERE table_name = 'Items'").fetchone()
+    return row[0] if row else None
+
+
+def _checksum(conn):
+    row = conn.execute('SELECT COUNT(*), TOTAL(item_id) FROM Items').fetchone()
+    return row[0], row[1]
+
+
+def build(conn):
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    version = _items_version(conn)
+    return CatalogIndex(cursor.execute(ITEMS_QUERY).fetchall(), version)
+
+
+class Catalog:
+    # Holds the current CatalogIndex for one process and keeps it up to date. Readers take
+    # the reference and never see it change under them; refresh swaps in a new one.
+    def __init__(self, path, refresh_seconds, overlay_max):
+        self.path = path
+        self.refresh_seconds = refresh_seconds
+        self.overlay_max = overlay_max
+        self.index = None
+        self.builds = 0
+        self.refreshes = 0
+        self.build_seconds = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        return db.connect(self.path)
+
+    def rebuild(self, conn=None):
+        started = time.perf_counter()
+        own = conn is None
+        conn = conn or self._connect()
+        try:
+            index = build(conn)
+        finally:
+            if own:
+                conn.close()
+        self.index = index
+        self.builds += 1
+        self.build_seconds = time.perf_counter() - started
+        return index
+
+    def current(self):
+        index = self.index
+        if index is None:
+            with self._lock:
+                return self.index or self.rebuild()
+        if time.monotonic() - index.checked_at >= self.refresh_seconds and self._lock.acquire(blocking=False):
+            # One request refreshes; the others carry on with the index they have
+            try:
+                index = self.refresh(index)
+            finally:
+                self._lock.release()
+        return index
+
+    def refresh(self, index):
+        conn = self._connect()
+        try:
+            index.checked_at = time.monotonic()
+            version = _items_version(conn)
+            if version == index.version:
+                return index
+            self.refreshes += 1
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            changed = cursor.execute(ITEMS_QUERY + " WHERE updated_at >= datetime(?, ?)",
+                                     (index.high_water, f'-{LOOKBACK_SECONDS} seconds')).fetchall()
+            overlay = dict(index.overlay)
+            for item_id, name, price, _ in changed:
+                row = index.packed.row_of(item_id)
+                if row is not None and index.packed.name(row) == name and index.packed.price(row) == price:
+                    overlay.pop(item_id, None)
+                    continue
+                overlay[item_id] = (name or '', _fold(name or ''), price)
+            added = [item_id for item_id in overlay if index.packed.row_of(item_id) is None]
+            expected = (len(index.packed) + len(added), float(index.packed.id_total + sum(added)))
+            # Deleted rows (or rows inserted with an old timestamp) show up as a checksum
+            # mismatch; so does an overlay too large to search linearly
+            if len(overlay) > self.overlay_max or _checksum(conn) != expected:
+                return self.rebuild(conn)
+            updated = copy.copy(index)
+            updated.overlay = overlay
+            updated.version = version
+            updated.high_water = max([index.high_water] + [row[3] for row in changed if row[3]])
+            self.index = updated
+            return updated
+        finally:
+            conn.close()
+
+    def stats(self):
+        index = self.index
+        stats = {'builds': self.builds, 'refreshes': self.refreshes,
+                 'build_seconds': round(self.build_seconds, 4) if self.build_seconds is not None else None}
+        if index is not None:
+            stats.update(index.stats())
+        return stats
+
+
+def get_catalog():
+    return current_app.extensions['catalog']
+
+
+def suggest(query, limit=None):
+    limit = limit or current_app.config['CATALOG_SUGGEST_LIMIT']
+    return get_catalog().current().suggest(query, min(limit, MAX_SUGGEST_LIMIT))
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    catalog = Catalog(app.config.get('DATABASE', db.DATABASE), app.config['CATALOG_REFRESH_SECONDS'],
+                      app.config['CATALOG_OVERLAY_MAX'])
+    app.extensions['catalog'] = catalog
+    if app.config['CATALOG_PRELOAD']:
+        catalog.rebuild()
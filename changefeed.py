@@ -0,0 +1,291 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+
+from flask import current_app
+
+import db
+
+# Live updates for the dashboards left open on wall screens, over server-sent events.
+#
+# Triggers on Items, Stock, SalesOrders and SalesOrderDetails write the key of every changed
+# item or order into ChangeLog along with a global change version. A key keeps only its latest
+# version, so the log never holds more rows than there are items and orders. Stock and line
+# changes are logged against their item or order, which is what the pages show.
+#
+# One poller thread per process reads the log past the last version it saw, loads the
+# changed rows in one query per topic, formats each event once and hands it to every
+# subscribed /stream. Fifty open dashboards then cost a query per change instead of fifty
+# page reloads. The poller runs only while someone is subscribed.
+#
+# Events carry the version as their id. A client that reconnects (Last-Event-ID) or that
+# passes the version its page was rendered at (?since=) gets what it missed from the recent
+# events kept in memory, or a reset telling it to reload. So does a subscriber that falls
+# too far behind, and everyone after a burst of more than CHANGEFEED_MAX_ROWS changes.
+
+DEFAULTS = {
+    'CHANGEFEED_POLL_INTERVAL': 1.0,
+    'CHANGEFEED_KEEPALIVE': 15,
+    'CHANGEFEED_BACKLOG': 256,
+    'CHANGEFEED_QUEUE_SIZE': 64,
+    'CHANGEFEED_MAX_ROWS': 1000,
+    # Log rows this many versions behind the newest are pruned, a few times a minute
+    'CHANGEFEED_RETAIN': 100000,
+}
+PRUNE_SECONDS = 20
+
+# topic -> the ChangeLog table_name it follows
+TOPICS = {'inventory': 'Items', 'sales_orders': 'SalesOrders'}
+
+# (table, log as, key columns): Stock rows and order lines are logged against their parent
+LOGGED = (
+    ('Items', 'Items', ('item_id',)),
+    ('Stock', 'Items', ('item_id',)),
+    ('SalesOrders', 'SalesOrders', ('so_id',)),
+    ('SalesOrderDetails', 'SalesOrders', ('so_id',)),
+)
+
+
+def migration(conn):
+    statements = ['''
+        CREATE TABLE IF NOT EXISTS ChangeFeedState (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO ChangeFeedState (id, version) VALUES (1, 0);
+        CREATE TABLE IF NOT EXISTS ChangeLog (
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (table_name, row_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_change_log_version ON ChangeLog (version);
+    ''']
+    for table, logged_as, (key,) in LOGGED:
+        for event, rows in (('INSERT', ('NEW',)), ('UPDATE', ('NEW', 'OLD')), ('DELETE', ('OLD',))):
+            inserts = []
+            for row in rows:
+                # An update logs the old key too when the row moved to another item or order
+                condition = f'{row}.{key} IS NOT NULL' + (f' AND OLD.{key} IS NOT NEW.{key}' if row == 'OLD' and
+                                                          event == 'UPDATE' else '')
+                inserts.append(f'''
+                    INSERT OR REPLACE INTO ChangeLog (table_name, row_id, version)
+                    SELECT '{logged_as}', {row}.{key}, version FROM ChangeFeedState WHERE id = 1 AND {condition};''')
+            statements.append(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_changelog_{table.lower()}_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    UPDATE ChangeFeedState SET version = version + 1 WHERE id = 1;{''.join(inserts)}
+                END;
+            ''')
+    return '\n'.join(statements)
+
+
+# Same columns as the pages' rows; the keys to load are in temp.changefeed_keys
+ROW_QUERIES = {
+    'inventory': '''
+        SELECT Items.item_id, Items.item_name, Items.description,
+               Categories.category_name, Suppliers.supplier_name,
+               Items.unit_price, Items.reorder_level,
+               IFNULL(ItemStockTotals.total_qty, 0) AS total_stock
+        FROM Items
+        LEFT JOIN Categories ON Items.category_id = Categories.category_id
+        LEFT JOIN Suppliers ON Items.supplier_id = Suppliers.supplier_id
+        LEFT JOIN ItemStockTotals ON Items.item_id = ItemStockTotals.item_id
+        WHERE Items.item_id IN (SELECT row_id FROM temp.changefeed_keys)
+    ''',
+    'sales_orders': '''
+        SELECT so.so_id, c.customer_name, so.order_date, so.status,
+               IFNULL(SUM(sod.quantity_sold), 0) AS total_items,
+               IFNULL(SUM(sod.quantity_sold * sod.unit_price), 0) AS total_value
+        FROM SalesOrders so
+        LEFT JOIN Customers c ON so.customer_id = c.customer_id
+        LEFT JOIN SalesOrderDetails sod ON so.so_id = sod.so_id
+        WHERE so.so_id IN (SELECT row_id FROM temp.changefeed_keys)
+        GROUP BY so.so_id
+    ''',
+}
+ROW_KEYS = {'inventory': 'item_id', 'sales_orders': 'so_id'}
+
+# since: the version before the event; text: the formatted message; topic None goes to everyone
+Event = namedtuple('Event', 'since version topic text')
+
+
+def _message(version, event, data):
+    return f'id: {version}\nevent: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+def reset_message(version):
+    return _message(version, 'reset', {'version': version})
+
+
+def current_version(conn):
+    row = conn.execute('SELECT version FROM ChangeFeedState WHERE id = 1').fetchone()
+    return row[0] if row else 0
+
+
+class Subscription:
+    def __init__(self, topics, size):
+        self.topics = frozenset(topics)
+        self.queue = queue.Queue(size)
+        # Set when an event didn't fit; the stream then tells the client to reload
+        self.overflowed = False
+
+    def wants(self, event):
+        return event.topic is None or event.topic in self.topics
+
+    def offer(self, text):
+        try:
+            self.queue.put_nowait(text)
+        except queue.Full:
+            self.overflowed = True
+
+
+class ChangeFeed:
+    def __init__(self, path, poll_interval=1.0, backlog=256, queue_size=64, max_rows=1000, retain=100000):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.max_rows = max_rows
+        self.retain = retain
+        self.version = None
+        self.recent = deque(maxlen=backlog)
+        self.polls = 0
+        self.events = 0
+        self.resets = 0
+        self.last_error = None
+        self._subscribers = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics, since=None):
+        subscription = Subscription(topics, self.queue_size)
+        with self._lock:
+            if self._thread is None:
+                conn = db.connect(self.path)
+                # A fresh start: nothing older than now is known
+                self.version = current_version(conn)
+                self.recent.clear()
+                self._thread = threading.Thread(target=self._run, args=(conn,), name='changefeed', daemon=True)
+                self._thread.start()
+            self._subscribers.add(subscription)
+            if since is not None and since < self.version:
+                self._catch_up(subscription, since)
+        return subscription
+
+    def _catch_up(self, subscription, since):
+        if not self.recent or self.recent[0].since > since:
+            subscription.offer(reset_message(self.version))
+            return
+        for event in self.recent:
+            if event.version > since and subscription.wants(event):
+                subscription.offer(event.text)
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def _run(self, conn):
+        pruned = time.monotonic()
+        try:
+            while True:
+                time.sleep(self.poll_interval)
+                with self._lock:
+                    if not self._subscribers:
+                        self._thread = None
+                        return
+                try:
+                    self.poll(conn)
+                    if time.monotonic() - pruned >= PRUNE_SECONDS:
+                        pruned = time.monotonic()
+                        self.prune(conn)
+                except sqlite3.Error as exc:
+                    self.last_error = str(exc)
+        finally:
+            conn.close()
+
+    def poll(self, conn):
+        self.polls += 1
+        since = self.version
+        changes = conn.execute(
+            'SELECT table_name, row_id, version FROM ChangeLog WHERE version > ? ORDER BY version LIMIT ?',
+            (since, self.max_rows + 1)).fetchall()
+        if not changes:
+            return
+        if len(changes) > self.max_rows:
+            # Too much to push row by row (a bulk import): every page reloads once instead
+            version = current_version(conn)
+            self._publish([Event(since, version, None, reset_message(version))])
+            self.resets += 1
+            return
+        version = changes[-1]['version']
+        events = []
+        for topic, table in TOPICS.items():
+            keys = [row['row_id'] for row in changes if row['table_name'] == table]
+            if keys:
+                rows = self._load(conn, topic, keys)
+                found = {row[ROW_KEYS[topic]] for row in rows}
+                data = {'version': version, 'rows': rows, 'deleted': [key for key in keys if key not in found]}
+                events.append(Event(since, version, topic, _message(version, topic, data)))
+        self._publish(events)
+
+    def _load(self, conn, topic, keys):
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS changefeed_keys (row_id INTEGER PRIMARY KEY)')
+        conn.execute('DELETE FROM temp.changefeed_keys')
+        conn.executemany('INSERT INTO temp.changefeed_keys (row_id) VALUES (?)', ((key,) for key in keys))
+        return [dict(row) for row in conn.execute(ROW_QUERIES[topic])]
+
+    def _publish(self, events):
+        with self._lock:
+            for event in events:
+                self.recent.append(event)
+                for subscription in self._subscribers:
+                    if subscription.wants(event):
+                        subscription.offer(event.text)
+                self.events += 1
+            if events:
+                self.version = events[-1].version
+
+    def prune(self, conn):
+        with conn:
+            conn.execute('DELETE FROM ChangeLog WHERE version <= ?', (self.version - self.retain,))
+
+    def stats(self):
+        with self._lock:
+            return {'running': self._thread is not None, 'subscribers': len(self._subscribers),
+                    'version': self.version, 'polls': self.polls, 'events': self.events, 'resets': self.resets,
+                    'recent': len(self.recent), 'last_error': self.last_error}
+
+
+def get_feed():
+    return current_app.extensions['changefeed']
+
+
+def iter_events(topics, since=None):
+    # Server-sent events for one client until it disconnects. Blocks on its own queue between
+    # events; the shared poller does the database work.
+    feed = get_feed()
+    keepalive = current_app.config['CHANGEFEED_KEEPALIVE']
+    subscription = feed.subscribe(topics, since)
+    try:
+        yield f'retry: {int(feed.poll_interval * 3000)}\n\n'
+        while not subscription.overflowed or not subscription.queue.empty():
+            try:
+                yield subscription.queue.get(timeout=keepalive)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+        feed.resets += 1
+        yield reset_message(feed.version)
+    finally:
+        feed.unsubscribe(subscription)
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.extensions['changefeed'] = ChangeFeed(
+        app.config.get('DATABASE', db.DATABASE), app.config['CHANGEFEED_POLL_INTERVAL'],
+        app.config['CHANGEFEED_BACKLOG'], app.config['CHANGEFEED_QUEUE_SIZE'], app.config['CHANGEFEED_MAX_ROWS'],
+        app.config['CHANGEFEED_RETAIN'])
@@ -0,0 +1,249 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g, has_app_context
+
+DATABASE = os.environ.get(
+    'INVENTORY_DATABASE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inventory.db'),
+)
+
+DEFAULTS = {
+    'DATABASE': DATABASE,
+    'DB_POOL_SIZE': 8,
+    'DB_POOL_TIMEOUT': 10.0,
+    'DB_BUSY_TIMEOUT_MS': 5000,
+    'DB_CACHE_SIZE_KB': 20000,
+    'DB_MMAP_SIZE': 256 * 1024 * 1024,
+    'DB_SYNCHRONOUS': 'NORMAL',
+}
+
+
+def _setting(name):
+    if has_app_context():
+        return current_app.config.get(name, DEFAULTS[name])
+    return DEFAULTS[name]
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    # Fetch time is charged to the statement that produced the rows
+    record = None
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def _timed(self, fetch, *args):
+        profile = self.connection.profile
+        if profile is None or self.record is None:
+            return fetch(*args)
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            profile.add_fetch(self.record, time.perf_counter() - started)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    # get_db_connection() sets profile for the length of a request; while it is None the
+    # overhead is one attribute check per execute.
+    profile = None
+    generation = 0
+
+    def execute(self, sql, parameters=()):
+        profile = self.profile
+        if profile is None:
+            return super().execute(sql, parameters)
+        cursor = self.cursor(ProfiledCursor)
+        started = time.perf_counter()
+        try:
+            cursor.execute(sql, parameters)
+        finally:
+            cursor.record = profile.add_statement(sql, parameters, time.perf_counter() - started)
+        return cursor
+
+    def executemany(self, sql, seq_of_parameters):
+        profile = self.profile
+        if profile is None:
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            profile.add_statement(sql, None, time.perf_counter() - started)
+
+
+def connect(path=None):
+    conn = sqlite3.connect(path or _setting('DATABASE'), check_same_thread=False, factory=ProfiledConnection)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {int(_setting('DB_BUSY_TIMEOUT_MS'))}")
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f"PRAGMA synchronous = {_setting('DB_SYNCHRONOUS')}")
+    # Negative cache_size is in KiB rather than pages
+    conn.execute(f"PRAGMA cache_size = -{int(_setting('DB_CACHE_SIZE_KB'))}")
+    conn.execute(f"PRAGMA mmap_size = {int(_setting('DB_MMAP_SIZE'))}")
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+class ConnectionPool:
+    def __init__(self, path, max_size, timeout, connector=None):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.connector = connector or connect
+        # recycle() bumps the generation; older connections are closed instead of reused
+        self.generation = 0
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+    def acquire(self):
+        with self._lock:
+            self.checkouts += 1
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                if conn.generation == self.generation:
+                    return conn
+                conn.close()
+                self._open -= 1
+            if self._open < self.max_size:
+                self._open += 1
+                create = True
+            else:
+                self.waits += 1
+                create = False
+
+        if create:
+            try:
+                conn = self.connector(self.path)
+                conn.generation = self.generation
+                return conn
+            except Exception:
+                with self._lock:
+                    self._open -= 1
+                raise
+
+        started = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self.timeouts += 1
+            raise RuntimeError(f'No database connection available after {self.timeout}s')
+        with self._lock:
+            self.wait_seconds += time.perf_counter() - started
+        if conn.generation != self.generation:
+            self.discard(conn)
+            return self.acquire()
+        return conn
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self.discard(conn)
+            return
+        if conn.generation != self.generation:
+            self.discard(conn)
+            return
+        self._idle.put(conn)
+
+    def recycle(self):
+        with self._lock:
+            self.generation += 1
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        finally:
+            with self._lock:
+                self._open -= 1
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_size': self.max_size,
+                'open': self._open,
+                'idle': self._idle.qsize(),
+                'in_use': self._open - self._idle.qsize(),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_seconds': round(self.wait_seconds, 6),
+                'timeouts': self.timeouts,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(app=None):
+    app = app or current_app._get_current_object()
+    path = app.config.get('DATABASE', DATABASE)
+    with _pools_lock:
+        pool = _pools.get(path)
+        # A pool inherited across fork (e.g. gunicorn --preload) must not reuse the parent's handles
+        if pool is None or pool.pid != os.getpid():
+            pool = ConnectionPool(
+                path,
+                app.config.get('DB_POOL_SIZE', DEFAULTS['DB_POOL_SIZE']),
+                app.config.get('DB_POOL_TIMEOUT', DEFAULTS['DB_POOL_TIMEOUT']),
+            )
+            _pools[path] = pool
+        return pool
+
+
+def get_db_connection():
+    # Outside a request/app context (scripts) callers own the connection and must close it
+    if not has_app_context():
+        return connect()
+    if 'db_conn' not in g:
+        g.db_conn = get_pool().acquire()
+        profile = g.get('request_profile')
+        if profile is not None:
+            profile.attach(g.db_conn)
+    return g.db_conn
+
+
+def release_db_connection(exception=None):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        if conn.profile is not None:
+            conn.profile.detach(conn)
+        get_pool().release(conn)
+
+
+def pool_stats():
+    return get_pool().stats()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.teardown_appcontext(release_db_connection)
@@ -0,0 +1,89 @@
+import zlib
+
+from flask import current_app
+from markupsafe import Markup
+
+import cache
+import versions
+
+# Rendered HTML of the long per-row tables (inventory page, sales orders, performance),
+# cached under a key built from the data behind it: TableVersions for the base tables, the
+# reporting high-water mark for summaries, the job id for a stored report. A page view after
+# nothing changed then skips the query and the template loop; after a change the key is new
+# and the old entry ages out. Templates wrap the block:
+#
+#   {% call cached(fragment_key) %} ... {% endcall %}
+#
+# and views pass rows as Lazy(...), so the query only runs when the block is rendered.
+# Entries are zlib-compressed: a 40k-row table is megabytes of markup but compresses ~10x.
+
+DEFAULTS = {
+    'FRAGMENT_CACHE': True,
+    'FRAGMENT_CACHE_TTL': 600,
+    'FRAGMENT_CACHE_SIZE': 64,
+    'FRAGMENT_CACHE_DIR': None,
+}
+COMPRESS_LEVEL = 1
+
+
+class Lazy:
+    # Loads on first use; iterates and exposes attributes of what load() returned
+    def __init__(self, load):
+        self._load = load
+        self._loaded = False
+        self._value = None
+
+    @property
+    def value(self):
+        if not self._loaded:
+            self._value = self._load()
+            self._loaded = True
+        return self._value
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.value, name)
+
+
+def key(conn, name, tables, *extra):
+    # Changes whenever one of tables does, or any of extra
+    return f'fragment-{name}-{versions.fingerprint(conn, tables, name, *extra)[0]}'
+
+
+def _cache():
+    return current_app.extensions['fragment_cache']
+
+
+def cached(fragment_key, caller):
+    if fragment_key is None or not current_app.config['FRAGMENT_CACHE']:
+        return caller()
+    rendered = []
+
+    def render():
+        rendered.append(str(caller()))
+        return zlib.compress(rendered[0].encode(), COMPRESS_LEVEL)
+
+    packed = _cache().get_or_load(fragment_key, render)
+    return Markup(rendered[0] if rendered else zlib.decompress(packed).decode())
+
+
+def fragment_stats():
+    return _cache().stats()
+
+
+def init_app(app):
+    for setting, value in DEFAULTS.items():
+        app.config.setdefault(setting, value)
+    if app.config['FRAGMENT_CACHE_DIR']:
+        backend = cache.FileBackend(app.config['FRAGMENT_CACHE_DIR'], app.config['FRAGMENT_CACHE_SIZE'])
+    else:
+        backend = cache.MemoryBackend(app.config['FRAGMENT_CACHE_SIZE'])
+    app.extensions['fragment_cache'] = cache.ReferenceCache(backend, app.config['FRAGMENT_CACHE_TTL'])
+    app.jinja_env.globals['cached'] = cached
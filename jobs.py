@@ -0,0 +1,538 @@
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+import archive
+import bulk
+import changefeed
+import db
+import planning
+import replica
+import reporting
+import versions
+from db import get_db_connection
+
+# Heavy reports and bulk imports run as rows in the Jobs table instead of inside the request.
+# A dispatcher thread claims queued rows and runs each one in a worker process, which writes
+# progress and the JSON result back to the row. Report results carry a cache key built from
+# TableVersions, so a finished report is reused until a table it reads changes. SQLite is
+# the only broker: any process on the host can enqueue, and `flask jobs worker` can run the
+# pool outside the web server.
+
+MIGRATION = '''
+    CREATE TABLE IF NOT EXISTS Jobs (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        params TEXT NOT NULL DEFAULT '{}',
+        cache_key TEXT,
+        status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed')),
+        progress REAL NOT NULL DEFAULT 0,
+        message TEXT,
+        result TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        user_id INTEGER,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        heartbeat_at REAL,
+        finished_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_jobs_status ON Jobs (status, job_id);
+    CREATE INDEX IF NOT EXISTS idx_jobs_kind_cache_key ON Jobs (kind, cache_key);
+'''
+
+# One queued, running or finished job per report key, so submit() can insert without a lock
+# held across its lookup. Any older duplicates give up their key first.
+UNIQUE_CACHE_KEY_MIGRATION = '''
+    UPDATE Jobs SET cache_key = NULL
+    WHERE cache_key IS NOT NULL AND status != 'failed' AND job_id < (
+        SELECT MAX(j.job_id) FROM Jobs j
+        WHERE j.kind = Jobs.kind AND j.cache_key = Jobs.cache_key AND j.status != 'failed');
+    DROP INDEX IF EXISTS idx_jobs_kind_cache_key;
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_cache_key ON Jobs (kind, cache_key) WHERE status != 'failed';
+'''
+
+TERMINAL = ('done', 'failed')
+MAX_ATTEMPTS = 3
+# Progress writes from a job are throttled to one per interval
+PROGRESS_INTERVAL = 0.5
+RECORDS_PER_PROGRESS = 1000
+PARSED_RESULTS = 8
+
+# run(conn, params, progress) -> JSON-serialisable result. tables: what a result is derived
+# from, or None for jobs whose result is never reused.
+JobType = namedtuple('JobType', 'run tables', defaults=(None,))
+
+
+class JobError(ValueError):
+    pass
+
+
+_results = OrderedDict()
+_results_lock = threading.Lock()
+
+
+def _report(build):
+    def run(conn, params, progress):
+        progress(0.1, 'Refreshing summaries')
+        reporting.ensure_fresh(conn, params.get('max_staleness', 0))
+        progress(0.5, 'Reading summaries')
+        return _build(build, conn, params)
+    return run
+
+
+def _build(build, conn, params):
+    # params['archive_dir'] asks for archived orders too (performance only); it is passed
+    # in because worker processes have no app config to find it from
+    directory = params.get('archive_dir')
+    # Read before the data, so live updates to the page resume from no later than it shows
+    live_since = changefeed.current_version(conn)
+    with archive.attached(conn, directory, enabled=bool(directory)) as schemas:
+        if not schemas:
+            data = build(conn)
+        else:
+            data = build(conn, archive.union(conn, 'SalesOrderSummary', schemas))
+    return dict(data, live_since=live_since)
+
+
+def _import(conn, params, progress):
+    path = params['path']
+    try:
+        size = os.path.getsize(path) or 1
+        with open(path, 'rb') as raw:
+            stream = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+
+            def records():
+                for number, record in enumerate(bulk.iter_records(stream, params['format']), start=1):
+                    if number % RECORDS_PER_PROGRESS == 0:
+                        progress(raw.tell() / size, f'{number} records read')
+                    yield record
+
+            return bulk.IMPORTERS[params['kind']](conn, records()).as_dict()
+    finally:
+        os.remove(path)
+
+
+def _planning(conn, params, progress):
+    return planning.plan(conn, params.get('as_of'), params['options'], params.get('apply', False), progress)
+
+
+REPORT_TABLES = ('Categories', 'Items', 'Stock', 'Customers', 'SalesOrders', 'SalesOrderDetails')
+
+REPORT_BUILDERS = {'reports': reporting.reports_data, 'performance': reporting.performance_data}
+
+JOB_TYPES = {
+    'reports': JobType(_report(REPORT_BUILDERS['reports']), REPORT_TABLES),
+    'performance': JobType(_report(REPORT_BUILDERS['performance']), REPORT_TABLES),
+    'import': JobType(_import),
+    'planning': JobType(_planning),
+}
+
+
+def _params_text(params):
+    return json.dumps(params or {}, sort_keys=True)
+
+
+def _cache_key(conn, kind, params_text):
+    tables = JOB_TYPES[kind].tables
+    if tables is None:
+        return None
+    return versions.fingerprint(conn, tables, kind, params_text)[0]
+
+
+def get_job(conn, job_id):
+    return conn.execute('SELECT * FROM Jobs WHERE job_id = ?', (job_id,)).fetchone()
+
+
+def job_result(job):
+    # Finished results never change, so the parsed form of the last few is kept per process
+    if job['result'] is None:
+        return None
+    with _results_lock:
+        if job['job_id'] in _results:
+            _results.move_to_end(job['job_id'])
+            return _results[job['job_id']]
+    result = json.loads(job['result'])
+    with _results_lock:
+        _results[job['job_id']] = result
+        while len(_results) > PARSED_RESULTS:
+            _results.popitem(last=False)
+    return result
+
+
+def job_info(job):
+    info = {key: job[key] for key in ('job_id', 'kind', 'status', 'progress', 'message', 'error',
+                                      'created_at', 'started_at', 'finished_at')}
+    if job['status'] == 'done':
+        info['result'] = job_result(job)
+    return info
+
+
+def _job_for_key(conn, kind, cache_key):
+    if cache_key is None:
+        return None
+    return conn.execute('''
+        SELECT * FROM Jobs WHERE kind = ? AND cache_key = ? AND status != 'failed'
+        ORDER BY job_id DESC LIMIT 1
+    ''', (kind, cache_key)).fetchone()
+
+
+def submit(conn, kind, params=None, user_id=None):
+    # Returns the job row that will answer this request: a finished run whose tables haven't
+    # changed since, one already queued or running for the same data, or a new queued one.
+    if kind not in JOB_TYPES:
+        raise JobError(f'Unknown job type: {kind}')
+    params_text = _params_text(params)
+    cache_key = _cache_key(conn, kind, params_text)
+    # A plain read first, so serving a finished result takes no write lock
+    job = _job_for_key(conn, kind, cache_key)
+    if job is None:
+        with conn:
+            # idx_jobs_cache_key allows one live job per key: when a concurrent request has
+            # just inserted it, this insert is ignored and its job is the one answered
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO Jobs (kind, params, cache_key, user_id, created_at) VALUES (?, ?, ?, ?, ?)
+            ''', (kind, params_text, cache_key, user_id, time.time()))
+        job = get_job(conn, cursor.lastrowid) if cursor.rowcount else _job_for_key(conn, kind, cache_key)
+    if job['status'] == 'queued':
+        _wake_dispatcher()
+    return job
+
+
+def latest_result(conn, kind, params=None):
+    # The newest finished run for these parameters, however stale
+    return conn.execute('''
+        SELECT * FROM Jobs WHERE kind = ? AND params = ? AND status = 'done'
+        ORDER BY job_id DESC LIMIT 1
+    ''', (kind, _params_text(params))).fetchone()
+
+
+def _keyed_result(job):
+    # data['result_key'] names this exact result, for caching what is rendered from it
+    return dict(job_result(job), result_key=f"job-{job['job_id']}")
+
+
+def fetch_report(kind, job_id=None, params=None):
+    # For report views: (data, pending_job). data is None until a first run has finished;
+    # pending_job is set while a newer run is on its way. With JOB_QUEUE off the report is
+    # computed in the request as before: summaries are refreshed on the primary, then read
+    # through the read router. Reads served from the snapshot skip the refresh, which
+    # couldn't reach them.
+    conn = get_db_connection()
+    if not current_app.config['JOB_QUEUE']:
+        read_conn = replica.get_read_connection()
+        if replica.read_source()['source'] != 'snapshot':
+            reporting.ensure_fresh(conn)
+        # Taken before the read, so a write in between can only make the key older than the data
+        result_key = 'inline-{}-{}'.format(_cache_key(read_conn, kind, _params_text(params)),
+                                           reporting.status(read_conn)['high_water_mark'])
+        data = _build(REPORT_BUILDERS[kind], read_conn, params or {})
+        return dict(data, result_key=result_key), None
+    if job_id is not None:
+        # Requested by the pending page once its job finished: show that run even if the
+        # tables have moved on since, or a busy database would keep the page waiting forever
+        job = get_job(conn, job_id)
+        if job is not None and job['kind'] == kind and job['status'] == 'done':
+            return _keyed_result(job), None
+    job = submit(conn, kind, params)
+    if job['status'] == 'done':
+        return _keyed_result(job), None
+    previous = latest_result(conn, kind, params)
+    return (_keyed_result(previous) if previous else None), job
+
+
+def iter_events(job_id, poll_interval, keepalive=15):
+    # Server-sent events for one job, a message whenever its progress or status changes. A
+    # pooled connection is borrowed per poll so open streams don't pin the pool.
+    pool = db.get_pool()
+    last = None
+    last_sent = time.monotonic()
+    while True:
+        conn = pool.acquire()
+        try:
+            job = get_job(conn, job_id)
+        finally:
+            pool.release(conn)
+        if job is None:
+            return
+        info = job_info(job)
+        info.pop('result', None)
+        if info != last:
+            last = info
+            last_sent = time.monotonic()
+            yield f'data: {json.dumps(info)}\n\n'
+        elif time.monotonic() - last_sent >= keepalive:
+            last_sent = time.monotonic()
+            yield ': keepalive\n\n'
+        if job['status'] in TERMINAL:
+            return
+        time.sleep(poll_interval)
+
+
+def save_upload(upload):
+    directory = current_app.config['JOB_UPLOAD_DIR']
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, suffix='.upload')
+    with os.fdopen(fd, 'wb') as f:
+        upload.save(f)
+    return path
+
+
+class ProgressReporter:
+    # Runs in the worker process. Uses its own connection so progress commits never touch
+    # the transaction the job itself may have open.
+    def __init__(self, path, job_id):
+        self.path = path
+        self.job_id = job_id
+        self._conn = None
+        self._last = 0.0
+
+    def __call__(self, fraction, message=None):
+        now = time.monotonic()
+        if now - self._last < PROGRESS_INTERVAL:
+            return
+        self._last = now
+        if self._conn is None:
+            self._conn = db.connect(self.path)
+        with self._conn:
+            self._conn.execute('''
+                UPDATE Jobs SET progress = ?, message = ?, heartbeat_at = ? WHERE job_id = ?
+            ''', (min(max(fraction, 0.0), 1.0), message, time.time(), self.job_id))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+
+
+def run_job(path, job_id):
+    # Entry point in the worker process; no Flask app exists here
+    conn = db.connect(path)
+    progress = ProgressReporter(path, job_id)
+    try:
+        job = get_job(conn, job_id)
+        try:
+            result = JOB_TYPES[job['kind']].run(conn, json.loads(job['params']), progress)
+        except Exception as exc:
+            if conn.in_transaction:
+                conn.rollback()
+            _finish(conn, job, 'failed', error=f'{type(exc).__name__}: {exc}')
+            return False
+        _finish(conn, job, 'done', result=json.dumps(result))
+        return True
+    finally:
+        progress.close()
+        conn.close()
+
+
+def _finish(conn, job, status, result=None, error=None):
+    with conn:
+        conn.execute('''
+            UPDATE Jobs SET status = ?, result = ?, error = ?, progress = 1, message = NULL, finished_at = ?
+            WHERE job_id = ?
+        ''', (status, result, error, time.time(), job['job_id']))
+        if status == 'done' and job['cache_key'] is not None:
+            # Older results for the same report can no longer be served
+            conn.execute('''
+                DELETE FROM Jobs WHERE kind = ? AND params = ? AND status = 'done' AND job_id < ?
+            ''', (job['kind'], job['params'], job['job_id']))
+
+
+def claim(conn, limit):
+    now = time.time()
+    with conn:
+        return conn.execute('''
+            UPDATE Jobs SET status = 'running', started_at = ?, heartbeat_at = ?, attempts = attempts + 1
+            WHERE job_id IN (SELECT job_id FROM Jobs WHERE status = 'queued' ORDER BY job_id LIMIT ?)
+            RETURNING job_id, kind, params
+        ''', (now, now, limit)).fetchall()
+
+
+def requeue_stale(conn, stale_after):
+    # Jobs whose dispatcher stopped heartbeating (process killed) go back to the queue,
+    # unless they have already been tried MAX_ATTEMPTS times
+    cutoff = time.time() - stale_after
+    with conn:
+        conn.execute('''
+            UPDATE Jobs SET status = 'failed', error = 'Worker stopped responding', finished_at = ?
+            WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?
+        ''', (time.time(), cutoff, MAX_ATTEMPTS))
+        return conn.execute('''
+            UPDATE Jobs SET status = 'queued', progress = 0, message = NULL
+            WHERE status = 'running' AND heartbeat_at < ?
+        ''', (cutoff,)).rowcount
+
+
+def prune(conn, retention):
+    with conn:
+        return conn.execute(
+            'DELETE FROM Jobs WHERE status IN (?, ?) AND finished_at < ?',
+            TERMINAL + (time.time() - retention,)
+        ).rowcount
+
+
+class JobDispatcher:
+    def __init__(self, app, processes, poll_interval, stale_after, retention):
+        self.app = app
+        self.path = app.config['DATABASE']
+        self.processes = processes
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.retention = retention
+        self.completed = 0
+        self.failed = 0
+        self.last_error = None
+        self.wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='job-dispatcher', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.wake.set()
+
+    def _executor(self):
+        # spawn: forking a process that runs request threads can copy held locks
+        return ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def run(self):
+        conn = db.connect(self.path)
+        executor = self._executor()
+        running = {}
+        last_housekeeping = 0.0
+        try:
+            while not self._stop.is_set():
+                try:
+                    if time.monotonic() - last_housekeeping >= self.stale_after / 2:
+                        last_housekeeping = time.monotonic()
+                        requeue_stale(conn, self.stale_after)
+                        prune(conn, self.retention)
+                    if running:
+                        with conn:
+                            conn.executemany('UPDATE Jobs SET heartbeat_at = ? WHERE job_id = ?',
+                                             [(time.time(), job['job_id']) for job in running.values()])
+                    free = self.processes - len(running)
+                    for job in (claim(conn, free) if free else ()):
+                        running[executor.submit(run_job, self.path, job['job_id'])] = job
+                    self.last_error = None
+                except Exception as exc:
+                    self.last_error = repr(exc)
+
+                if running:
+                    done, _ = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                else:
+                    done = ()
+                    self.wake.wait(self.poll_interval)
+                    self.wake.clear()
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        succeeded = future.result()
+                    except BrokenProcessPool:
+                        # A worker died (e.g. out of memory); the stale check requeues its job
+                        executor.shutdown(wait=False)
+                        executor = self._executor()
+                        continue
+                    except Exception as exc:
+                        self.last_error = repr(exc)
+                        continue
+                    self._finished(job, succeeded)
+        finally:
+            executor.shutdown(cancel_futures=True)
+            conn.close()
+
+    def _finished(self, job, succeeded):
+        if not succeeded:
+            self.failed += 1
+            return
+        self.completed += 1
+
+    def stats(self):
+        return {'processes': self.processes, 'completed': self.completed,
+                'failed': self.failed, 'last_error': self.last_error}
+
+
+def _wake_dispatcher():
+    dispatcher = current_app.extensions.get('job_dispatcher')
+    if dispatcher is not None:
+        dispatcher.start()
+        dispatcher.wake.set()
+
+
+def queue_stats(conn):
+    counts = dict(conn.execute('SELECT status, COUNT(*) FROM Jobs GROUP BY status').fetchall())
+    dispatcher = current_app.extensions.get('job_dispatcher')
+    return {'jobs': {status: counts.get(status, 0) for status in ('queued', 'running', 'done', 'failed')},
+            'dispatcher': dispatcher.stats() if dispatcher else None}
+
+
+def _dispatcher(app, processes):
+    return JobDispatcher(app, processes, app.config['JOB_POLL_INTERVAL'],
+                         app.config['JOB_STALE_SECONDS'], app.config['JOB_RETENTION_SECONDS'])
+
+
+def init_app(app):
+    app.config.setdefault('JOB_QUEUE', True)
+    app.config.setdefault('JOB_WORKERS', 2)
+    app.config.setdefault('JOB_POLL_INTERVAL', 0.5)
+    app.config.setdefault('JOB_STALE_SECONDS', 60)
+    app.config.setdefault('JOB_RETENTION_SECONDS', 24 * 3600)
+    app.config.setdefault('JOB_UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'inventory-uploads'))
+    app.cli.add_command(jobs_command)
+
+    # JOB_WORKERS = 0 leaves the queue to a separate `flask jobs worker`
+    if app.config['JOB_QUEUE'] and app.config['JOB_WORKERS']:
+        dispatcher = _dispatcher(app, app.config['JOB_WORKERS'])
+        app.extensions['job_dispatcher'] = dispatcher
+        # Started by the first request so CLI commands don't spawn the pool
+        app.before_request(dispatcher.start)
+
+
+@click.group('jobs')
+def jobs_command():
+    """Run and inspect background jobs."""
+
+
+@jobs_command.command('worker')
+@click.option('--processes', type=int, default=None, help='Worker processes (default JOB_WORKERS or 2).')
+@with_appcontext
+def worker_command(processes):
+    app = current_app._get_current_object()
+    dispatcher = _dispatcher(app, processes or app.config['JOB_WORKERS'] or 2)
+    click.echo(f'Running jobs from {dispatcher.path} with {dispatcher.processes} processes.')
+    try:
+        dispatcher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+@jobs_command.command('list')
+@click.option('--status', type=click.Choice(['queued', 'running', 'done', 'failed']), default=None)
+@click.option('--limit', type=int, default=20, show_default=True)
+@with_appcontext
+def list_command(status, limit):
+    conn = get_db_connection()
+    rows = conn.execute('''
+        SELECT job_id, kind, status, progress, error, created_at FROM Jobs
+        WHERE ? IS NULL OR status = ? ORDER BY job_id DESC LIMIT ?
+    ''', (status, status, limit)).fetchall()
+    for row in rows:
+        created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['created_at']))
+        click.echo(f"{row['job_id']}\t{row['kind']}\t{row['status']}\t{row['progress']:.0%}\t{created}\t"
+                   f"{row['error'] or ''}")
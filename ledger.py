@@ -0,0 +1,322 @@
+import sqlite3
+import time
+from collections import OrderedDict, namedtuple
+
+import click
+from flask.cli import with_appcontext
+
+import allocation
+from db import get_db_connection
+
+# Every stock change is a row in Transactions plus a matching update to Stock, written in the
+# same short BEGIN IMMEDIATE transaction. OUT movements are guarded by the quantity read at
+# write time (compare-and-set), so concurrent clerks cannot take an item below zero, nor below
+# what is reserved for Pending sales orders.
+
+Movement = namedtuple('Movement', 'item_id warehouse_id transaction_type quantity reference_id user_id')
+Movement.__new__.__defaults__ = (None, None)
+
+SIGNS = {'IN': 1, 'OUT': -1, 'ADJUSTMENT': 1}
+
+BUSY_RETRIES = 5
+
+
+class InsufficientStock(Exception):
+    def __init__(self, item_id, warehouse_id, requested):
+        super().__init__(f'Not enough stock of item {item_id} in warehouse {warehouse_id} '
+                         f'to remove {requested}')
+        self.item_id = item_id
+        self.warehouse_id = warehouse_id
+        self.requested = requested
+
+
+class PostingError(Exception):
+    pass
+
+
+MIGRATION = '''
+    ALTER TABLE Transactions ADD COLUMN warehouse_id INTEGER REFERENCES Warehouses(warehouse_id);
+
+    CREATE TABLE IF NOT EXISTS StockSnapshots (
+        snapshot_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        taken_at TEXT NOT NULL,
+        last_transaction_id INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS StockSnapshotLines (
+        snapshot_id INTEGER NOT NULL REFERENCES StockSnapshots(snapshot_id),
+        item_id INTEGER NOT NULL,
+        warehouse_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (snapshot_id, item_id, warehouse_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_stock_item_warehouse ON Stock (item_id, warehouse_id);
+    CREATE INDEX IF NOT EXISTS idx_transactions_date ON Transactions (transaction_date);
+
+    -- Opening balance: the ledger only explains stock movements from this point on
+    INSERT INTO StockSnapshots (taken_at, last_transaction_id)
+    SELECT CURRENT_TIMESTAMP, IFNULL(MAX(transaction_id), 0) FROM Transactions;
+    INSERT INTO StockSnapshotLines (snapshot_id, item_id, warehouse_id, quantity)
+    SELECT last_insert_rowid(), item_id, warehouse_id, total_qty FROM ItemWarehouseStockTotals;
+'''
+
+
+def _signed(movement):
+    if movement.warehouse_id is None:
+        raise PostingError('Every movement needs a warehouse')
+    if movement.transaction_type not in SIGNS:
+        raise PostingError(f'Unknown transaction type {movement.transaction_type!r}')
+    if movement.transaction_type != 'ADJUSTMENT' and movement.quantity <= 0:
+        raise PostingError('IN and OUT quantities must be positive')
+    return SIGNS[movement.transaction_type] * movement.quantity
+
+
+# A removal may not dip into stock reserved for other sales orders
+_GUARDED_UPDATE = f'''
+    UPDATE Stock
+    SET quantity = quantity + ?, last_updated = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+    WHERE stock_id = (SELECT MIN(stock_id) FROM Stock WHERE item_id = ? AND warehouse_id = ?)
+      AND (SELECT total_qty FROM ItemWarehouseStockTotals WHERE item_id = ? AND warehouse_id = ?)
+          - CASE WHEN ? < 0 THEN {allocation.reserved('?', '?', '?')} ELSE 0 END + ? >= 0
+'''
+
+
+def _apply(conn, movements, reserved_for=None):
+    # Net the batch per (item, warehouse) so a burst against a hot item costs one guarded
+    # UPDATE, then append every movement to the ledger. reserved_for is the sales order whose
+    # own reservations the batch may use.
+    deltas = OrderedDict()
+    for movement in movements:
+        key = (movement.item_id, movement.warehouse_id)
+        deltas[key] = deltas.get(key, 0) + _signed(movement)
+
+    for (item_id, warehouse_id), delta in deltas.items():
+        cursor = conn.execute(_GUARDED_UPDATE, (delta, item_id, warehouse_id, item_id, warehouse_id, delta,
+                                                item_id, warehouse_id, reserved_for, delta))
+        if cursor.rowcount:
+            continue
+        exists = conn.execute(
+            'SELECT 1 FROM Stock WHERE item_id = ? AND warehouse_id = ? LIMIT 1', (item_id, warehouse_id)
+        ).fetchone()
+        if exists or delta < 0:
+            raise InsufficientStock(item_id, warehouse_id, -delta)
+        conn.execute(
+            'INSERT INTO Stock (item_id, warehouse_id, quantity) VALUES (?, ?, ?)',
+            (item_id, warehouse_id, delta)
+        )
+
+    conn.executemany('''
+        INSERT INTO Transactions (item_id, warehouse_id, transaction_type, quantity, reference_id, user_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(m.item_id, m.warehouse_id, m.transaction_type, m.quantity, m.reference_id, m.user_id)
+          for m in movements])
+
+
+def _in_transaction(conn, work):
+    for attempt in range(BUSY_RETRIES):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as exc:
+            # busy_timeout already waited; back off briefly and try again
+            if 'locked' not in str(exc) or attempt == BUSY_RETRIES - 1:
+                raise
+            time.sleep(0.01 * (attempt + 1))
+            continue
+        try:
+            result = work()
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        return result
+
+
+def post_movements(conn, movements):
+    movements = list(movements)
+    if movements:
+        _in_transaction(conn, lambda: _apply(conn, movements))
+    return len(movements)
+
+
+def adjust(conn, item_id, warehouse_id, delta, user_id=None):
+    return post_movements(conn, [Movement(item_id, warehouse_id, 'ADJUSTMENT', delta, None, user_id)])
+
+
+def receive_purchase_order(conn, po_id, warehouse_id, quantities=None, user_id=None):
+    # Books outstanding PO quantities into warehouse_id. quantities maps po_detail_id to the
+    # amount received now; without it every line is received in full. The PO becomes
+    # Received once nothing is outstanding.
+    def work():
+        lines = conn.execute('''
+            SELECT po_detail_id, item_id, quantity_ordered - IFNULL(quantity_received, 0) AS outstanding
+            FROM PurchaseOrderDetails
+            WHERE po_id = ? AND quantity_ordered > IFNULL(quantity_received, 0)
+        ''', (po_id,)).fetchall()
+        received = []
+        for line in lines:
+            quantity = line['outstanding'] if quantities is None else quantities.get(line['po_detail_id'], 0)
+            if quantity > line['outstanding']:
+                raise PostingError(f"Line {line['po_detail_id']} has only {line['outstanding']} outstanding")
+            if quantity > 0:
+                received.append((line, quantity))
+        if not received:
+            raise PostingError(f'Purchase order {po_id} has nothing to receive')
+        _apply(conn, [Movement(line['item_id'], warehouse_id, 'IN', quantity, po_id, user_id)
+                      for line, quantity in received])
+        conn.executemany('''
+            UPDATE PurchaseOrderDetails
+            SET quantity_received = IFNULL(quantity_received, 0) + ?, updated_at = CURRENT_TIMESTAMP
+            WHERE po_detail_id = ?
+        ''', [(quantity, line['po_detail_id']) for line, quantity in received])
+        conn.execute('''
+            UPDATE PurchaseOrders SET status = 'Received', updated_at = CURRENT_TIMESTAMP
+            WHERE po_id = ? AND NOT EXISTS (
+                SELECT 1 FROM PurchaseOrderDetails
+                WHERE po_id = ? AND quantity_ordered > IFNULL(quantity_received, 0))
+        ''', (po_id, po_id))
+        return len(received)
+    return _in_transaction(conn, work)
+
+
+def ship_sales_order(conn, so_id, warehouse_id=None, user_id=None):
+    # Takes every line of a Pending SO out of warehouse_id; fails as a whole if any line is short.
+    # The order may use its own reservations there, but not stock reserved for other orders.
+    # Without a warehouse the order ships as allocated: each reservation from its warehouse,
+    # which needs every line reserved in full. Shipping releases the reservations.
+    def work():
+        order = conn.execute('SELECT status FROM SalesOrders WHERE so_id = ?', (so_id,)).fetchone()
+        if order is None:
+            raise PostingError(f'Sales order {so_id} does not exist')
+        if order['status'] != 'Pending':
+            raise PostingError(f"Sales order {so_id} is {order['status']}, only Pending orders can ship")
+        if warehouse_id is not None:
+            lines = conn.execute(
+                'SELECT item_id, quantity_sold FROM SalesOrderDetails WHERE so_id = ?', (so_id,)
+            ).fetchall()
+            movements = [Movement(line['item_id'], warehouse_id, 'OUT', line['quantity_sold'], so_id, user_id)
+                         for line in lines]
+        else:
+            unreserved = conn.execute('''
+                SELECT COUNT(*) FROM SalesOrderDetails d
+                WHERE d.so_id = ? AND d.quantity_sold > (
+                    SELECT IFNULL(SUM(r.quantity), 0) FROM StockReservations r WHERE r.so_detail_id = d.so_detail_id)
+            ''', (so_id,)).fetchone()[0]
+            if unreserved:
+                raise PostingError(f'Sales order {so_id} has {unreserved} lines not fully allocated')
+            lines = conn.execute('''
+                SELECT item_id, warehouse_id, quantity FROM StockReservations WHERE so_id = ? ORDER BY reservation_id
+            ''', (so_id,)).fetchall()
+            if not lines:
+                raise PostingError(f'Sales order {so_id} has nothing allocated')
+            movements = [Movement(line['item_id'], line['warehouse_id'], 'OUT', line['quantity'], so_id, user_id)
+                         for line in lines]
+        _apply(conn, movements, reserved_for=so_id)
+        conn.execute('''
+            UPDATE SalesOrders SET status = 'Shipped', updated_at = CURRENT_TIMESTAMP WHERE so_id = ?
+        ''', (so_id,))
+        return len(lines)
+    return _in_transaction(conn, work)
+
+
+def take_snapshot(conn):
+    def work():
+        cursor = conn.execute('''
+            INSERT INTO StockSnapshots (taken_at, last_transaction_id)
+            SELECT CURRENT_TIMESTAMP, IFNULL(MAX(transaction_id), 0) FROM Transactions
+        ''')
+        snapshot_id = cursor.lastrowid
+        conn.execute('''
+            INSERT INTO StockSnapshotLines (snapshot_id, item_id, warehouse_id, quantity)
+            SELECT ?, item_id, warehouse_id, total_qty FROM ItemWarehouseStockTotals
+        ''', (snapshot_id,))
+        return snapshot_id
+    return _in_transaction(conn, work)
+
+
+def _end_of(as_of):
+    # Timestamps are stored as 'YYYY-MM-DD HH:MM:SS'; a bare date means the end of that day
+    if not as_of:
+        return '9999-12-31 23:59:59'
+    return as_of + ' 23:59:59' if len(as_of) == 10 else as_of
+
+
+def stock_as_of(conn, as_of=None, transactions='Transactions'):
+    # Starts from the newest snapshot taken at or before as_of and replays later ledger rows
+    # up to as_of. Returns {(item_id, warehouse_id): quantity}, warehouse 0 meaning none.
+    # transactions is the ledger to replay: the table, or it unioned with the archives.
+    as_of = _end_of(as_of)
+    snapshot = conn.execute('''
+        SELECT snapshot_id, last_transaction_id FROM StockSnapshots
+        WHERE taken_at <= ? ORDER BY taken_at DESC, snapshot_id DESC LIMIT 1
+    ''', (as_of,)).fetchone()
+    if snapshot is None:
+        raise PostingError(f'No stock snapshot exists at or before {as_of}')
+    if transactions == 'Transactions':
+        archived = conn.execute('SELECT transactions_through FROM ArchiveState WHERE id = 1').fetchone()
+        if archived is not None and snapshot['last_transaction_id'] < archived[0]:
+            raise PostingError(f'Ledger rows after the snapshot at or before {as_of} are archived; '
+                               f'replay with the archives included')
+    positions = {}
+    for row in conn.execute(
+            'SELECT item_id, warehouse_id, quantity FROM StockSnapshotLines WHERE snapshot_id = ?',
+            (snapshot['snapshot_id'],)):
+        positions[(row['item_id'], row['warehouse_id'])] = row['quantity']
+    for row in conn.execute(f'''
+        SELECT item_id, IFNULL(warehouse_id, 0) AS warehouse_id,
+               SUM(CASE transaction_type WHEN 'OUT' THEN -quantity ELSE quantity END) AS delta
+        FROM {transactions}
+        WHERE transaction_id > ? AND transaction_date <= ?
+        GROUP BY item_id, IFNULL(warehouse_id, 0)
+    ''', (snapshot['last_transaction_id'], as_of)):
+        key = (row['item_id'], row['warehouse_id'])
+        positions[key] = positions.get(key, 0) + row['delta']
+    return positions
+
+
+def rebuild_stock(conn, as_of=None):
+    # Rewrites Stock to the replayed positions: one row per (item, warehouse)
+    def work():
+        positions = stock_as_of(conn, as_of)
+        conn.execute('DELETE FROM Stock')
+        conn.executemany(
+            'INSERT INTO Stock (item_id, warehouse_id, quantity) VALUES (?, NULLIF(?, 0), ?)',
+            [(item_id, warehouse_id, quantity) for (item_id, warehouse_id), quantity in positions.items()]
+        )
+        return len(positions)
+    return _in_transaction(conn, work)
+
+
+def init_app(app):
+    app.cli.add_command(ledger_command)
+
+
+@click.group('stock-ledger')
+def ledger_command():
+    """Snapshot and replay the stock movement ledger."""
+
+
+@ledger_command.command('snapshot')
+@with_appcontext
+def snapshot_command():
+    snapshot_id = take_snapshot(get_db_connection())
+    click.echo(f'Took stock snapshot {snapshot_id}.')
+
+
+@ledger_command.command('replay')
+@click.option('--as-of', default=None, help='Timestamp to replay to, e.g. 2025-10-31 23:59:59.')
+@click.option('--apply', 'do_apply', is_flag=True, help='Rewrite Stock with the replayed positions.')
+@click.option('--include-archive', is_flag=True, help='Also replay ledger rows moved to the archives.')
+@with_appcontext
+def replay_command(as_of, do_apply, include_archive):
+    import archive  # archive imports this module
+
+    conn = get_db_connection()
+    if do_apply:
+        if include_archive:
+            raise click.UsageError('--apply replays the current ledger only')
+        count = rebuild_stock(conn, as_of)
+        click.echo(f'Stock rebuilt from the ledger: {count} item/warehouse positions.')
+        return
+    with archive.attached(conn, enabled=include_archive) as schemas:
+        positions = stock_as_of(conn, as_of, archive.union(conn, 'Transactions', schemas))
+    for (item_id, warehouse_id), quantity in sorted(positions.items()):
+        click.echo(f'item {item_id}\twarehouse {warehouse_id}\t{quantity}')
@@ -0,0 +1,237 @@
+import re
+
+import click
+from flask.cli import with_appcontext
+
+import allocation
+import archive
+import catalog
+import changefeed
+import jobs
+import ledger
+import passwords
+import planning
+import reporting
+import search
+import versions
+from db import get_db_connection
+
+# Append-only: each entry is (version, name, sql). sql may also be a callable taking the
+# connection and returning the script, for migrations that depend on the SQLite build.
+# Never edit a migration that has shipped.
+MIGRATIONS = [
+    (1, 'covering indexes for view joins and filters', '''
+        CREATE INDEX IF NOT EXISTS idx_stock_item_quantity ON Stock (item_id, quantity);
+        CREATE INDEX IF NOT EXISTS idx_sales_order_details_so ON SalesOrderDetails (so_id, quantity_sold, unit_price);
+        CREATE INDEX IF NOT EXISTS idx_sales_order_details_item ON SalesOrderDetails (item_id);
+        CREATE INDEX IF NOT EXISTS idx_sales_orders_customer ON SalesOrders (customer_id);
+        CREATE INDEX IF NOT EXISTS idx_purchase_order_details_po ON PurchaseOrderDetails (po_id, item_id);
+        CREATE INDEX IF NOT EXISTS idx_purchase_orders_supplier ON PurchaseOrders (supplier_id);
+        CREATE INDEX IF NOT EXISTS idx_items_category ON Items (category_id);
+        CREATE INDEX IF NOT EXISTS idx_items_supplier ON Items (supplier_id);
+        CREATE INDEX IF NOT EXISTS idx_transactions_item_date ON Transactions (item_id, transaction_date);
+    '''),
+    (2, 'materialized per-item stock totals', '''
+        CREATE TABLE IF NOT EXISTS ItemStockTotals (
+            item_id INTEGER PRIMARY KEY,
+            total_qty INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS ItemWarehouseStockTotals (
+            item_id INTEGER NOT NULL,
+            warehouse_id INTEGER NOT NULL,
+            total_qty INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (item_id, warehouse_id)
+        ) WITHOUT ROWID;
+
+        INSERT INTO ItemStockTotals (item_id, total_qty)
+        SELECT item_id, SUM(quantity) FROM Stock WHERE item_id IS NOT NULL GROUP BY item_id;
+        INSERT INTO ItemWarehouseStockTotals (item_id, warehouse_id, total_qty)
+        SELECT item_id, IFNULL(warehouse_id, 0), SUM(quantity) FROM Stock
+        WHERE item_id IS NOT NULL GROUP BY item_id, IFNULL(warehouse_id, 0);
+
+        CREATE TRIGGER IF NOT EXISTS trg_stock_totals_insert AFTER INSERT ON Stock
+        WHEN NEW.item_id IS NOT NULL
+        BEGIN
+            INSERT INTO ItemStockTotals (item_id, total_qty) VALUES (NEW.item_id, NEW.quantity)
+            ON CONFLICT (item_id) DO UPDATE SET total_qty = total_qty + excluded.total_qty;
+            INSERT INTO ItemWarehouseStockTotals (item_id, warehouse_id, total_qty)
+            VALUES (NEW.item_id, IFNULL(NEW.warehouse_id, 0), NEW.quantity)
+            ON CONFLICT (item_id, warehouse_id) DO UPDATE SET total_qty = total_qty + excluded.total_qty;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_stock_totals_delete AFTER DELETE ON Stock
+        WHEN OLD.item_id IS NOT NULL
+        BEGIN
+            UPDATE ItemStockTotals SET total_qty = total_qty - OLD.quantity
+            WHERE item_id = OLD.item_id;
+            UPDATE ItemWarehouseStockTotals SET total_qty = total_qty - OLD.quantity
+            WHERE item_id = OLD.item_id AND warehouse_id = IFNULL(OLD.warehouse_id, 0);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_stock_totals_update AFTER UPDATE OF item_id, warehouse_id, quantity ON Stock
+        BEGIN
+            UPDATE ItemStockTotals SET total_qty = total_qty - OLD.quantity
+            WHERE item_id = OLD.item_id;
+            UPDATE ItemWarehouseStockTotals SET total_qty = total_qty - OLD.quantity
+            WHERE item_id = OLD.item_id AND warehouse_id = IFNULL(OLD.warehouse_id, 0);
+            INSERT INTO ItemStockTotals (item_id, total_qty)
+            SELECT NEW.item_id, NEW.quantity WHERE NEW.item_id IS NOT NULL
+            ON CONFLICT (item_id) DO UPDATE SET total_qty = total_qty + excluded.total_qty;
+            INSERT INTO ItemWarehouseStockTotals (item_id, warehouse_id, total_qty)
+            SELECT NEW.item_id, IFNULL(NEW.warehouse_id, 0), NEW.quantity WHERE NEW.item_id IS NOT NULL
+            ON CONFLICT (item_id, warehouse_id) DO UPDATE SET total_qty = total_qty + excluded.total_qty;
+        END;
+    '''),
+    (3, 'full-text search index over item names and descriptions', search.fts_migration),
+    (4, 'incrementally refreshed reporting summaries', reporting.SCHEMA + reporting.SEED),
+    (5, 'per-table change counters', versions.migration),
+    (6, 'stock movement ledger and snapshots', ledger.MIGRATION),
+    (7, 'background job queue', jobs.MIGRATION),
+    (8, 'demand forecasts and reorder points', planning.MIGRATION),
+    (9, 'hash plaintext passwords', passwords.migration),
+    (10, 'keep Items.updated_at current for the catalog index', catalog.MIGRATION),
+    (11, 'order and ledger archives with summary rollups', archive.MIGRATION),
+    (12, 'warehouse allocation reservations', allocation.MIGRATION),
+    (13, 'change log for live dashboard updates', changefeed.migration),
+    (14, 'one live job per report cache key', jobs.UNIQUE_CACHE_KEY_MIGRATION),
+]
+
+# Tables that grow with business volume; hot queries must reach them through an index
+LARGE_TABLES = ('Stock', 'ItemStockTotals', 'SalesOrderDetails', 'PurchaseOrderDetails', 'Transactions')
+
+# Representative copies of the queries run by the list/report views
+HOT_QUERIES = {
+    'inventory': '''
+        SELECT Items.item_id, IFNULL(ItemStockTotals.total_qty, 0) AS total_stock
+        FROM Items
+        LEFT JOIN Categories ON Items.category_id = Categories.category_id
+        LEFT JOIN Suppliers ON Items.supplier_id = Suppliers.supplier_id
+        LEFT JOIN ItemStockTotals ON Items.item_id = ItemStockTotals.item_id
+        ORDER BY Items.item_id
+    ''',
+    'orders': '''
+        SELECT po.po_id, s.supplier_name, i.item_name, pod.quantity_ordered
+        FROM PurchaseOrders po
+        JOIN Suppliers s ON po.supplier_id = s.supplier_id
+        JOIN PurchaseOrderDetails pod ON po.po_id = pod.po_id
+        JOIN Items i ON pod.item_id = i.item_id
+        ORDER BY po.po_id
+    ''',
+    'reports': '''
+        SELECT category_name, total_stock FROM CategoryStockSummary ORDER BY category_id
+    ''',
+    'reports_daily_sales': '''
+        SELECT sale_date, SUM(quantity), SUM(value)
+        FROM DailySalesSummary
+        GROUP BY sale_date
+        ORDER BY sale_date DESC
+        LIMIT 14
+    ''',
+    'sales_orders': '''
+        SELECT so.so_id, c.customer_name, so.total_items, so.total_value
+        FROM SalesOrderSummary so
+        JOIN Customers c ON so.customer_id = c.customer_id
+        ORDER BY so.so_id DESC
+    ''',
+    'performance': '''
+        SELECT i.item_name, IFNULL(t.total_qty,0) AS total_stock, i.reorder_level
+        FROM Items i
+        LEFT JOIN ItemStockTotals t ON i.item_id = t.item_id
+        WHERE IFNULL(t.total_qty,0) < i.reorder_level
+    ''',
+}
+
+
+def current_version(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def run_migrations(conn):
+    applied = []
+    version = current_version(conn)
+    for number, name, sql in MIGRATIONS:
+        if number <= version:
+            continue
+        if callable(sql):
+            sql = sql(conn)
+        # executescript() commits any pending transaction first, so open one explicitly
+        # and record the version inside it; a failing migration then leaves nothing behind
+        try:
+            conn.executescript('BEGIN;\n' + sql)
+            conn.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (number, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append((number, name))
+    if applied:
+        conn.execute('ANALYZE')
+        conn.commit()
+    return applied
+
+
+def _table_aliases(sql):
+    aliases = {}
+    for table, alias in re.findall(r'(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', sql, re.IGNORECASE):
+        aliases[table] = table
+        if alias and alias.upper() not in ('ON', 'WHERE', 'LEFT', 'JOIN', 'GROUP', 'ORDER', 'USING'):
+            aliases[alias] = table
+    return aliases
+
+
+def full_scans(conn, sql, params=()):
+    aliases = _table_aliases(sql)
+    problems = []
+    for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+        detail = row[3]
+        words = detail.split()
+        if len(words) < 2 or words[0] not in ('SCAN', 'SEARCH'):
+            continue
+        table = aliases.get(words[1], words[1])
+        # An AUTOMATIC index is built by scanning the whole table on every execution
+        if table in LARGE_TABLES and (words[0] == 'SCAN' or 'AUTOMATIC' in detail):
+            problems.append(detail)
+    return problems
+
+
+def check_query_plans(conn):
+    return {route: full_scans(conn, sql) for route, sql in HOT_QUERIES.items()}
+
+
+def init_app(app):
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(check_query_plans_command)
+    with app.app_context():
+        run_migrations(get_db_connection())
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command():
+    applied = run_migrations(get_db_connection())
+    for number, name in applied:
+        click.echo(f'Applied migration {number}: {name}')
+    if not applied:
+        click.echo('Database schema is up to date.')
+
+
+@click.command('check-query-plans')
+@with_appcontext
+def check_query_plans_command():
+    failures = 0
+    for route, scans in check_query_plans(get_db_connection()).items():
+        status = 'FULL SCAN' if scans else 'ok'
+        click.echo(f'{route}: {status}')
+        for detail in scans:
+            click.echo(f'    {detail}')
+        failures += len(scans)
+    if failures:
+        raise SystemExit(1)
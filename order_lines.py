@@ -0,0 +1,137 @@
+from contextlib import contextmanager
+
+from flask import request
+
+# Purchase and sales orders share one shape: a header row plus N detail lines.
+# A spec names the tables/columns and the request field for each line column.
+PURCHASE = {
+    'detail_table': 'PurchaseOrderDetails',
+    'order_key': 'po_id',
+    'detail_key': 'po_detail_id',
+    'columns': ('item_id', 'quantity_ordered', 'unit_cost'),
+    'fields': ('item_id', 'quantity', 'unit_cost'),
+    'types': (int, int, float),
+}
+
+SALES = {
+    'detail_table': 'SalesOrderDetails',
+    'order_key': 'so_id',
+    'detail_key': 'so_detail_id',
+    'columns': ('item_id', 'quantity_sold', 'unit_price'),
+    'fields': ('item_id', 'quantity_sold', 'unit_price'),
+    'types': (int, int, float),
+}
+
+
+def _convert(spec, values):
+    return tuple(None if value is None else convert(value) for convert, value in zip(spec['types'], values))
+
+
+@contextmanager
+def immediate_transaction(conn):
+    # Take the write lock up front so header and lines commit together without a
+    # mid-transaction SQLITE_BUSY upgrade from a read lock
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def _json_lines():
+    # The "lines" of a JSON body, or None when it has none
+    lines = request.get_json().get('lines')
+    if lines is not None and not (isinstance(lines, list) and all(isinstance(line, dict) for line in lines)):
+        raise TypeError('lines must be a list of objects')
+    return lines
+
+
+def new_lines_from_request(spec, prefix=''):
+    # JSON: {"lines": [{"item_id": 1, "quantity": 5, ...}, ...]} (lines without a detail id).
+    # Forms: the line fields repeated once per line, e.g. item_id=1&quantity=5&item_id=2&quantity=3.
+    if request.is_json:
+        lines = [line for line in _json_lines() or [] if spec['detail_key'] not in line]
+        return [_convert(spec, [line[field] for field in spec['fields']]) for line in lines]
+    columns = [request.form.getlist(prefix + field) for field in spec['fields']]
+    lines = []
+    for values in zip(*columns):
+        if all(value == '' for value in values):
+            continue
+        lines.append(_convert(spec, values))
+    return lines
+
+
+def line_changes_from_request(spec, existing):
+    # Returns ({detail_id: new values}, [detail ids to delete]) for the order's current lines.
+    # JSON lists the lines to change, by detail id, with "delete": true to drop one; lines it
+    # doesn't mention are kept, no "lines" at all changes none, and "lines": [] drops them all.
+    # Forms post <field>_<detail id> per line and remove_<detail id> to drop one.
+    updates = {}
+    deletes = []
+    if request.is_json:
+        lines = _json_lines()
+        if lines is None:
+            return updates, deletes
+        if not lines:
+            return updates, [detail[spec['detail_key']] for detail in existing]
+        wanted = {line[spec['detail_key']]: line for line in lines if spec['detail_key'] in line}
+        for detail in existing:
+            line = wanted.get(detail[spec['detail_key']])
+            if line is None:
+                continue
+            if line.get('delete'):
+                deletes.append(detail[spec['detail_key']])
+                continue
+            values = [line.get(field, detail[column]) for field, column in zip(spec['fields'], spec['columns'])]
+            updates[detail[spec['detail_key']]] = _convert(spec, values)
+        return updates, deletes
+
+    for detail in existing:
+        detail_id = detail[spec['detail_key']]
+        if request.form.get(f'remove_{detail_id}'):
+            deletes.append(detail_id)
+            continue
+        values = []
+        for field, column in zip(spec['fields'], spec['columns']):
+            # Edit forms name the quantity field quantity_<id> for both order types
+            name = 'quantity' if column.startswith('quantity') else field
+            values.append(request.form.get(f'{name}_{detail_id}', detail[column]))
+        updates[detail_id] = _convert(spec, values)
+    return updates, deletes
+
+
+def insert_lines(conn, spec, order_id, lines):
+    columns = ', '.join((spec['order_key'],) + spec['columns'])
+    placeholders = ', '.join('?' * (len(spec['columns']) + 1))
+    conn.executemany(
+        f"INSERT INTO {spec['detail_table']} ({columns}) VALUES ({placeholders})",
+        [(order_id,) + line for line in lines]
+    )
+
+
+def apply_line_changes(conn, spec, existing, updates, deletes):
+    # Only lines whose values actually changed are written
+    changed = []
+    for detail in existing:
+        detail_id = detail[spec['detail_key']]
+        values = updates.get(detail_id)
+        if values is None:
+            continue
+        current = _convert(spec, [detail[column] for column in spec['columns']])
+        if values != current:
+            changed.append(values + (detail_id,))
+    if changed:
+        assignments = ', '.join(f'{column} = ?' for column in spec['columns'])
+        conn.executemany(
+            f"UPDATE {spec['detail_table']} SET {assignments}, updated_at = CURRENT_TIMESTAMP "
+            f"WHERE {spec['detail_key']} = ?",
+            changed
+        )
+    if deletes:
+        conn.executemany(
+            f"DELETE FROM {spec['detail_table']} WHERE {spec['detail_key']} = ?",
+            [(detail_id,) for detail_id in deletes]
+        )
+    return len(changed)
@@ -0,0 +1,251 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+# Password hashes are stored as self-describing strings, so the cost can be raised at any
+# time: a login whose stored hash used other parameters is re-hashed with the current ones.
+#
+#   scrypt$<n>$<r>$<p>$<salt>$<digest>
+#   pbkdf2_sha256$<iterations>$<salt>$<digest>
+#
+# Anything else is a plaintext value from before hashing; it still verifies once and is
+# replaced on that login. Hashing runs on a bounded pool (hashlib releases the GIL), so no
+# matter how many requests try to log in at once, at most PASSWORD_HASH_WORKERS cores are
+# spent on it, and the throttle turns away repeated attempts before any hash is computed.
+
+SCHEMES = ('scrypt', 'pbkdf2_sha256')
+SALT_BYTES = 16
+DIGEST_BYTES = 32
+
+DEFAULTS = {
+    'PASSWORD_SCHEME': 'scrypt',
+    'PASSWORD_SCRYPT_N': 2 ** 14,
+    'PASSWORD_SCRYPT_R': 8,
+    'PASSWORD_SCRYPT_P': 1,
+    'PASSWORD_PBKDF2_ITERATIONS': 600000,
+    'PASSWORD_HASH_WORKERS': os.cpu_count() or 2,
+    'PASSWORD_HASH_MAX_PENDING': 64,
+    'LOGIN_IP_ATTEMPTS': 20,
+    'LOGIN_USER_FAILURES': 5,
+    'LOGIN_THROTTLE_WINDOW': 60,
+    'LOGIN_THROTTLE_MAX_KEYS': 10000,
+}
+
+
+class HasherBusy(RuntimeError):
+    pass
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _unb64(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def params_from_config(config):
+    if config['PASSWORD_SCHEME'] not in SCHEMES:
+        raise ValueError(f"Unknown PASSWORD_SCHEME {config['PASSWORD_SCHEME']!r}")
+    if config['PASSWORD_SCHEME'] == 'scrypt':
+        return ('scrypt', int(config['PASSWORD_SCRYPT_N']), int(config['PASSWORD_SCRYPT_R']),
+                int(config['PASSWORD_SCRYPT_P']))
+    return ('pbkdf2_sha256', int(config['PASSWORD_PBKDF2_ITERATIONS']))
+
+
+def _digest(password, salt, params):
+    if params[0] == 'scrypt':
+        n, r, p = params[1:]
+        # scrypt needs 128 * n * r * p bytes; OpenSSL refuses more than 32 MB unless told
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r * p, dklen=DIGEST_BYTES)
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, params[1], dklen=DIGEST_BYTES)
+
+
+def _prefix(params):
+    return '$'.join(str(part) for part in params) + '$'
+
+
+def hash_password(password, params):
+    salt = os.urandom(SALT_BYTES)
+    return f'{_prefix(params)}{_b64(salt)}${_b64(_digest(password, salt, params))}'
+
+
+def _parse(stored):
+    parts = stored.split('$')
+    try:
+        if parts[0] == 'scrypt' and len(parts) == 6:
+            return ('scrypt', int(parts[1]), int(parts[2]), int(parts[3])), parts[4], parts[5]
+        if parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+            return ('pbkdf2_sha256', int(parts[1])), parts[2], parts[3]
+    except ValueError:
+        pass
+    return None
+
+
+def verify_password(password, stored):
+    parsed = _parse(stored)
+    if parsed is None:
+        return hmac.compare_digest(password.encode(), stored.encode())
+    params, salt, digest = parsed
+    return hmac.compare_digest(_digest(password, _unb64(salt), params), _unb64(digest))
+
+
+def needs_rehash(stored, params):
+    return not stored.startswith(_prefix(params)) or _parse(stored) is None
+
+
+class Hasher:
+    def __init__(self, params, workers, max_pending):
+        self.params = params
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._dummy = None
+
+    def _run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HasherBusy('Too many logins in progress')
+            self.pending += 1
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def hash(self, password):
+        return self._run(hash_password, password, self.params)
+
+    def verify(self, password, stored):
+        return self._run(verify_password, password, stored)
+
+    def dummy_hash(self):
+        # Verified against when the username doesn't exist, so a miss costs as much as a
+        # wrong password and response times don't reveal which usernames are registered
+        if self._dummy is None:
+            self._dummy = hash_password(os.urandom(16).hex(), self.params)
+        return self._dummy
+
+
+class LoginThrottle:
+    # Token buckets per client IP and per username, each refilled to capacity over
+    # LOGIN_THROTTLE_WINDOW. Every attempt takes a token from both before it is hashed, so
+    # concurrent guesses at one account can't all get in while the first hashes run; a
+    # successful login gives the username its tokens back. At most max_keys buckets are
+    # kept; the least recently used ones are dropped first, which only ever forgives.
+    def __init__(self, ip_attempts, user_failures, window, max_keys):
+        self.ip_attempts = ip_attempts
+        self.user_failures = user_failures
+        self.window = window
+        self.max_keys = max_keys
+        self.throttled = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, capacity, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(capacity), now]
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * capacity / self.window)
+            bucket[1] = now
+        return bucket
+
+    def _wait(self, bucket, capacity):
+        return max(1, int((1 - bucket[0]) * self.window / capacity) + 1)
+
+    def check(self, username, ip):
+        # Returns seconds to wait, or 0 if the attempt may go ahead (and takes its tokens)
+        now = time.monotonic()
+        with self._lock:
+            user = self._bucket(('user', username), self.user_failures, now)
+            ip_bucket = self._bucket(('ip', ip), self.ip_attempts, now)
+            if user[0] < 1:
+                self.throttled += 1
+                return self._wait(user, self.user_failures)
+            if ip_bucket[0] < 1:
+                self.throttled += 1
+                return self._wait(ip_bucket, self.ip_attempts)
+            ip_bucket[0] -= 1
+            user[0] -= 1
+            return 0
+
+    def refund(self, username):
+        # For an attempt whose password was never checked (the hasher was busy)
+        with self._lock:
+            bucket = self._buckets.get(('user', username))
+            if bucket is not None:
+                bucket[0] = min(self.user_failures, bucket[0] + 1)
+
+    def succeeded(self, username):
+        with self._lock:
+            self._buckets.pop(('user', username), None)
+
+    def stats(self):
+        with self._lock:
+            return {'tracked_keys': len(self._buckets), 'max_keys': self.max_keys, 'throttled': self.throttled}
+
+
+def hasher():
+    return current_app.extensions['password_hasher']
+
+
+def throttle():
+    return current_app.extensions['login_throttle']
+
+
+def authenticate(conn, username, password):
+    # Returns the user row if the password matches, else None. Upgrades the stored hash
+    # when it was made with other parameters (or is plaintext).
+    user = conn.execute('SELECT * FROM Users WHERE username = ?', (username,)).fetchone()
+    pool = hasher()
+    if user is None:
+        pool.verify(password, pool.dummy_hash())
+        return None
+    stored = user['password_hash']
+    if not pool.verify(password, stored):
+        return None
+    if needs_rehash(stored, pool.params):
+        # Only replaces the hash that was verified, in case the password changed meanwhile
+        conn.execute('''
+            UPDATE Users SET password_hash = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ? AND password_hash = ?
+        ''', (pool.hash(password), user['user_id'], stored))
+        conn.commit()
+    return user
+
+
+def migration(conn):
+    # Hashes any plaintext passwords left from before hashing, with the default cost
+    params = params_from_config(DEFAULTS)
+    statements = []
+    for row in conn.execute('SELECT user_id, password_hash FROM Users').fetchall():
+        if row[1] is not None and _parse(row[1]) is None:
+            statements.append(f"UPDATE Users SET password_hash = '{hash_password(row[1], params)}' "
+                              f"WHERE user_id = {int(row[0])};")
+    return '\n'.join(statements)
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.extensions['password_hasher'] = Hasher(params_from_config(app.config), app.config['PASSWORD_HASH_WORKERS'],
+                                               app.config['PASSWORD_HASH_MAX_PENDING'])
+    app.extensions['login_throttle'] = LoginThrottle(
+        app.config['LOGIN_IP_ATTEMPTS'], app.config['LOGIN_USER_FAILURES'],
+        app.config['LOGIN_THROTTLE_WINDOW'], app.config['LOGIN_THROTTLE_MAX_KEYS'],
+    )
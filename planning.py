@@ -0,0 +1,250 @@
+import statistics
+import time
+from datetime import date, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from db import get_db_connection
+
+# Demand forecasts and reorder points for every item, computed in one vectorised pass.
+# Sales history is loaded straight from SQLite into NumPy arrays and kept sparse: per
+# (item, day) totals rather than a dense item x day matrix, which at 100k items x 3 years
+# would be ~440 MB of mostly zeros. Every statistic below is a weighted sum over those
+# totals, so np.bincount computes it for all items at once.
+#
+#   average   mean daily demand over the history, days without sales counted as zero
+#   moving    mean daily demand over the last PLANNING_WINDOW_DAYS
+#   smoothed  exponentially smoothed level (alpha = PLANNING_SMOOTHING), seeded with average
+#   safety    z(service level) x daily std dev x sqrt(lead time)
+#   reorder   ceil(smoothed x lead time + safety)
+#
+# Lead time is each supplier's average expected delivery time over the history, falling
+# back to PLANNING_LEAD_TIME_DAYS. NumPy is only imported when a plan is computed.
+
+MIGRATION = '''
+    CREATE TABLE IF NOT EXISTS ItemPlanning (
+        item_id INTEGER PRIMARY KEY,
+        average_demand REAL NOT NULL,
+        moving_demand REAL NOT NULL,
+        smoothed_demand REAL NOT NULL,
+        demand_std REAL NOT NULL,
+        lead_time_days REAL NOT NULL,
+        safety_stock REAL NOT NULL,
+        reorder_point INTEGER NOT NULL,
+        as_of TEXT NOT NULL,
+        computed_at REAL NOT NULL
+    );
+'''
+
+DEFAULTS = {
+    'PLANNING_HISTORY_DAYS': 3 * 365,
+    'PLANNING_WINDOW_DAYS': 28,
+    'PLANNING_SMOOTHING': 0.2,
+    'PLANNING_SERVICE_LEVEL': 0.95,
+    'PLANNING_LEAD_TIME_DAYS': 7,
+}
+
+# Sales and purchase orders moved to the archives are read back from their per-day rollups
+HISTORY_QUERY = '''
+    SELECT sod.item_id, CAST(julianday(so.order_date) - julianday(?) AS INTEGER), sod.quantity_sold
+    FROM SalesOrders so
+    JOIN SalesOrderDetails sod ON so.so_id = sod.so_id
+    WHERE so.order_date >= ? AND so.order_date <= ? AND so.status != 'Cancelled'
+      AND sod.item_id IS NOT NULL AND sod.quantity_sold > 0
+    UNION ALL
+    SELECT item_id, CAST(julianday(sale_date) - julianday(?) AS INTEGER), quantity
+    FROM SalesHistoryRollup
+    WHERE sale_date >= ? AND sale_date <= ?
+'''
+
+ITEMS_QUERY = '''
+    SELECT i.item_id, IFNULL(i.reorder_level, -1), IFNULL(lt.days, ?)
+    FROM Items i
+    LEFT JOIN (
+        SELECT supplier_id, SUM(total_days) / SUM(orders) AS days
+        FROM (
+            SELECT supplier_id, COUNT(*) AS orders,
+                   SUM(julianday(expected_delivery_date) - julianday(order_date)) AS total_days
+            FROM PurchaseOrders
+            WHERE expected_delivery_date IS NOT NULL AND order_date >= ?
+            GROUP BY supplier_id
+            UNION ALL
+            SELECT supplier_id, SUM(orders), SUM(total_days)
+            FROM SupplierLeadTimeRollup
+            WHERE order_date >= ?
+            GROUP BY supplier_id
+        )
+        GROUP BY supplier_id
+    ) lt ON lt.supplier_id = i.supplier_id
+    ORDER BY i.item_id
+'''
+
+
+class PlanningError(RuntimeError):
+    pass
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise PlanningError('Demand planning needs NumPy: pip install numpy')
+    return numpy
+
+
+def settings(config=None):
+    # PLANNING_* config keys as plan() options: PLANNING_WINDOW_DAYS -> window_days
+    config = config if config is not None else current_app.config
+    return {key[len('PLANNING_'):].lower(): config[key] for key in DEFAULTS}
+
+
+def _fetch(np, conn, sql, params, dtype):
+    # A plain cursor yields tuples, which np.fromiter packs straight into a structured array
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(sql, params)
+    return np.fromiter(cursor, dtype=dtype)
+
+
+def forecast(np, item_ids, hist_items, hist_days, hist_qty, days, options):
+    # Returns per-item arrays aligned with item_ids (sorted). Sales of deleted items are dropped.
+    n = len(item_ids)
+    pos = np.searchsorted(item_ids, hist_items)
+    known = pos < n
+    known[known] = item_ids[pos[known]] == hist_items[known]
+    pos, hist_days, hist_qty = pos[known], hist_days[known], hist_qty[known]
+
+    # Collapse order lines into one total per (item, day)
+    keys, inverse = np.unique(pos * days + hist_days, return_inverse=True)
+    daily = np.bincount(inverse, weights=hist_qty)
+    item, day = keys // days, keys % days
+
+    total = np.bincount(item, weights=daily, minlength=n)
+    average = total / days
+    variance = np.bincount(item, weights=daily * daily, minlength=n) / days - average * average
+    std = np.sqrt(np.maximum(variance, 0.0))
+
+    window = min(options['window_days'], days)
+    recent = day >= days - window
+    moving = np.bincount(item[recent], weights=daily[recent], minlength=n) / window
+
+    alpha = options['smoothing']
+    weights = alpha * (1 - alpha) ** (days - 1 - day)
+    smoothed = (1 - alpha) ** days * average + np.bincount(item, weights=daily * weights, minlength=n)
+    return {'average': average, 'moving': moving, 'smoothed': smoothed, 'std': std,
+            'sold_days': np.bincount(item, minlength=n)}
+
+
+def plan(conn, as_of=None, options=None, apply=False, progress=None):
+    np = _numpy()
+    options = options or settings(DEFAULTS)
+    progress = progress or (lambda *args: None)
+    as_of = date.fromisoformat(as_of) if isinstance(as_of, str) else (as_of or date.today())
+    start = as_of - timedelta(days=options['history_days'] - 1)
+    timings = {}
+
+    started = time.perf_counter()
+    progress(0.05, 'Loading items')
+    items = _fetch(np, conn, ITEMS_QUERY, (options['lead_time_days'], start.isoformat(), start.isoformat()),
+                   [('item_id', 'i8'), ('reorder_level', 'i8'), ('lead_time', 'f8')])
+    progress(0.15, 'Loading sales history')
+    history = _fetch(np, conn, HISTORY_QUERY, (start.isoformat(), start.isoformat(), as_of.isoformat()) * 2,
+                     [('item_id', 'i8'), ('day', 'i8'), ('qty', 'f8')])
+    timings['load'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    progress(0.6, 'Forecasting demand')
+    # A shorter history than configured is averaged over the days it actually covers
+    days = int(options['history_days'] - history['day'].min()) if len(history) else options['history_days']
+    if len(history):
+        history['day'] -= history['day'].min()
+    result = forecast(np, items['item_id'], history['item_id'], history['day'], history['qty'], days, options)
+    lead_time = np.maximum(items['lead_time'], 1.0)
+    z = statistics.NormalDist().inv_cdf(options['service_level'])
+    safety = z * result['std'] * np.sqrt(lead_time)
+    # The epsilon keeps float noise (2.0000000001) from rounding a whole number up
+    reorder_point = np.ceil(result['smoothed'] * lead_time + safety - 1e-9).astype('i8')
+    timings['compute'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    progress(0.8, 'Saving reorder points')
+    computed_at = time.time()
+    rows = zip(items['item_id'].tolist(), result['average'].tolist(), result['moving'].tolist(),
+               result['smoothed'].tolist(), result['std'].tolist(), lead_time.tolist(), safety.tolist(),
+               reorder_point.tolist())
+    changed = reorder_point != items['reorder_level']
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM ItemPlanning')
+        conn.executemany('''
+            INSERT INTO ItemPlanning (item_id, average_demand, moving_demand, smoothed_demand, demand_std,
+                                      lead_time_days, safety_stock, reorder_point, as_of, computed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (row + (as_of.isoformat(), computed_at) for row in rows))
+        if apply:
+            conn.executemany('UPDATE Items SET reorder_level = ? WHERE item_id = ?',
+                             zip(reorder_point[changed].tolist(), items['item_id'][changed].tolist()))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    timings['write'] = time.perf_counter() - started
+
+    return {
+        'as_of': as_of.isoformat(),
+        'history_days': days,
+        'items': len(items),
+        'items_with_sales': int(np.count_nonzero(result['sold_days'])),
+        'sales_lines': len(history),
+        'changed_reorder_levels': int(np.count_nonzero(changed)),
+        'applied': bool(apply),
+        'seconds': {key: round(value, 3) for key, value in timings.items()},
+    }
+
+
+def suggestions(conn, limit=200):
+    # Items whose stock is below their computed reorder point, largest shortfall first
+    return conn.execute('''
+        SELECT p.item_id, i.item_name, IFNULL(t.total_qty, 0) AS total_stock, i.reorder_level,
+               p.smoothed_demand, p.moving_demand, p.safety_stock, p.lead_time_days, p.reorder_point,
+               p.reorder_point - IFNULL(t.total_qty, 0) AS shortfall
+        FROM ItemPlanning p
+        JOIN Items i ON i.item_id = p.item_id
+        LEFT JOIN ItemStockTotals t ON t.item_id = p.item_id
+        WHERE IFNULL(t.total_qty, 0) < p.reorder_point
+        ORDER BY shortfall DESC
+        LIMIT ?
+    ''', (limit,)).fetchall()
+
+
+def last_run(conn):
+    return conn.execute('''
+        SELECT MAX(as_of) AS as_of, MAX(computed_at) AS computed_at, COUNT(*) AS items,
+               SUM(reorder_point > 0) AS items_with_reorder_point
+        FROM ItemPlanning
+    ''').fetchone()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.cli.add_command(plan_command)
+
+
+@click.command('plan-reorders')
+@click.option('--as-of', default=None, help='Plan as of this date (YYYY-MM-DD), default today.')
+@click.option('--apply', 'do_apply', is_flag=True, help='Also write the reorder points to Items.reorder_level.')
+@with_appcontext
+def plan_command(as_of, do_apply):
+    try:
+        summary = plan(get_db_connection(), as_of, settings(), apply=do_apply)
+    except PlanningError as exc:
+        raise click.ClickException(str(exc))
+    seconds = summary['seconds']
+    click.echo(f"Planned {summary['items']} items ({summary['items_with_sales']} with sales, "
+               f"{summary['sales_lines']} order lines over {summary['history_days']} days) as of {summary['as_of']}.")
+    click.echo(f"load {seconds['load']}s, compute {seconds['compute']}s, write {seconds['write']}s")
+    action = 'updated' if do_apply else 'would change (use --apply)'
+    click.echo(f"{summary['changed_reorder_levels']} reorder levels {action}.")
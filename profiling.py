@@ -0,0 +1,328 @@
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+from flask import before_render_template, current_app, g, request, template_rendered
+
+import db
+import replica
+
+# Every request is timed and split into database time, query count and template time; the
+# cost is a few perf_counter() calls. A sampled share of requests additionally records each
+# statement, counts the statements SQLite actually runs, trigger bodies included (trace
+# callback), and its VM steps (progress handler). Statements slower than SLOW_QUERY_MS are logged with their query plan.
+
+slow_query_log = logging.getLogger('inventory.slow_queries')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+PROGRESS_OPS = 100
+MAX_PLANS = 256
+RECENT = 100
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][index] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self, label_names):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            base = _labels(label_names, labels)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{base}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{base}le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{base.rstrip(",")}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{base.rstrip(",")}}} {count}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.series = {}
+
+    def inc(self, labels, amount=1):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self, label_names):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self.series.items()):
+            base = _labels(label_names, labels).rstrip(',')
+            lines.append(f'{self.name}{{{base}}} {value}' if base else f'{self.name} {value}')
+        return lines
+
+
+def _labels(names, values):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for value in values)
+    return ''.join(f'{name}="{value}",' for name, value in zip(names, escaped))
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter('inventory_http_requests_total', 'Requests by route, method and status.')
+        self.duration = Histogram('inventory_http_request_duration_seconds',
+                                  'Request latency by route.', LATENCY_BUCKETS)
+        self.db_time = Histogram('inventory_http_request_db_seconds',
+                                 'Time spent in SQLite per request.', LATENCY_BUCKETS)
+        self.template_time = Histogram('inventory_http_request_template_seconds',
+                                       'Time spent rendering templates per request.', LATENCY_BUCKETS)
+        self.queries = Histogram('inventory_http_request_queries',
+                                 'SQL statements issued per request.', QUERY_BUCKETS)
+        self.sampled = Counter('inventory_profiled_requests_total', 'Requests sampled for statement detail.')
+        self.sqlite_statements = Counter('inventory_sqlite_statements_total',
+                                         'Statements run by SQLite for sampled requests, trigger bodies included.')
+        self.vm_steps = Counter('inventory_sqlite_vm_steps_total',
+                                'Approximate SQLite VM instructions run by sampled requests.')
+        self.slow_queries = Counter('inventory_slow_queries_total', 'Statements slower than SLOW_QUERY_MS.')
+
+    def record(self, profile, route, method, status, elapsed):
+        with self.lock:
+            self.requests.inc((route, method, status))
+            self.duration.observe((route, method), elapsed)
+            self.db_time.observe((route,), profile.db_seconds)
+            self.template_time.observe((route,), profile.template_seconds)
+            self.queries.observe((route,), profile.queries)
+            if profile.sampled:
+                self.sampled.inc((route,))
+                self.sqlite_statements.inc((route,), profile.sqlite_statements)
+                self.vm_steps.inc((route,), profile.vm_steps * PROGRESS_OPS)
+
+    def render(self):
+        with self.lock:
+            lines = self.requests.render(('route', 'method', 'status'))
+            lines += self.duration.render(('route', 'method'))
+            for metric in (self.db_time, self.template_time, self.queries):
+                lines += metric.render(('route',))
+            for metric in (self.sampled, self.sqlite_statements, self.vm_steps):
+                lines += metric.render(('route',))
+            lines += self.slow_queries.render(())
+        return lines
+
+
+class StatementRecord:
+    __slots__ = ('sql', 'parameters', 'seconds', 'logged')
+
+    def __init__(self, sql, parameters, seconds):
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = seconds
+        self.logged = False
+
+
+class RequestProfile:
+    def __init__(self, monitor, sampled):
+        self.monitor = monitor
+        self.sampled = sampled
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.queries = 0
+        self.sqlite_statements = 0
+        self.vm_steps = 0
+        self.statements = [] if sampled else None
+        self.conn = None
+        self._template_started = None
+
+    def attach(self, conn):
+        self.conn = conn
+        conn.profile = self
+        if self.sampled:
+            conn.set_trace_callback(self._trace)
+            conn.set_progress_handler(self._progress, PROGRESS_OPS)
+
+    def detach(self, conn):
+        conn.profile = None
+        if self.sampled:
+            conn.set_trace_callback(None)
+            conn.set_progress_handler(None, 0)
+        # A request can hold a primary and a read connection; keep the one still attached
+        if self.conn is conn:
+            self.conn = None
+
+    def _trace(self, statement):
+        # Called for every statement SQLite starts, including each trigger body and implicit
+        # BEGIN, so comparing this with queries shows the write amplification of triggers
+        self.sqlite_statements += 1
+
+    def _progress(self):
+        self.vm_steps += 1
+        return 0
+
+    def add_statement(self, sql, parameters, seconds):
+        self.queries += 1
+        self.db_seconds += seconds
+        record = StatementRecord(sql, parameters, seconds)
+        if self.statements is not None:
+            self.statements.append(record)
+        self._check_slow(record)
+        return record
+
+    def add_fetch(self, record, seconds):
+        record.seconds += seconds
+        self.db_seconds += seconds
+        self._check_slow(record)
+
+    def _check_slow(self, record):
+        if not record.logged and record.seconds * 1000 >= self.monitor.slow_query_ms:
+            record.logged = True
+            self.monitor.slow_query(self.conn, record)
+
+    def template_started(self):
+        self._template_started = time.perf_counter()
+
+    def template_finished(self):
+        if self._template_started is not None:
+            self.template_seconds += time.perf_counter() - self._template_started
+            self._template_started = None
+
+
+class Monitor:
+    def __init__(self, sample_rate, slow_query_ms):
+        self.sample_rate = sample_rate
+        self.slow_query_ms = slow_query_ms
+        self.metrics = Metrics()
+        self.slow_queries = deque(maxlen=RECENT)
+        self.samples = deque(maxlen=RECENT)
+        self._plans = OrderedDict()
+        self._plans_lock = threading.Lock()
+
+    def _plan(self, conn, sql, parameters):
+        # Plans are cached per statement text; EXPLAIN only runs the first time a query is slow
+        with self._plans_lock:
+            if sql in self._plans:
+                self._plans.move_to_end(sql)
+                return self._plans[sql]
+        if conn is None or parameters is None:
+            return None
+        try:
+            profile, conn.profile = conn.profile, None
+            try:
+                rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+            finally:
+                conn.profile = profile
+        except Exception as exc:
+            plan = [f'EXPLAIN failed: {exc}']
+        else:
+            plan = [row[3] for row in rows]
+        with self._plans_lock:
+            self._plans[sql] = plan
+            if len(self._plans) > MAX_PLANS:
+                self._plans.popitem(last=False)
+        return plan
+
+    def slow_query(self, conn, record):
+        plan = self._plan(conn, record.sql, record.parameters)
+        entry = {
+            'route': request.url_rule.rule if request.url_rule else None,
+            'ms': round(record.seconds * 1000, 3),
+            'sql': ' '.join(record.sql.split()),
+            'plan': plan,
+        }
+        self.slow_queries.append(entry)
+        with self.metrics.lock:
+            self.metrics.slow_queries.inc(())
+        slow_query_log.warning('slow query %.1f ms on %s: %s | plan: %s',
+                               entry['ms'], entry['route'], entry['sql'], '; '.join(plan or []))
+
+    def before_request(self):
+        g.request_started = time.perf_counter()
+        g.request_profile = RequestProfile(self, random.random() < self.sample_rate)
+
+    def after_request(self, response):
+        profile = g.get('request_profile')
+        if profile is None:
+            return response
+        elapsed = time.perf_counter() - g.request_started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        self.metrics.record(profile, route, request.method, response.status_code, elapsed)
+        response.headers['Server-Timing'] = (
+            f'db;dur={profile.db_seconds * 1000:.2f}, tpl;dur={profile.template_seconds * 1000:.2f}, '
+            f'total;dur={elapsed * 1000:.2f}'
+        )
+        if profile.sampled:
+            top = sorted(profile.statements, key=lambda record: record.seconds, reverse=True)[:5]
+            self.samples.append({
+                'route': route,
+                'ms': round(elapsed * 1000, 3),
+                'db_ms': round(profile.db_seconds * 1000, 3),
+                'template_ms': round(profile.template_seconds * 1000, 3),
+                'queries': profile.queries,
+                'sqlite_statements': profile.sqlite_statements,
+                'vm_steps': profile.vm_steps * PROGRESS_OPS,
+                'top_statements': [{'ms': round(record.seconds * 1000, 3), 'sql': ' '.join(record.sql.split())}
+                                   for record in top],
+            })
+        return response
+
+
+def _template_started(sender, **extra):
+    profile = g.get('request_profile')
+    if profile is not None:
+        profile.template_started()
+
+
+def _template_finished(sender, **extra):
+    profile = g.get('request_profile')
+    if profile is not None:
+        profile.template_finished()
+
+
+def get_monitor():
+    return current_app.extensions.get('profiling')
+
+
+def render_metrics():
+    monitor = get_monitor()
+    lines = monitor.metrics.render() if monitor else []
+    pool = db.pool_stats()
+    for key in ('open', 'idle', 'in_use'):
+        lines += [f'# TYPE inventory_db_pool_{key} gauge', f'inventory_db_pool_{key} {pool[key]}']
+    for key in ('checkouts', 'waits', 'timeouts'):
+        lines += [f'# TYPE inventory_db_pool_{key}_total counter', f'inventory_db_pool_{key}_total {pool[key]}']
+    reads = replica.read_stats()
+    lines.append('# TYPE inventory_db_reads_total counter')
+    lines += [f'inventory_db_reads_total{{source="{source}"}} {count}' for source, count in reads['reads'].items()]
+    snapshot = reads.get('snapshot')
+    if snapshot is not None:
+        for key in ('age_seconds', 'version_lag', 'last_copy_seconds'):
+            if snapshot[key] is not None:
+                value = round(snapshot[key], 3)
+                lines += [f'# TYPE inventory_db_replica_{key} gauge', f'inventory_db_replica_{key} {value}']
+        for key in ('refreshes', 'failures'):
+            lines += [f'# TYPE inventory_db_replica_{key}_total counter',
+                      f'inventory_db_replica_{key}_total {snapshot[key]}']
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    app.config.setdefault('PROFILING', True)
+    app.config.setdefault('PROFILE_SAMPLE_RATE', 0.05)
+    app.config.setdefault('SLOW_QUERY_MS', 100)
+    if not app.config['PROFILING']:
+        return
+    monitor = Monitor(app.config['PROFILE_SAMPLE_RATE'], app.config['SLOW_QUERY_MS'])
+    app.extensions['profiling'] = monitor
+    app.before_request(monitor.before_request)
+    app.after_request(monitor.after_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
@@ -0,0 +1,299 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+from flask import current_app, g, has_request_context, request
+
+import db
+
+log = logging.getLogger('inventory.replica')
+
+# Read routing for the long report queries. Views that only read call
+# get_read_connection(); everything else keeps using db.get_db_connection() (the primary).
+# DB_READ_MODE picks where those reads go:
+#
+#   primary    the request's primary connection, as before
+#   readonly   a separate pool of read-only (mode=ro, query_only) connections to the primary
+#   snapshot   a copy of the database made with the sqlite3 backup API every
+#              DB_SNAPSHOT_INTERVAL seconds; reads there never touch the primary's WAL or locks
+#
+# Each read says how stale it may be: DB_READ_STALENESS maps endpoint -> seconds, anything
+# else gets DB_READ_MAX_STALENESS. When the snapshot is older than that (or missing) the read
+# falls back to a read-only connection to the primary.
+#
+# Several processes can share one snapshot file: whoever finds it due copies into a temp
+# file and renames it into place; the others notice the new file and recycle their pools.
+
+DEFAULTS = {
+    'DB_READ_MODE': 'primary',
+    'DB_SNAPSHOT_PATH': None,
+    'DB_SNAPSHOT_INTERVAL': 30,
+    'DB_READ_MAX_STALENESS': 60,
+    'DB_READ_STALENESS': {},
+    'DB_READ_POOL_SIZE': 4,
+}
+MODES = ('primary', 'readonly', 'snapshot')
+# A temp file older than this is left over from a copy that died
+ABANDONED_COPY_SECONDS = 600
+
+
+def connect_readonly(path):
+    conn = sqlite3.connect(f'file:{quote(os.path.abspath(path))}?mode=ro', uri=True,
+                           check_same_thread=False, factory=db.ProfiledConnection)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {int(db._setting('DB_BUSY_TIMEOUT_MS'))}")
+    conn.execute(f"PRAGMA cache_size = -{int(db._setting('DB_CACHE_SIZE_KB'))}")
+    conn.execute(f"PRAGMA mmap_size = {int(db._setting('DB_MMAP_SIZE'))}")
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+def _version_total(conn):
+    row = conn.execute('SELECT IFNULL(SUM(version), 0) FROM TableVersions').fetchone()
+    return row[0]
+
+
+class Snapshot:
+    def __init__(self, primary_path, path, interval, pool_size, pool_timeout):
+        self.primary_path = primary_path
+        self.path = path
+        self.interval = interval
+        self.pool = db.ConnectionPool(path, pool_size, pool_timeout, connector=connect_readonly)
+        self.pid = os.getpid()
+        self.taken_at = None
+        self.refreshes = 0
+        self.failures = 0
+        self.last_copy_seconds = None
+        self.version_lag = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def age(self):
+        # Seconds since the copy began, or None while there is no snapshot
+        return None if self.taken_at is None else max(0.0, time.time() - self.taken_at)
+
+    def _check_file(self):
+        # Picks up a snapshot renamed into place by this or another process
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self.taken_at = None
+            return
+        identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if identity != self._file:
+            self._file = identity
+            self.taken_at = st.st_mtime
+            self.pool.recycle()
+
+    def refresh(self):
+        # Copies the primary into the snapshot; returns False if another process is already on it
+        tmp = self.path + '.tmp'
+        try:
+            fd = os.open(tmp, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(tmp) > ABANDONED_COPY_SECONDS:
+                    os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            return False
+        os.close(fd)
+        started = time.time()
+        try:
+            source = sqlite3.connect(self.primary_path)
+            target = sqlite3.connect(tmp)
+            try:
+                # One step: a WAL reader never blocks writers, and a multi-step copy would
+                # restart every time the primary changed in between
+                source.backup(target)
+                # Readers open the snapshot read-only, which a WAL database can't always do
+                target.execute('PRAGMA journal_mode = DELETE')
+            finally:
+                target.close()
+                source.close()
+            # The snapshot's age is measured from when the copy started
+            os.utime(tmp, (started, started))
+            os.replace(tmp, self.path)
+        except Exception:
+            self.failures += 1
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        self.refreshes += 1
+        self.last_copy_seconds = time.time() - started
+        self._check_file()
+        return True
+
+    def poll(self):
+        with self._lock:
+            self._check_file()
+            age = self.age()
+            if age is None or age >= self.interval:
+                try:
+                    self.refresh()
+                except (sqlite3.Error, OSError) as exc:
+                    log.warning('snapshot refresh failed: %s', exc)
+            self._measure_lag()
+
+    def _measure_lag(self):
+        # How many tracked-table changes the primary has that the snapshot doesn't
+        if self.taken_at is None:
+            self.version_lag = None
+            return
+        try:
+            primary = sqlite3.connect(self.primary_path)
+            snapshot = connect_readonly(self.path)
+            try:
+                self.version_lag = max(0, _version_total(primary) - _version_total(snapshot))
+            finally:
+                snapshot.close()
+                primary.close()
+        except sqlite3.Error:
+            self.version_lag = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='db-snapshot', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                self.failures += 1
+            if self._stop.wait(min(self.interval, 5)):
+                return
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {'age_seconds': self.age(), 'refreshes': self.refreshes, 'failures': self.failures,
+                'last_copy_seconds': self.last_copy_seconds, 'version_lag': self.version_lag}
+
+
+class ReadRouter:
+    def __init__(self, app):
+        config = app.config
+        if config['DB_READ_MODE'] not in MODES:
+            raise ValueError(f"Unknown DB_READ_MODE {config['DB_READ_MODE']!r}")
+        self.config = config
+        self.reads = {'primary': 0, 'readonly': 0, 'snapshot': 0}
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    @property
+    def mode(self):
+        return self.config['DB_READ_MODE']
+
+    def _primary_path(self):
+        return self.config.get('DATABASE', db.DATABASE)
+
+    def readonly_pool(self):
+        with self._lock:
+            pool = self._pools.get('readonly')
+            if pool is None or pool.pid != os.getpid():
+                pool = self._pools['readonly'] = db.ConnectionPool(
+                    self._primary_path(), self.config['DB_READ_POOL_SIZE'], self.config['DB_POOL_TIMEOUT'],
+                    connector=connect_readonly)
+            return pool
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = self._pools.get('snapshot')
+            # Like the primary pool, a snapshot inherited across fork starts afresh
+            if snapshot is None or snapshot.pid != os.getpid():
+                primary = self._primary_path()
+                snapshot = self._pools['snapshot'] = Snapshot(
+                    primary, self.config['DB_SNAPSHOT_PATH'] or primary + '.snapshot',
+                    self.config['DB_SNAPSHOT_INTERVAL'], self.config['DB_READ_POOL_SIZE'],
+                    self.config['DB_POOL_TIMEOUT'])
+        snapshot.start()
+        return snapshot
+
+    def max_staleness(self):
+        endpoint = request.endpoint if has_request_context() else None
+        return self.config['DB_READ_STALENESS'].get(endpoint, self.config['DB_READ_MAX_STALENESS'])
+
+    def route(self, max_staleness=None):
+        # Returns (source, pool) for one read; pool is None for the primary connection
+        if self.mode == 'primary':
+            return 'primary', None
+        if self.mode == 'snapshot':
+            snapshot = self.snapshot()
+            age = snapshot.age()
+            limit = self.max_staleness() if max_staleness is None else max_staleness
+            if age is not None and age <= limit:
+                return 'snapshot', snapshot.pool
+        return 'readonly', self.readonly_pool()
+
+    def stats(self):
+        stats = {'mode': self.mode, 'reads': dict(self.reads)}
+        snapshot = self._pools.get('snapshot')
+        if snapshot is not None:
+            stats['snapshot'] = snapshot.stats()
+        return stats
+
+
+def get_router():
+    return current_app.extensions['db_read_router']
+
+
+def get_read_connection(max_staleness=None):
+    # For read-only views. One connection per request, released at teardown; writes made
+    # earlier in the request are only visible here when it routes to the primary.
+    if 'db_read_conn' not in g:
+        router = get_router()
+        source, pool = router.route(max_staleness)
+        router.reads[source] += 1
+        if pool is None:
+            conn = db.get_db_connection()
+        else:
+            conn = pool.acquire()
+            g.db_read_pool = pool
+            profile = g.get('request_profile')
+            if profile is not None:
+                profile.attach(conn)
+        g.db_read_conn = conn
+        g.db_read_source = source
+    return g.db_read_conn
+
+
+def read_source():
+    # What the current request's reads were served from, for templates
+    source = g.get('db_read_source')
+    if source != 'snapshot':
+        return {'source': source, 'age_seconds': None}
+    return {'source': source, 'age_seconds': get_router().snapshot().age()}
+
+
+def release_read_connection(exception=None):
+    conn = g.pop('db_read_conn', None)
+    pool = g.pop('db_read_pool', None)
+    g.pop('db_read_source', None)
+    if conn is not None and pool is not None:
+        if conn.profile is not None:
+            conn.profile.detach(conn)
+        pool.release(conn)
+
+
+def read_stats():
+    return get_router().stats()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.extensions['db_read_router'] = ReadRouter(app)
+    app.teardown_appcontext(release_read_connection)
@@ -0,0 +1,363 @@
+import sqlite3
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+import db
+from db import get_db_connection
+
+# Summary tables behind /reports, /performance and /sales_orders. Triggers append the keys
+# touched by every write to ReportingChanges; refresh() recomputes only those keys and
+# advances the high-water mark, so its cost follows the size of the change, not of history.
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS ReportingChanges (
+        change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        ref
+    );
+
+    CREATE TABLE IF NOT EXISTS ReportingState (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        high_water_mark INTEGER NOT NULL DEFAULT 0,
+        refreshed_at REAL
+    );
+    INSERT OR IGNORE INTO ReportingState (id, high_water_mark, refreshed_at) VALUES (1, 0, NULL);
+
+    CREATE TABLE IF NOT EXISTS CategoryStockSummary (
+        category_id INTEGER PRIMARY KEY,
+        category_name TEXT,
+        total_stock INTEGER NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS SalesOrderSummary (
+        so_id INTEGER PRIMARY KEY,
+        customer_id INTEGER,
+        order_date TEXT,
+        status TEXT,
+        total_items INTEGER,
+        total_value REAL
+    );
+
+    CREATE TABLE IF NOT EXISTS DailySalesSummary (
+        sale_date TEXT NOT NULL,
+        item_id INTEGER NOT NULL,
+        customer_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (sale_date, item_id, customer_id)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS idx_sales_orders_order_date ON SalesOrders (order_date);
+
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_stock_insert AFTER INSERT ON Stock
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref)
+        SELECT 'category', category_id FROM Items WHERE item_id = NEW.item_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_stock_update AFTER UPDATE OF item_id, quantity ON Stock
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref)
+        SELECT 'category', category_id FROM Items WHERE item_id IN (OLD.item_id, NEW.item_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_stock_delete AFTER DELETE ON Stock
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref)
+        SELECT 'category', category_id FROM Items WHERE item_id = OLD.item_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_items_update AFTER UPDATE OF category_id ON Items
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref) VALUES ('category', OLD.category_id), ('category', NEW.category_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_items_delete AFTER DELETE ON Items
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref) VALUES ('category', OLD.category_id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_categories_insert AFTER INSERT ON Categories
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref) VALUES ('category', NEW.category_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_categories_update AFTER UPDATE OF category_name ON Categories
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref) VALUES ('category', NEW.category_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_categories_delete AFTER DELETE ON Categories
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref) VALUES ('category', OLD.category_id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_sales_orders_insert AFTER INSERT ON SalesOrders
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref) VALUES ('order', NEW.so_id), ('day', NEW.order_date);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_sales_orders_update AFTER UPDATE OF customer_id, order_date, status ON SalesOrders
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref)
+        VALUES ('order', NEW.so_id), ('day', OLD.order_date), ('day', NEW.order_date);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_sales_orders_delete AFTER DELETE ON SalesOrders
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref) VALUES ('order', OLD.so_id), ('day', OLD.order_date);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_sales_details_insert AFTER INSERT ON SalesOrderDetails
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref) VALUES ('order', NEW.so_id);
+        INSERT INTO ReportingChanges (kind, ref)
+        SELECT 'day', order_date FROM SalesOrders WHERE so_id = NEW.so_id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_sales_details_update AFTER UPDATE OF so_id, item_id, quantity_sold, unit_price ON SalesOrderDetails
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref) VALUES ('order', OLD.so_id), ('order', NEW.so_id);
+        INSERT INTO ReportingChanges (kind, ref)
+        SELECT 'day', order_date FROM SalesOrders WHERE so_id IN (OLD.so_id, NEW.so_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_reporting_sales_details_delete AFTER DELETE ON SalesOrderDetails
+    BEGIN
+        INSERT INTO ReportingChanges (kind, ref) VALUES ('order', OLD.so_id);
+        INSERT INTO ReportingChanges (kind, ref)
+        SELECT 'day', order_date FROM SalesOrders WHERE so_id = OLD.so_id;
+    END;
+'''
+
+# Each recompute replaces the summary rows for a set of keys; {keys} expands to placeholders
+RECOMPUTE = {
+    'category': (
+        'DELETE FROM CategoryStockSummary WHERE category_id IN ({keys})',
+        '''
+        INSERT INTO CategoryStockSummary (category_id, category_name, total_stock)
+        SELECT c.category_id, c.category_name, SUM(IFNULL(t.total_qty, 0))
+        FROM Categories c
+        LEFT JOIN Items i ON c.category_id = i.category_id
+        LEFT JOIN ItemStockTotals t ON i.item_id = t.item_id
+        WHERE c.category_id IN ({keys})
+        GROUP BY c.category_id
+        ''',
+    ),
+    'order': (
+        'DELETE FROM SalesOrderSummary WHERE so_id IN ({keys})',
+        '''
+        INSERT INTO SalesOrderSummary (so_id, customer_id, order_date, status, total_items, total_value)
+        SELECT so.so_id, so.customer_id, so.order_date, so.status,
+               SUM(sod.quantity_sold), SUM(sod.quantity_sold * sod.unit_price)
+        FROM SalesOrders so
+        JOIN SalesOrderDetails sod ON so.so_id = sod.so_id
+        WHERE so.so_id IN ({keys})
+        GROUP BY so.so_id
+        ''',
+    ),
+    'day': (
+        'DELETE FROM DailySalesSummary WHERE sale_date IN ({keys})',
+        '''
+        INSERT INTO DailySalesSummary (sale_date, item_id, customer_id, quantity, value)
+        SELECT so.order_date, sod.item_id, so.customer_id,
+               SUM(sod.quantity_sold), SUM(sod.quantity_sold * sod.unit_price)
+        FROM SalesOrders so
+        JOIN SalesOrderDetails sod ON so.so_id = sod.so_id
+        WHERE so.order_date IN ({keys}) AND sod.item_id IS NOT NULL AND so.customer_id IS NOT NULL
+        GROUP BY so.order_date, sod.item_id, so.customer_id
+        ''',
+    ),
+}
+
+# SQLite's default limit on bound parameters is 999 on older builds
+KEY_BATCH = 500
+
+
+def _recompute(conn, kind, keys):
+    delete_sql, insert_sql = RECOMPUTE[kind]
+    for start in range(0, len(keys), KEY_BATCH):
+        batch = keys[start:start + KEY_BATCH]
+        placeholders = ', '.join('?' * len(batch))
+        conn.execute(delete_sql.format(keys=placeholders), batch)
+        conn.execute(insert_sql.format(keys=placeholders), batch)
+
+
+# Journals every key once, so the next refresh() recomputes all summaries from scratch
+SEED = '''
+    INSERT INTO ReportingChanges (kind, ref) SELECT 'category', category_id FROM Categories;
+    INSERT INTO ReportingChanges (kind, ref) SELECT 'order', so_id FROM SalesOrders;
+    INSERT INTO ReportingChanges (kind, ref) SELECT DISTINCT 'day', order_date FROM SalesOrders;
+'''
+
+
+def refresh(conn):
+    # BEGIN IMMEDIATE so two refreshers (scheduler and a request) never apply the same batch
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        high_water_mark = conn.execute(
+            'SELECT high_water_mark FROM ReportingState WHERE id = 1'
+        ).fetchone()[0]
+        changes = conn.execute(
+            'SELECT change_id, kind, ref FROM ReportingChanges WHERE change_id > ? ORDER BY change_id',
+            (high_water_mark,)
+        ).fetchall()
+        keys = {kind: set() for kind in RECOMPUTE}
+        for change in changes:
+            if change['ref'] is not None:
+                keys[change['kind']].add(change['ref'])
+        for kind, refs in keys.items():
+            if refs:
+                _recompute(conn, kind, sorted(refs, key=str))
+        if changes:
+            high_water_mark = changes[-1]['change_id']
+            conn.execute('DELETE FROM ReportingChanges WHERE change_id <= ?', (high_water_mark,))
+        conn.execute(
+            'UPDATE ReportingState SET high_water_mark = ?, refreshed_at = ? WHERE id = 1',
+            (high_water_mark, time.time())
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(changes)
+
+
+def rebuild(conn):
+    with conn:
+        conn.execute('DELETE FROM CategoryStockSummary')
+        conn.execute('DELETE FROM SalesOrderSummary')
+        conn.execute('DELETE FROM DailySalesSummary')
+        for statement in SEED.split(';'):
+            if statement.strip():
+                conn.execute(statement)
+    return refresh(conn)
+
+
+def status(conn):
+    row = conn.execute('''
+        SELECT refreshed_at, high_water_mark,
+               (SELECT COUNT(*) FROM ReportingChanges
+                WHERE change_id > ReportingState.high_water_mark) AS pending
+        FROM ReportingState WHERE id = 1
+    ''').fetchone()
+    age = time.time() - row['refreshed_at'] if row['refreshed_at'] else None
+    # high_water_mark identifies the summaries' contents: it only moves when they change
+    return {'refreshed_at': row['refreshed_at'], 'age_seconds': age, 'pending_changes': row['pending'],
+            'high_water_mark': row['high_water_mark']}
+
+
+def try_refresh(conn):
+    try:
+        refresh(conn)
+    except sqlite3.OperationalError as exc:
+        # Another refresher or a long write held the lock past busy_timeout; serve the
+        # summaries as they are (the status shows what is pending) rather than fail
+        if 'locked' not in str(exc):
+            raise
+
+
+def ensure_fresh(conn, max_staleness=None):
+    # Views call this before reading summaries. Pending changes older than
+    # REPORT_MAX_STALENESS seconds are applied inline; the work is bounded by the change set.
+    state = status(conn)
+    if max_staleness is None:
+        max_staleness = current_app.config['REPORT_MAX_STALENESS']
+    if state['pending_changes'] and (state['age_seconds'] is None or state['age_seconds'] >= max_staleness):
+        try_refresh(conn)
+        state = status(conn)
+    return state
+
+
+# Page data for /reports and /performance, as plain dicts so a background job can store it
+def reports_data(conn):
+    report_data = conn.execute('''
+        SELECT category_name, total_stock
+        FROM CategoryStockSummary
+        ORDER BY category_id
+    ''').fetchall()
+    daily_sales = conn.execute('''
+        SELECT sale_date, SUM(quantity) AS total_items, SUM(value) AS total_value
+        FROM DailySalesSummary
+        GROUP BY sale_date
+        ORDER BY sale_date DESC
+        LIMIT 14
+    ''').fetchall()
+    return {'report_data': [dict(row) for row in report_data],
+            'daily_sales': [dict(row) for row in daily_sales]}
+
+
+# Sales orders listed on the performance page
+RECENT_SALES_ORDERS = 100
+
+
+def performance_data(conn, sales_orders='SalesOrderSummary'):
+    # sales_orders: the summary table, or the summary unioned with the archives. Only the
+    # newest orders are listed, so the page costs the same however long the history is; the
+    # sales orders page pages through the rest.
+    performance_data = conn.execute('''
+        SELECT i.item_id, i.item_name, IFNULL(t.total_qty,0) AS total_stock, i.reorder_level
+        FROM Items i
+        LEFT JOIN ItemStockTotals t ON i.item_id = t.item_id
+        WHERE IFNULL(t.total_qty,0) < i.reorder_level
+    ''').fetchall()
+    sales_summary = conn.execute(f'''
+        SELECT 
+            so.so_id,
+            c.customer_name,
+            so.order_date,
+            so.status,
+            so.total_items,
+            so.total_value
+        FROM {sales_orders} so
+        JOIN Customers c ON so.customer_id = c.customer_id
+        ORDER BY so.so_id DESC
+        LIMIT ?
+    ''', (RECENT_SALES_ORDERS,)).fetchall()
+    return {'performance_data': [dict(row) for row in performance_data],
+            'sales_summary': [dict(row) for row in sales_summary]}
+
+
+class RefreshScheduler:
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='report-refresh', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        conn = db.connect(self.path)
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    refresh(conn)
+                    self.last_error = None
+                except Exception as exc:
+                    self.last_error = repr(exc)
+        finally:
+            conn.close()
+
+
+def init_app(app):
+    app.config.setdefault('REPORT_REFRESH_INTERVAL', 30)
+    app.config.setdefault('REPORT_MAX_STALENESS', 0)
+    app.cli.add_command(refresh_reports_command)
+
+    if app.config['REPORT_REFRESH_INTERVAL']:
+        scheduler = RefreshScheduler(app.config['DATABASE'], app.config['REPORT_REFRESH_INTERVAL'])
+        app.extensions['report_scheduler'] = scheduler
+        # Started by the first request so CLI commands don't spawn the thread
+        app.before_request(scheduler.start)
+
+
+@click.command('refresh-reports')
+@click.option('--rebuild', 'do_rebuild', is_flag=True, help='Recompute every summary row.')
+@with_appcontext
+def refresh_reports_command(do_rebuild):
+    conn = get_db_connection()
+    applied = rebuild(conn) if do_rebuild else refresh(conn)
+    click.echo(f'Applied {applied} reporting changes.')
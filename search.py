@@ -0,0 +1,63 @@
+import re
+import sqlite3
+
+# ItemsSearch is an external-content FTS5 index over Items(item_name, description),
+# kept in sync by triggers. Builds without FTS5 never get the table and fall back to LIKE.
+
+FTS_SCHEMA = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS ItemsSearch USING fts5(
+        item_name, description,
+        content='Items', content_rowid='item_id',
+        tokenize='unicode61 remove_diacritics 2'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS trg_items_search_insert AFTER INSERT ON Items
+    BEGIN
+        INSERT INTO ItemsSearch (rowid, item_name, description)
+        VALUES (NEW.item_id, NEW.item_name, NEW.description);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_items_search_delete AFTER DELETE ON Items
+    BEGIN
+        INSERT INTO ItemsSearch (ItemsSearch, rowid, item_name, description)
+        VALUES ('delete', OLD.item_id, OLD.item_name, OLD.description);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_items_search_update AFTER UPDATE OF item_name, description ON Items
+    BEGIN
+        INSERT INTO ItemsSearch (ItemsSearch, rowid, item_name, description)
+        VALUES ('delete', OLD.item_id, OLD.item_name, OLD.description);
+        INSERT INTO ItemsSearch (rowid, item_name, description)
+        VALUES (NEW.item_id, NEW.item_name, NEW.description);
+    END;
+
+    INSERT INTO ItemsSearch (ItemsSearch) VALUES ('rebuild');
+'''
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def fts5_supported(conn):
+    try:
+        conn.execute('CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)')
+    except sqlite3.OperationalError:
+        return False
+    conn.execute('DROP TABLE temp.fts5_probe')
+    return True
+
+
+def fts_migration(conn):
+    return FTS_SCHEMA if fts5_supported(conn) else ''
+
+
+def has_search_index(conn):
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ItemsSearch'"
+    ).fetchone()
+    return row is not None
+
+
+def match_expression(text):
+    # Every word must match as a prefix: "lin clo" finds "Linen Cloth"
+    tokens = _TOKEN.findall(text)
+    return ' '.join('"{}"*'.format(token.replace('"', '""')) for token in tokens)
@@ -0,0 +1,69 @@
+import click
+from flask.cli import with_appcontext
+
+from db import get_db_connection
+
+# ItemStockTotals / ItemWarehouseStockTotals are kept exact by the Stock triggers in
+# migrations.py. These helpers compare them against the live SUM and rebuild them.
+
+MISMATCH_QUERY = '''
+    SELECT item_id, NULL AS warehouse_id, live_qty, stored_qty FROM (
+        SELECT item_id, SUM(live_qty) AS live_qty, SUM(stored_qty) AS stored_qty FROM (
+            SELECT item_id, quantity AS live_qty, 0 AS stored_qty FROM Stock WHERE item_id IS NOT NULL
+            UNION ALL
+            SELECT item_id, 0, total_qty FROM ItemStockTotals
+        ) GROUP BY item_id
+    ) WHERE live_qty != stored_qty
+    UNION ALL
+    SELECT item_id, warehouse_id, live_qty, stored_qty FROM (
+        SELECT item_id, warehouse_id, SUM(live_qty) AS live_qty, SUM(stored_qty) AS stored_qty FROM (
+            SELECT item_id, IFNULL(warehouse_id, 0) AS warehouse_id, quantity AS live_qty, 0 AS stored_qty
+            FROM Stock WHERE item_id IS NOT NULL
+            UNION ALL
+            SELECT item_id, warehouse_id, 0, total_qty FROM ItemWarehouseStockTotals
+        ) GROUP BY item_id, warehouse_id
+    ) WHERE live_qty != stored_qty
+    ORDER BY item_id
+'''
+
+
+def verify(conn):
+    return conn.execute(MISMATCH_QUERY).fetchall()
+
+
+def rebuild(conn):
+    with conn:
+        conn.execute('DELETE FROM ItemStockTotals')
+        conn.execute('DELETE FROM ItemWarehouseStockTotals')
+        conn.execute('''
+            INSERT INTO ItemStockTotals (item_id, total_qty)
+            SELECT item_id, SUM(quantity) FROM Stock WHERE item_id IS NOT NULL GROUP BY item_id
+        ''')
+        conn.execute('''
+            INSERT INTO ItemWarehouseStockTotals (item_id, warehouse_id, total_qty)
+            SELECT item_id, IFNULL(warehouse_id, 0), SUM(quantity) FROM Stock
+            WHERE item_id IS NOT NULL GROUP BY item_id, IFNULL(warehouse_id, 0)
+        ''')
+
+
+def init_app(app):
+    app.cli.add_command(stock_totals_command)
+
+
+@click.command('stock-totals')
+@click.option('--rebuild', 'do_rebuild', is_flag=True, help='Recompute the totals from Stock.')
+@with_appcontext
+def stock_totals_command(do_rebuild):
+    conn = get_db_connection()
+    if do_rebuild:
+        rebuild(conn)
+        click.echo('Stock totals rebuilt.')
+    mismatches = verify(conn)
+    for row in mismatches:
+        where = f"item {row['item_id']}"
+        if row['warehouse_id'] is not None:
+            where += f" warehouse {row['warehouse_id']}"
+        click.echo(f"{where}: Stock has {row['live_qty']}, totals have {row['stored_qty']}")
+    if mismatches:
+        raise SystemExit(1)
+    click.echo('Stock totals match Stock.')
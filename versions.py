@@ -0,0 +1,57 @@
+import hashlib
+
+# Every tracked table has a row in TableVersions whose version is bumped by triggers on each
+# insert/update/delete. Readers compare versions to tell whether data they derived is stale
+# without re-running the query (API ETags, cached fragments).
+TRACKED_TABLES = (
+    'Categories', 'Suppliers', 'Customers', 'Warehouses', 'Items', 'Stock',
+    'PurchaseOrders', 'PurchaseOrderDetails', 'SalesOrders', 'SalesOrderDetails',
+    'Users', 'Transactions',
+)
+
+
+def migration(conn):
+    statements = ['''
+        CREATE TABLE IF NOT EXISTS TableVersions (
+            table_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            changed_at INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    ''']
+    for table in TRACKED_TABLES:
+        statements.append(
+            f"INSERT OR IGNORE INTO TableVersions (table_name, version, changed_at) "
+            f"VALUES ('{table}', 0, CAST(strftime('%s', 'now') AS INTEGER));"
+        )
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            statements.append(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_version_{table.lower()}_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    UPDATE TableVersions
+                    SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER)
+                    WHERE table_name = '{table}';
+                END;
+            ''')
+    return '\n'.join(statements)
+
+
+def current(conn, tables):
+    placeholders = ', '.join('?' * len(tables))
+    return conn.execute(
+        f'SELECT table_name, version, changed_at FROM TableVersions '
+        f'WHERE table_name IN ({placeholders}) ORDER BY table_name',
+        tuple(tables)
+    ).fetchall()
+
+
+def fingerprint(conn, tables, *extra):
+    # Returns (etag, last_modified_epoch) for data derived from the given tables
+    rows = current(conn, tables)
+    digest = hashlib.sha1()
+    for part in extra:
+        digest.update(str(part).encode())
+        digest.update(b'\0')
+    for row in rows:
+        digest.update(f"{row['table_name']}={row['version']};".encode())
+    last_modified = max((row['changed_at'] for row in rows), default=0)
+    return digest.hexdigest()[:20], last_modified